@@ -1,9 +1,10 @@
-import sys, argparse
+import sys, argparse, time
+
+# origin of the startup profile, before the heavy imports
+START = time.perf_counter()
 
 import pygame as pg
 
-import imgui
-import my_imgui.pygame_imgui as pygame_imgui
 import numpy as np
 import moderngl as mgl
 import glm
@@ -13,14 +14,32 @@ from model import *
 from config import *
 from shader_program import ShaderProgram
 from light import Light
+from nbody.backend import init_taichi
+from nbody.cli import add_checkpoint_args, add_diagnostics_args, add_ic_args, add_record_args, add_startup_args, add_timing_args
+from nbody.checkpoint import read_checkpoint_meta
+from nbody.ic import parse_ic_params
+from nbody.timing import FramePacer, FrameTimer, StartupProfile
 
 import taichi as ti
 
+# imgui is only imported for the options window (it pulls PyOpenGL), not with --hide_options
+imgui = pygame_imgui = None
+
+def import_imgui():
+    global imgui, pygame_imgui
+
+    import imgui
+    import my_imgui.pygame_imgui as pygame_imgui
+
 # -----------------------------------------------------------------------------------------------------------
 
 class App:
 
-    def __init__(self, screen_width=1280, screen_height=800, hide_options=True, max_fps=0, nb_body=8, dt=0.005, eps=0.5):
+    def __init__(self, screen_width=1280, screen_height=800, hide_options=True, max_fps=0, nb_body=8, dt=0.005, eps=0.5, solver="direct", theta=0.5, grid=128, periodic=False, upload="orphan", threaded=False, integrator="kdk", layout="soa",
+                 record=None, record_every=10, record_dtype="float32", record_compression="none",
+                 checkpoint=None, checkpoint_every=0, checkpoint_interval=0.0, restart=None, seed=0, ic="cube", ic_params=None, ic_cache=None,
+                 replay=None, replay_speed=30.0, replay_mode="skip", diag_every=0, reorder_every=0, collision_radius=0.0, profile=False, trace=None, startup=None,
+                 precision="f32", vbo_format="f32", lod_budget=0, lod_grid=64, capacity=0, substeps=0):
 
         self.screen_width = screen_width
         self.screen_height = screen_height
@@ -28,6 +47,61 @@ class App:
         self.hide_options = hide_options
 
         self.nb_body = nb_body
+        self.capacity = capacity
+        self.solver = solver
+        self.theta = theta
+        self.grid = grid
+        self.periodic = periodic
+        self.integrator = integrator
+        self.layout = layout
+
+        self.record = record
+        self.record_every = record_every
+        self.record_dtype = record_dtype
+        self.record_compression = record_compression
+
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        self.restart = restart
+        self.seed = seed
+
+        self.ic = ic
+        self.ic_params = ic_params
+        self.ic_cache = ic_cache
+
+        self.reorder_every = reorder_every
+        self.collision_radius = collision_radius
+
+        self.replay = replay
+        self.replay_speed = replay_speed
+        self.replay_mode = replay_mode
+
+        self.diag_every = diag_every
+
+        # bodies of the spawned clusters / removals (options)
+        self.spawn_body = 1024
+
+        # per phase frame timing, profile adds the kick / drift / force phases of the steps
+        self.profile = profile
+        self.trace = trace
+        self.timer = FrameTimer(trace=bool(trace), sync=ti.sync)
+
+        # physics steps per rendered frame, fitted to the max fps (0 substeps = automatic)
+        self.pacer = FramePacer(fps=max_fps, substeps=substeps)
+
+        # StartupProfile printed after the first frame, or None
+        self.startup = startup
+
+        self.upload = upload
+        self.threaded = threaded
+
+        self.precision = precision
+        self.vbo_format = vbo_format
+
+        # level of detail: at most lod_budget vertices drawn, 0 = every body
+        self.lod_budget = lod_budget
+        self.lod_grid = lod_grid
 
         #
         self.lastTime = time.time()
@@ -48,6 +122,7 @@ class App:
 
         # IMGUI
         if not self.hide_options:
+            import_imgui()
             imgui.create_context()
             self.imgui_renderer = pygame_imgui.PygameRenderer()
             imgui.get_io().display_size = self.screen_width, self.screen_height
@@ -95,10 +170,14 @@ class App:
         # camera
         self.camera = Camera(self, fov=FOV, near=NEAR, far=FAR, position=CAM_POS, speed=SPEED, sensivity=SENSITIVITY)
 
+        self.mark_startup("window")
+
         # scene object
         self.scene = []
 
-        self.sim = Simulation(self, self.nbody_program)
+        self.sim = Replay(self, self.nbody_program) if self.replay else Simulation(self, self.nbody_program)
+        if self.profile and self.sim.nbody_system:
+            self.sim.nbody_system.instrument(self.timer)
         self.scene.append(self.sim)
 
         self.ctx.clear(color = (0.0, 0.0, 0.0))
@@ -109,6 +188,16 @@ class App:
         for obj in self.scene:
             obj.destroy()
 
+        print(self.timer.format_summary())
+
+        if self.trace:
+            nb_event = self.timer.export_trace(self.trace)
+            print("trace %s: %d events" % (self.trace, nb_event))
+
+    def mark_startup(self, name):
+        if self.startup:
+            self.startup.mark(name)
+
     def set_uniform(self, program, u_name, u_value):
         try:
             program[u_name] = u_value
@@ -121,8 +210,15 @@ class App:
 
         if delta >= 1:
             fps = f"FPS: {self.fps.get_fps():3.0f}"
+            steps = f"Steps/s: {self.sim.get_steps_per_sec():3.0f}"
+            upload = f"Upload: {self.sim.get_upload_time() * 1000:.2f} ms ({self.sim.get_upload_bytes() / 1e6:.2f} MB)"
             cam_pos = f"CamPos: {int(self.camera.position.x)}, {int(self.camera.position.y)}, {int(self.camera.position.z)}"
-            pg.display.set_caption(fps + " | " + cam_pos)
+
+            if self.replay:
+                step, sim_time = self.sim.player.get_frame_info()
+                steps = f"Frame: {self.sim.player.current()}/{self.sim.player.nb_frame} (step {step}, t = {sim_time:.3f})"
+
+            pg.display.set_caption(fps + " | " + steps + " | " + upload + " | " + cam_pos)
 
             self.lastTime = self.currentTime
 
@@ -150,6 +246,15 @@ class App:
                     self.up = True
                 if event.key == pg.K_LSHIFT:
                     self.down = True
+
+                # replay: pause, frame by frame
+                if self.replay:
+                    if event.key == pg.K_SPACE:
+                        self.sim.player.paused = not self.sim.player.paused
+                    if event.key == pg.K_PERIOD:
+                        self.sim.player.step(1)
+                    if event.key == pg.K_COMMA:
+                        self.sim.player.step(-1)
                 
             if event.type == pg.KEYUP:
                 if event.key == pg.K_UP:
@@ -226,76 +331,211 @@ class App:
         imgui.new_frame()
         imgui.begin("Options", True)
 
-        _, self.dt  = imgui.slider_float("dt", self.dt, 0.001, 1.0)
-        _, self.eps = imgui.slider_float("eps", self.eps, 0.01, 1.0)
+        if self.replay:
+            player = self.sim.player
+
+            changed, frame = imgui.slider_int("frame", player.current(), 0, player.nb_frame - 1)
+            if changed:
+                player.seek(frame)
+
+            _, player.speed = imgui.slider_float("frames/s", player.speed, -120.0, 120.0)
+            _, player.paused = imgui.checkbox("pause", player.paused)
+
+            changed, index = imgui.combo("mode", REPLAY_MODES.index(player.mode), list(REPLAY_MODES))
+            if changed:
+                player.mode = REPLAY_MODES[index]
+        else:
+            _, self.dt  = imgui.slider_float("dt", self.dt, 0.001, 1.0)
+            _, self.eps = imgui.slider_float("eps", self.eps, 0.01, 1.0)
+
+            if self.threaded:
+                imgui.text("Substeps: threaded, the physics runs on its own")
+            else:
+                pacing = self.pacer.get_info()
+                imgui.text(f"Substeps: {pacing['substeps']} {'auto' if pacing['auto'] else 'fixed'}  step: {pacing['step_ms']:.2f} ms  "
+                           f"render: {pacing['other_ms']:.2f} ms  budget: {pacing['budget_ms']:.2f} ms")
+
+            # the solver of the system, a --restart keeps the one of the checkpoint
+            system = self.sim.nbody_system
+            if system.solver == "bh":
+                _, system.theta = imgui.slider_float("theta", system.theta, 0.1, 1.5)
+
+            # added / removed in place while they fit the slots, the system grows (recompiles) otherwise
+            imgui.text(f"Bodies: {system.n_active} / {system.nb_body} slots")
+            _, self.spawn_body = imgui.slider_int("cluster bodies", self.spawn_body, 1, 16384)
+            if imgui.button("spawn cluster"):
+                self.sim.spawn_cluster(self.spawn_body)
+            imgui.same_line()
+            if imgui.button("remove"):
+                self.sim.remove_random(self.spawn_body)
+
+        if self.sim.lod:
+            lod = self.sim.lod.get_info()
+            imgui.text(f"LOD: {lod['vertices']} vertices ({lod['near']} near, {lod['cells']} cells)  radius: {lod['radius']:.2f}")
+
+        collisions = getattr(self.sim.nbody_system, "collisions", None)
+        if collisions:
+            info = collisions.get_info()
+            imgui.text(f"Collisions: {info['merges']} merges  active bodies: {info['active']}")
+
+        if self.sim.writer:
+            m = self.sim.writer.metrics()
+            imgui.text(f"Recorded: {m['frames_written']}  dropped: {m['frames_dropped']}  queued: {m['frames_queued']}")
+            imgui.text(f"Write: {m['write_mb_per_sec']:.1f} MB/s")
+
+        if self.sim.diagnostics and self.sim.diagnostics.samples:
+            diagnostics = self.sim.diagnostics
+            last = diagnostics.samples[-1]
+
+            imgui.text(f"E: {last['energy']:.6e}  dE/E: {last['energy_error']:+.2e}  2K/|W|: {last['virial']:.3f}")
+            imgui.plot_lines("dE/E", np.array(diagnostics.series("energy_error"), dtype='f4'), graph_size=(0, 60))
+            imgui.plot_lines("2K/|W|", np.array(diagnostics.series("virial"), dtype='f4'), graph_size=(0, 60))
+
+        # rolling percentiles of the frame phases
+        if imgui.collapsing_header("Timing")[0]:
+            imgui.text("%-12s %8s %8s %8s" % ("phase", "p50 ms", "p95 ms", "p99 ms"))
+            for name, values in self.timer.summary().items():
+                imgui.text("%-12s %8.3f %8.3f %8.3f" % ((name,) + tuple(v * 1000 for v in values)))
 
         imgui.end()
 
     def run(self):
 
+        timer = self.timer
+
         while True:
+            self.pacer.begin_frame()
+
             # app.time used for object model motion
             self.set_time()
 
             # pygame events
-            self.check_events()
+            with timer.phase("events"):
+                self.check_events()
 
             #
-            self.camera.update(self.mouse_dx, self.mouse_dy, self.forward, self.backward, self.left, self.right, self.up, self.down)
+            with timer.phase("camera"):
+                self.camera.update(self.mouse_dx, self.mouse_dy, self.forward, self.backward, self.left, self.right, self.up, self.down)
 
             if CLEAR_ON:
                 self.ctx.clear(color = (0.0, 0.0, 0.0))
 
             for obj in self.scene:
                 obj.update()
-                obj.render()
+
+                # GL is asynchronous: draw is the submission, the GPU time shows up in swap
+                with timer.phase("draw"):
+                    obj.render()
 
             # imgui
             if not self.hide_options:
-                self.show_options_ui()
-                imgui.render()
-                self.imgui_renderer.render(imgui.get_draw_data())
+                with timer.phase("imgui"):
+                    self.show_options_ui()
+                    imgui.render()
+                    self.imgui_renderer.render(imgui.get_draw_data())
 
             # show
-            pg.display.flip()
+            with timer.phase("swap"):
+                pg.display.flip()
+
+            # the substeps of the next frame, from the work of this one
+            self.pacer.end_frame()
 
             # fps
-            self.delta_time = self.clock.tick(self.max_fps)
+            with timer.phase("wait"):
+                self.delta_time = self.clock.tick(self.max_fps)
+
+            timer.end_frame()
+
+            if self.startup:
+                self.startup.mark("first frame")
+                print(self.startup.format())
+                self.startup = None
+
             self.get_fps()
             self.num_frames += 1
 
 # -----------------------------------------------------------------------------------------------------------
 # python3 main.py --arch=cpu --body=32 --fps=-1
 # python3 main.py --arch=cpu --body=32 --fps=-1 -ho
+# python3 main.py --arch=cpu --body=65536 --fps=-1 --solver=bh --theta=0.5
+# python3 main.py --arch=cpu --body=16384 --fps=-1 --solver=tiled --profile --trace=frames.json
+# python3 main.py --arch=cpu --body=262144 --fps=-1 --solver=bh --vbo_format=i16 --precision=f64
+# python3 main.py --arch=cpu --body=1048576 --fps=-1 --solver=bh --threaded --lod_budget=200000
+# python3 main.py --arch=cpu --body=16384 --fps=-1 --solver=bh --ic=disk --collision_radius=0.02
+# python3 main.py --arch=cpu --body=1048576 --fps=-1 --solver=pm --grid=128 --threaded --lod_budget=200000
+# python3 main.py --arch=cpu --body=65536 --fps=-1 --solver=bh --ic=collision --ic_params=eps=0.5 --seed=2
+# python3 main.py --arch=cpu --body=16384 --fps=-1 --solver=bh --capacity=65536
+# python3 main.py --arch=cpu --body=4096 --fps=60 --solver=tiled
+# python3 main.py --fps=-1 --replay=run.nbt --replay_speed=60 --replay_mode=hermite
+# python3 main.py --arch=cpu --body=65536 --fps=-1 --solver=bh -ho --startup_profile
             
-parser = argparse.ArgumentParser(description="")
-
-parser.add_argument('-ww', '--width', help='width', default=1280, type=int)
-parser.add_argument('-hh', '--height', help='width', default=800, type=int)
-
-parser.add_argument('-a', '--arch', help='Taichi backend', default="cpu", action="store")
-parser.add_argument('-f', '--fps', help='Max FPS, 0 for unlimited', default=0, type=int)
-parser.add_argument('-b', '--body', help='NB Body', default=32, type=int)
-parser.add_argument('-ho', '--hide_options', help='Options UI', default=False, action="store_true")
-
-result = parser.parse_args()
-args = dict(result._get_kwargs())
-
-print("Args = %s" % args)
-
-if args["arch"] in ("cpu", "x64"):
-    ti.init(ti.cpu, debug=0, default_ip=ti.i32, default_fp=ti.f32)
-
-elif args["arch"] in ("gpu", "cuda"):
-    ti.init(ti.gpu)
-elif args["arch"] in ("opengl",):
-    ti.init(ti.opengl)
-elif args["arch"] in ("vulkan",):
-    ti.init(ti.vulkan)
+def main():
+    startup = StartupProfile(START)
+    startup.mark("imports")
+
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument('-ww', '--width', help='width', default=1280, type=int)
+    parser.add_argument('-hh', '--height', help='width', default=800, type=int)
+
+    parser.add_argument('-a', '--arch', help='Taichi backend', default="cpu", action="store")
+    parser.add_argument('-f', '--fps', help='Max FPS, 0 for unlimited', default=0, type=int)
+    parser.add_argument('-b', '--body', help='NB Body', default=32, type=int)
+    parser.add_argument('--substeps', help='Physics steps per frame, 0 for automatic (as many as --fps leaves room for, 1 with unlimited fps)', default=0, type=int)
+    parser.add_argument('-ho', '--hide_options', help='Options UI', default=False, action="store_true")
+    parser.add_argument('-s', '--solver', help='Force solver', default="direct", choices=SOLVERS)
+    parser.add_argument('-t', '--theta', help='Barnes-Hut opening angle', default=0.5, type=float)
+    parser.add_argument('-g', '--grid', help='Particle-mesh cells per axis', default=128, type=int)
+    parser.add_argument('--periodic', help='Particle-mesh periodic box (the initial cube)', default=False, action="store_true")
+    parser.add_argument('-i', '--integrator', help='Integrator', default="kdk", choices=tuple(INTEGRATORS))
+    parser.add_argument('-l', '--layout', help='Body fields memory layout', default="soa", choices=LAYOUTS)
+    parser.add_argument('-p', '--precision', help='Integration precision (forces are f32)', default="f32", choices=PRECISIONS)
+    parser.add_argument('-u', '--upload', help='VBO upload strategy', default="orphan", choices=UPLOADS)
+    parser.add_argument('-vf', '--vbo_format', help='VBO positions format', default="f32", choices=tuple(VBO_FORMATS))
+    parser.add_argument('-th', '--threaded', help='Step the physics in a background thread', default=False, action="store_true")
+    parser.add_argument('--lod_budget', help='Max vertices drawn per frame (near bodies + impostors of far cells), 0 for every body', default=0, type=int)
+    parser.add_argument('--reorder_every', help='Morton reorder the bodies every N steps (memory locality), 0 for never', default=0, type=int)
+    parser.add_argument('--collision_radius', help='Collision radius of a unit mass body (radius * mass^(1/3)), colliding bodies merge, 0 for none', default=0.0, type=float)
+    parser.add_argument('--capacity', help='Body slots allocated up front (bodies spawned from the options fit without a recompile)', default=0, type=int)
+    parser.add_argument('--lod_grid', help='LOD density grid cells per axis (capped by the budget)', default=64, type=int)
+    add_record_args(parser)
+    add_checkpoint_args(parser)
+    add_ic_args(parser)
+    add_diagnostics_args(parser)
+    add_timing_args(parser)
+    add_startup_args(parser)
+    parser.add_argument('--replay', help='Play a recorded trajectory instead of simulating', default=None)
+    parser.add_argument('--replay_speed', help='Replay speed in recorded frames per second, negative for backward', default=30.0, type=float)
+    parser.add_argument('--replay_mode', help='Replay between recorded frames', default="skip", choices=REPLAY_MODES)
+
+    result = parser.parse_args()
+    args = dict(result._get_kwargs())
+
+    print("Args = %s" % args)
+
+    if args["restart"]:
+        meta = read_checkpoint_meta(args["restart"])
+        args["seed"], args["precision"] = meta["seed"], meta.get("precision", "f32")
+
+    # fast math would drop the Kahan compensations
+    fast_math = args["precision"] != "kahan"
+
+    init_taichi(args["arch"], kernel_cache=args["kernel_cache"], random_seed=args["seed"], fast_math=fast_math)
+    startup.mark("taichi init")
+
+    app = App(screen_width=args["width"], screen_height=args["height"], max_fps=args["fps"], hide_options=args["hide_options"], nb_body=args["body"], dt=0.005, eps=0.5,
+              solver=args["solver"], theta=args["theta"], grid=args["grid"], periodic=args["periodic"], upload=args["upload"], threaded=args["threaded"], integrator=args["integrator"], layout=args["layout"],
+              record=args["record"], record_every=args["record_every"], record_dtype=args["record_dtype"], record_compression=args["record_compression"],
+              checkpoint=args["checkpoint"], checkpoint_every=args["checkpoint_every"], checkpoint_interval=args["checkpoint_interval"], restart=args["restart"], seed=args["seed"],
+              ic=args["ic"], ic_params=parse_ic_params(args["ic_params"]), ic_cache=args["ic_cache"],
+              replay=args["replay"], replay_speed=args["replay_speed"], replay_mode=args["replay_mode"],
+              diag_every=args["diag_every"], reorder_every=args["reorder_every"], collision_radius=args["collision_radius"], profile=args["profile"], trace=args["trace"], startup=startup if args["startup_profile"] else None,
+              precision=args["precision"], vbo_format=args["vbo_format"], lod_budget=args["lod_budget"], lod_grid=args["lod_grid"],
+              capacity=args["capacity"], substeps=args["substeps"])
+    app.run()
 
 # -----------------------------------------------------------------------------------------------------------
 
 if __name__ == '__main__':
-    app = App(screen_width=args["width"], screen_height=args["height"], max_fps=args["fps"], hide_options=args["hide_options"], nb_body=args["body"], dt=0.005, eps=0.5)
-    app.run()
-
+    main()
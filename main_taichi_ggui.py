@@ -1,76 +1,74 @@
-import sys, argparse
+import sys, argparse, time
+
+# origin of the startup profile, before the heavy imports
+START = time.perf_counter()
 
 import taichi as ti
 
+from nbody.backend import init_taichi
+from nbody.system import NBodySystem, SOLVERS, LAYOUTS, PRECISIONS
+from nbody.integrators import INTEGRATORS
+from nbody.cli import add_checkpoint_args, add_ic_args, add_record_args, add_startup_args, add_timing_args
+from nbody.checkpoint import Checkpointer, read_checkpoint_meta, system_from_checkpoint
+from nbody.ic import parse_ic_params
+from nbody.timing import FrameTimer, StartupProfile
+from nbody.trajectory import open_writer, print_writer_metrics
+
 # python3 main_taichi_ggui.py --arch=cpu --body=10 --fps=-1
 # python3 main_taichi_ggui.py --arch=vulkan --body=1024 --fps=60
+# python3 main_taichi_ggui.py --arch=cpu --body=16384 --fps=-1 --solver=bh --theta=0.5
+# python3 main_taichi_ggui.py --arch=cpu --body=4096 --fps=-1 --profile --kernel_profiler --trace=frames.json
+# python3 main_taichi_ggui.py --arch=cpu --body=65536 --fps=-1 --solver=bh --startup_profile
 
 # -----------------------------------------------------------------------------------------------------------
 
-@ti.data_oriented
-class Body:
-
-    def __init__(self, nb_body=8):
-
-        self.nb_body = nb_body
-
-        self.pos = ti.Vector.field(3, dtype=ti.f32, shape=self.nb_body)
-        self.vel = ti.Vector.field(3, dtype=ti.f32, shape=self.nb_body)
-        self.acc = ti.Vector.field(3, dtype=ti.f32, shape=self.nb_body)
-
-        self.mass = 1.0
-
-    @ti.kernel
-    def init(self):
-        for i in range(self.nb_body):
-            self.pos[i] = [((ti.random(float) * 2) - 1) * 1.0, ((ti.random(float) * 2) - 1) * 1.0, ((ti.random(float) * 2) - 1) * 1.0]
-            self.vel[i] = [0.0, 0.0, 0.0]
-            self.acc[i] = [0.0, 0.0, 0.0]
-
-    @ti.kernel
-    def update(self, dt: ti.f32, eps: ti.f32):
-
-        for i in range(self.nb_body):
-            self.vel[i] += self.acc[i] * 0.5 * dt
-            self.pos[i] += self.vel[i] * dt
+class App:
 
-        # only the outer loop is optimized 
-            
-        # For tne next for loop set the number of threads in a block on GPU
-        # ti.loop_config(block_dim=8)
+    def __init__(self, screen_width=1280, screen_height=800, max_fps=-1, camera_pos=ti.Vector([0.0, 0.0, 8.0]), nb_body=8, dt=0.005, eps=0.5, solver="direct", theta=0.5, grid=128, periodic=False, integrator="kdk", layout="soa", precision="f32",
+                 record=None, record_every=10, record_dtype="float32", record_compression="none",
+                 checkpoint=None, checkpoint_every=0, checkpoint_interval=0.0, restart=None, seed=0, ic="cube", ic_params=None, ic_cache=None,
+                 reorder_every=0, collision_radius=0.0, profile=False, trace=None, kernel_profiler=False, startup=None):
 
-        # For tne next for loop set the number of threads in a block on CPU
-        #ti.loop_config(parallelize=8)
+        # per phase frame timing, profile adds the kick / drift / force phases of the steps
+        self.trace = trace
+        self.kernel_profiler = kernel_profiler
+        self.timer = FrameTimer(trace=bool(trace), sync=ti.sync)
 
-        #for i, j in ti.ndrange(self.nb_body, self.nb_body): # does not work on vulkan / opengl ?
-        for i in range(self.nb_body):
-            for j in range(self.nb_body):
-                if i != j:
-                    DR = self.pos[j] - self.pos[i]
-                    DR2 = ti.math.dot(DR, DR)
-                    DR2 += eps*eps
+        # StartupProfile printed after the first frame, or None
+        self.startup = startup
 
-                    PHI = self.mass / (ti.sqrt(DR2) * DR2)
+        # Body
+        self.nb_body = nb_body
+        self.dt = dt
+        self.eps = eps
 
-                    self.acc[i] += DR * PHI
+        if restart:
+            # the checkpoint settings win over the command line
+            self.bodies, meta = system_from_checkpoint(restart)
+            self.nb_body, self.dt, self.eps = meta["nb_body"], meta["dt"], meta["eps"]
+        else:
+            self.bodies = NBodySystem(nb_body=self.nb_body, solver=solver, theta=theta, integrator=integrator, scale=1.0, layout=layout, precision=precision,
+                                      grid=grid, periodic=periodic)
+            self.bodies.init(ic=ic, seed=seed, params=ic_params, cache_dir=ic_cache)
 
-        for i in range(self.nb_body):
-            self.vel[i] += self.acc[i] * 0.5 * dt
-            self.acc[i] = [0.0, 0.0, 0.0]  
-          
-# -----------------------------------------------------------------------------------------------------------
+        self.bodies.set_reorder(reorder_every)
+        self.bodies.set_collisions(collision_radius)
+        self.mark_startup("initial conditions")
 
-class App:
+        # every kernel of the steps compiled now rather than on the first frame
+        self.bodies.warmup(self.dt, self.eps)
+        self.mark_startup("compile")
 
-    def __init__(self, screen_width=1280, screen_height=800, max_fps=-1, camera_pos=ti.Vector([0.0, 0.0, 8.0]), nb_body=8, dt=0.005, eps=0.5):
+        if profile:
+            self.bodies.instrument(self.timer)
 
-        # Body
-        self.nb_body = nb_body
-        self.dt = dt
-        self.eps = eps
+        self.writer = None
+        if record:
+            self.writer = open_writer(self.bodies, record, self.dt, self.eps, every=record_every, dtype=record_dtype, compression=record_compression)
 
-        self.bodies = Body(nb_body=self.nb_body)
-        self.bodies.init()
+        self.checkpointer = None
+        if checkpoint:
+            self.checkpointer = Checkpointer(checkpoint, every=checkpoint_every, interval=checkpoint_interval, seed=seed)
 
         # Window
         self.screen_width = screen_width
@@ -94,48 +92,99 @@ class App:
         
         self.cam_moved = False
 
+        self.mark_startup("window")
+
+    def mark_startup(self, name):
+        if self.startup:
+            self.startup.mark(name)
+
     def show_options(self):
         self.window.GUI.begin("Options", 0.05, 0.1, 0.2, 0.15)
         self.dt = self.window.GUI.slider_float("dt", self.dt, minimum=0.0, maximum=0.1)
         self.eps = self.window.GUI.slider_float("eps", self.eps, minimum=0.01, maximum=1.0)
         self.window.GUI.end()
 
+        self.window.GUI.begin("Timing (ms) p50 / p95 / p99", 0.05, 0.3, 0.25, 0.35)
+        for name, values in self.timer.summary().items():
+            self.window.GUI.text("%-12s %8.3f %8.3f %8.3f" % ((name,) + tuple(v * 1000 for v in values)))
+        self.window.GUI.end()
+
     def run(self):
 
+        timer = self.timer
+
         # drawing loop
         while self.window.running:
 
-            self.camera.track_user_inputs(self.window, movement_speed=1.0, hold_key=ti.ui.RMB)
+            with timer.phase("events"):
+                self.camera.track_user_inputs(self.window, movement_speed=1.0, hold_key=ti.ui.RMB)
+
+                for e in self.window.get_events(ti.ui.PRESS):
+                    if e.key in [ti.ui.ESCAPE]:
+                        # leaves the loop after this frame: the shutdown below (writer, checkpoint...) still runs
+                        self.window.running = False
+                    if e.key in [ti.ui.DOWN]:
+                        self.camera_pos.z += 1.001
+                        self.cam_moved = True
+                    if e.key in [ti.ui.UP]:
+                        self.camera_pos.z -= 1.001
+                        self.cam_moved = True
+
+            with timer.phase("camera"):
+                if self.cam_moved:
+                    self.camera.position(self.camera_pos.x, self.camera_pos.y, self.camera_pos.z)
+                    self.camera.lookat(0.0, 0.0, 0.0)
+                    self.cam_moved = False
+
+                self.scene.set_camera(self.camera)
+
+            with timer.phase("step", sync=True):
+                self.bodies.update(self.dt, self.eps)
+
+            if self.writer:
+                with timer.phase("record"):
+                    self.writer.write(self.bodies)
+            if self.checkpointer:
+                with timer.phase("checkpoint"):
+                    self.checkpointer.update(self.bodies, self.dt, self.eps)
 
-            for e in self.window.get_events(ti.ui.PRESS):
-                if e.key in [ti.ui.ESCAPE]:
-                    exit()
-                if e.key in [ti.ui.DOWN]:
-                    self.camera_pos.z += 1.001
-                    self.cam_moved = True
-                if e.key in [ti.ui.UP]:
-                    self.camera_pos.z -= 1.001
-                    self.cam_moved = True
+            with timer.phase("draw"):
+                self.scene.ambient_light((0.8, 0.8, 0.8))
+                self.scene.point_light(pos=(0.5, 1.5, 1.5), color=(1, 1, 1))
 
-            if self.cam_moved:
-                self.camera.position(self.camera_pos.x, self.camera_pos.y, self.camera_pos.z)
-                self.camera.lookat(0.0, 0.0, 0.0)
-                self.cam_moved = False
+                self.scene.particles(self.bodies.pos, radius=0.01, color=(1.0, 1.0, 1.0), index_count=self.bodies.n_active)
 
-            self.scene.set_camera(self.camera)
+                self.canvas.scene(self.scene)
 
-            self.bodies.update(self.dt, self.eps)
-            #ti.profiler.print_kernel_profiler_info()
+            with timer.phase("ui"):
+                self.show_options()
 
-            self.scene.ambient_light((0.8, 0.8, 0.8))
-            self.scene.point_light(pos=(0.5, 1.5, 1.5), color=(1, 1, 1))
-            
-            self.scene.particles(self.bodies.pos, radius=0.01, color=(1.0, 1.0, 1.0))
+            with timer.phase("show"):
+                self.window.show()
 
-            self.canvas.scene(self.scene)
-                        
-            self.show_options()
-            self.window.show()
+            timer.end_frame()
+
+            if self.startup:
+                self.startup.mark("first frame")
+                print(self.startup.format())
+                self.startup = None
+
+        if self.writer:
+            self.writer.close()
+            print_writer_metrics(self.writer)
+
+        if self.checkpointer:
+            self.checkpointer.save(self.bodies, self.dt, self.eps)
+
+        print(self.timer.format_summary())
+
+        if self.trace:
+            nb_event = self.timer.export_trace(self.trace)
+            print("trace %s: %d events" % (self.trace, nb_event))
+
+        # per kernel times (cpu / cuda only)
+        if self.kernel_profiler:
+            ti.profiler.print_kernel_profiler_info()
 
         self.window.destroy()
 
@@ -144,37 +193,61 @@ class App:
 def main():
 
     # const
-    USE_PROFILER  = 0
-
     SCREEN_WIDTH  = 1280
     SCREEN_HEIGHT = 800
     CAMERA_POS = ti.Vector([0.0, 0.0, 8.0])
 
+    startup = StartupProfile(START)
+    startup.mark("imports")
+
     # args
     parser = argparse.ArgumentParser(description="Leapfrog N-Body")
 
     parser.add_argument('-a', '--arch', help='Taichi backend', default="cpu", action="store")
     parser.add_argument('-f', '--fps', help='Max FPS, -1 for unlimited', default=-1, type=int)
     parser.add_argument('-b', '--body', help='NB Body', default=32, type=int)
+    parser.add_argument('-s', '--solver', help='Force solver', default="direct", choices=SOLVERS)
+    parser.add_argument('-t', '--theta', help='Barnes-Hut opening angle', default=0.5, type=float)
+    parser.add_argument('-g', '--grid', help='Particle-mesh cells per axis', default=128, type=int)
+    parser.add_argument('--periodic', help='Particle-mesh periodic box (the initial cube)', default=False, action="store_true")
+    parser.add_argument('-i', '--integrator', help='Integrator', default="kdk", choices=tuple(INTEGRATORS))
+    parser.add_argument('-l', '--layout', help='Body fields memory layout', default="soa", choices=LAYOUTS)
+    parser.add_argument('-p', '--precision', help='Integration precision (forces are f32)', default="f32", choices=PRECISIONS)
+    parser.add_argument('--collision_radius', help='Collision radius of a unit mass body (radius * mass^(1/3)), colliding bodies merge, 0 for none', default=0.0, type=float)
+    parser.add_argument('--reorder_every', help='Morton reorder the bodies every N steps (memory locality), 0 for never', default=0, type=int)
+    add_record_args(parser)
+    add_checkpoint_args(parser)
+    add_ic_args(parser)
+    add_timing_args(parser)
+    add_startup_args(parser)
+    parser.add_argument('--kernel_profiler', help='Taichi kernel profiler, printed on exit (cpu / cuda)', default=False, action="store_true")
 
     result = parser.parse_args()
     args = dict(result._get_kwargs())
 
     print("Args = %s" % args)
 
-    if args["arch"] in ("cpu", "x64"):
-        ti.init(ti.cpu, debug=0, default_ip=ti.i32, default_fp=ti.f32, kernel_profiler=USE_PROFILER)
+    if args["restart"]:
+        meta = read_checkpoint_meta(args["restart"])
+        args["seed"], args["precision"] = meta["seed"], meta.get("precision", "f32")
+
+    # fast math would drop the Kahan compensations
+    fast_math = args["precision"] != "kahan"
+
+    # the kernel profiler is cpu / cuda only
+    profiler = {"kernel_profiler": True} if args["kernel_profiler"] and args["arch"] in ("cpu", "x64", "gpu", "cuda") else {}
 
-    elif args["arch"] in ("gpu", "cuda"):
-        ti.init(ti.gpu, kernel_profiler=USE_PROFILER)
-    elif args["arch"] in ("opengl",):
-        ti.init(ti.opengl)
-    elif args["arch"] in ("vulkan",):
-        ti.init(ti.vulkan)
+    init_taichi(args["arch"], kernel_cache=args["kernel_cache"], random_seed=args["seed"], fast_math=fast_math, **profiler)
+    startup.mark("taichi init")
 
     # App
     app = App(screen_width=SCREEN_WIDTH, screen_height=SCREEN_HEIGHT, max_fps=args["fps"], camera_pos=CAMERA_POS, 
-              nb_body=args["body"], dt=0.005, eps=0.5)
+              nb_body=args["body"], dt=0.005, eps=0.5, solver=args["solver"], theta=args["theta"], grid=args["grid"], periodic=args["periodic"], integrator=args["integrator"], layout=args["layout"],
+              precision=args["precision"], record=args["record"], record_every=args["record_every"], record_dtype=args["record_dtype"], record_compression=args["record_compression"],
+              checkpoint=args["checkpoint"], checkpoint_every=args["checkpoint_every"], checkpoint_interval=args["checkpoint_interval"], restart=args["restart"], seed=args["seed"],
+              ic=args["ic"], ic_params=parse_ic_params(args["ic_params"]), ic_cache=args["ic_cache"],
+              reorder_every=args["reorder_every"], collision_radius=args["collision_radius"], profile=args["profile"], trace=args["trace"], kernel_profiler=args["kernel_profiler"],
+              startup=startup if args["startup_profile"] else None)
     app.run()
 
 if __name__ == "__main__":
@@ -7,52 +7,25 @@ import random, sys
 
 import taichi as ti
 
-# -----------------------------------------------------------------------------------------------------------
-# dataclass version here: https://github.com/devpack/taichi-tests/blob/main/nbody-dataclass.py
-
-@ti.data_oriented
-class NBodySystem:
-    def __init__(self, nb_body=8):
-
-        self.nb_body = nb_body
-
-        self.pos = ti.Vector.field(3, dtype=ti.f32, shape=self.nb_body)
-        self.vel = ti.Vector.field(3, dtype=ti.f32, shape=self.nb_body)
-        self.acc = ti.Vector.field(3, dtype=ti.f32, shape=self.nb_body)
-
-        self.mass = 1.0
-
-    @ti.kernel
-    def init(self):
-        for i in range(self.nb_body):
-            self.pos[i] = [((ti.random(float) * 2) - 1) * 8.0, ((ti.random(float) * 2) - 1) * 8.0, ((ti.random(float) * 2) - 1) * 8.0]
-            self.vel[i] = [0.0, 0.0, 0.0]
-            self.acc[i] = [0.0, 0.0, 0.0]
-
-    @ti.kernel
-    def update(self, dt: ti.f32, eps: ti.f32):
-
-        for i in range(self.nb_body):
-            self.vel[i] += self.acc[i] * dt * 0.5
-            self.pos[i] += self.vel[i] * dt
+from nbody.system import NBodySystem, SOLVERS, LAYOUTS, PRECISIONS, grown_capacity
+from nbody.integrators import INTEGRATORS
+from nbody.stepper import Stepper
+from nbody.checkpoint import Checkpointer, system_from_checkpoint
+from nbody.diagnostics import Diagnostics
+from nbody.replay import Player, REPLAY_MODES
+from nbody.trajectory import open_writer, print_writer_metrics
+from nbody.lod import LOD
+from nbody.ic import cluster_ic
 
-        
-        # ! only the outer loop is optimized => avoid nested for loops
-        #for i, j in ti.ndrange(self.nb_body, self.nb_body):
-        for i in range(self.nb_body):
-            for j in range(self.nb_body):
-                if i != j:
-                    DR = self.pos[j] - self.pos[i]
-                    DR2 = ti.math.dot(DR, DR)
-                    DR2 += eps * eps
+UPLOADS = ("write", "orphan", "ring")
+RING_SIZE = 3
 
-                    PHI = self.mass / (ti.sqrt(DR2) * DR2)
-
-                    self.acc[i] += DR * PHI
-
-        for i in range(self.nb_body):
-            self.vel[i] += self.acc[i] * dt * 0.5
-            self.acc[i] = [0.0, 0.0, 0.0]            
+# VBO position formats: (moderngl format, numpy dtype)
+#   "f32" : 12 bytes / body
+#   "f16" : 6 bytes / body, half floats
+#   "i16" : 6 bytes / body, int16 steps of u_pos_scale around u_pos_offset (the bounding box of the frame)
+VBO_FORMATS = {"f32": ('3f', 'f4'), "f16": ('3f2', 'f2'), "i16": ('3i2', 'i2')}
+I16_MAX = 32767
 
 # -----------------------------------------------------------------------------------------------------------
 
@@ -71,34 +44,490 @@ class Simulation:
         self.nbody_program['m_view'].write(self.app.camera.m_view)
         #self.nbody_program['cam_pos'].write(self.app.camera.position)
 
-        self.nbody_system = NBodySystem(nb_body=self.app.nb_body)
-        self.nbody_system.init()
+        if self.app.restart:
+            # the checkpoint settings win over the command line
+            self.nbody_system, meta = system_from_checkpoint(self.app.restart)
+            self.app.dt, self.app.eps = meta["dt"], meta["eps"]
+        else:
+            self.nbody_system = NBodySystem(nb_body=self.app.nb_body, solver=self.app.solver, theta=self.app.theta, integrator=self.app.integrator,
+                                            layout=self.app.layout, precision=self.app.precision, grid=self.app.grid, periodic=self.app.periodic,
+                                            capacity=self.app.capacity)
+            self.nbody_system.init(ic=self.app.ic, seed=self.app.seed, params=self.app.ic_params, cache_dir=self.app.ic_cache)
+
+        self.nbody_system.set_reorder(self.app.reorder_every)
+        self.nbody_system.set_collisions(self.app.collision_radius)
+        self.app.mark_startup("initial conditions")
+
+        self.step_times = collections.deque(maxlen=60)
+
+        # trajectory recording, the frames are written by a background thread
+        self.writer = None
+
+        if self.app.record:
+            self.writer = open_writer(self.nbody_system, self.app.record, self.app.dt, self.app.eps, every=self.app.record_every,
+                                      dtype=self.app.record_dtype, compression=self.app.record_compression)
+
+        self.checkpointer = None
+
+        if self.app.checkpoint:
+            self.checkpointer = Checkpointer(self.app.checkpoint, every=self.app.checkpoint_every, interval=self.app.checkpoint_interval, seed=self.app.seed)
 
-        vertex_data = np.asarray(self.nbody_system.pos.to_numpy(), dtype='f4') #vertex_data = np.array(bodies, dtype='f4')
+        # energy / momentum samples every diag_every steps, plotted in the options
+        self.diagnostics = None
+
+        if self.app.diag_every:
+            self.diagnostics = Diagnostics(self.nbody_system, every=self.app.diag_every)
+            self.diagnostics.sample(self.app.eps)
+
+        # bodies added by spawn while threaded that did not fit, the growth is left to the main thread
+        self.deferred = collections.deque()
+        self.rng = np.random.default_rng(self.app.seed)
+
+        self.attach()
+        self.app.mark_startup("compile")
+
+    def attach(self):
+        # everything sized for the slots of nbody_system, again after it grows (see grow)
+
+        # host staging buffer owned for the whole run: the export kernel writes into it (in place on cpu),
+        # the VBO is filled from it => no per frame allocation
+        self.host_pos = np.empty((self.nbody_system.nb_body, 3), dtype='f4')
+        self.nbody_system.export_pos(self.host_pos)
+
+        self.create_lod(self.nbody_system.nb_body, self.nbody_system.mass.to_numpy())
+        self.create_staging(self.nbody_system.nb_body)
 
         # VBO / VAO
-        self.vbo = self.ctx.buffer(data = vertex_data)
-        self.vao = self.ctx.vertex_array(self.nbody_program, [(self.vbo, '3f', 'in_position')])
+        #   "write"  : a single VBO, overwritten
+        #   "orphan" : a single VBO, orphaned before the write so the driver can hand out fresh storage
+        #   "ring"   : RING_SIZE VBOs used in turn, the one being written is not the one the last draw used
+        self.create_buffers(*self.prepare(self.host_pos[:self.nbody_system.n_active]))
+
+        # every kernel of the steps and of the VBO packing compiled now rather than on the first frame (and
+        # before the stepper thread starts)
+        self.nbody_system.warmup(self.app.dt, self.app.eps)
+        if not self.app.threaded and not self.lod:
+            self.pack_system()
+
+        # threaded: the physics runs in a Stepper thread, the frame only uploads its latest snapshot
+        self.stepper = None
+        self.uploaded_version = 0
+
+        if self.app.threaded:
+            # the worker publishes [positions, nb_active], with the LOD [positions, weights, nb_vertex] built at
+            # the camera of the last frame
+            nb_body = self.nbody_system.nb_body
+            export, new_buffer = self.export_active, lambda: [np.empty((nb_body, 3), dtype='f4'), 0]
+            if self.lod:
+                self.lod_cam = self.camera_pos()
+                export, new_buffer = self.export_lod, lambda: list(self.lod.new_output()) + [0]
+
+            self.stepper = Stepper(self.nbody_system, dt=self.app.dt, eps=self.app.eps, on_step=self.after_step, timer=self.app.timer,
+                                   export=export, new_buffer=new_buffer)
+            self.stepper.start()
+
+    def spawn(self, pos, vel, mass):
+        # adds bodies (nbody.ic.cluster_ic...): in place while they fit the slots, no recompile. Otherwise
+        # the system grows on the next frame, see grow_deferred
+        self.submit(lambda system: self.add_or_defer(system, pos, vel, mass))
+
+    def add_or_defer(self, system, pos, vel, mass):
+        if system.n_active + len(mass) <= system.nb_body:
+            system.add_bodies(pos, vel, mass)
+        else:
+            self.deferred.append((pos, vel, mass))
+
+    def spawn_cluster(self, nb_body):
+        # a Plummer cluster at a random place of the initial cube, at rest
+        scale = self.nbody_system.scale
+        self.spawn(*cluster_ic(nb_body, self.rng, scale=scale, center=self.rng.uniform(-0.8, 0.8, 3) * scale))
+
+    def remove_random(self, nb_body):
+        # swap-removes nb_body random active bodies
+        def remove(system):
+            n = min(nb_body, system.n_active - 1)
+            if n > 0:
+                system.remove_bodies(self.rng.choice(system.n_active, n, replace=False).tolist())
+
+        self.submit(remove)
+
+    def grow_deferred(self):
+        # main thread: the bodies that did not fit -> a bigger system (NBodySystem.resized, one recompile),
+        # then new buffers / stepper for its slots
+        if not self.deferred:
+            return
+
+        if self.writer:
+            # the recorded frames have a fixed size
+            print("spawn: no room for %d bodies while recording (see --capacity)" % sum(len(mass) for _, _, mass in self.deferred))
+            self.deferred.clear()
+            return
+
+        requests = []
+        if self.stepper:
+            self.stepper.stop()
+            requests = self.stepper.take_requests()
+
+        system = self.nbody_system
+        needed = system.n_active + sum(len(mass) for _, _, mass in self.deferred)
+        system = system.resized(grown_capacity(needed, system.nb_body))
+        print("bodies: %d slots -> %d" % (self.nbody_system.nb_body, system.nb_body))
+
+        while self.deferred:
+            system.add_bodies(*self.deferred.popleft())
+
+        if self.app.profile:
+            system.instrument(self.app.timer)
+
+        if self.diagnostics:
+            self.diagnostics = Diagnostics(system, every=self.app.diag_every)
+            self.diagnostics.sample(self.app.eps)
+
+        self.release_buffers()
+        self.nbody_system = system
+        self.attach()
+
+        # queued after the deferred ones: run them in order, in the new worker
+        for fn in requests:
+            self.submit(fn)
+
+    def submit(self, fn):
+        # fn(system) between two steps of the worker when threaded, now otherwise
+        if self.stepper:
+            self.stepper.submit(fn)
+        else:
+            fn(self.nbody_system)
+
+    def create_buffers(self, vbo_pos, weight):
+        self.upload = self.app.upload
+        nb_vbo = RING_SIZE if self.upload == "ring" else 1
+
+        fmt, _ = VBO_FORMATS[self.vbo_format]
+
+        # sized for the largest upload (the LOD budget), the first nb_vertex are drawn
+        self.vbos = [self.ctx.buffer(reserve=self.vbo_pos.nbytes) for _ in range(nb_vbo)]
+
+        # point weights (bodies per vertex): per VBO with the LOD, otherwise a single buffer of ones
+        if self.lod:
+            self.weight_vbos = [self.ctx.buffer(reserve=self.lod.weight.nbytes) for _ in range(nb_vbo)]
+        else:
+            self.weight_vbos = [self.ctx.buffer(data=np.ones(len(self.vbo_pos), dtype='f4'))] * nb_vbo
+
+        self.vaos = [self.ctx.vertex_array(self.nbody_program, [(vbo, fmt, 'in_position'), (weight_vbo, 'f', 'in_weight')])
+                     for vbo, weight_vbo in zip(self.vbos, self.weight_vbos)]
+        self.current = 0
+
+        self.upload_times = collections.deque(maxlen=60)
+
+        for _ in range(nb_vbo):
+            self.upload_pos(vbo_pos, weight)
+
+    def create_lod(self, nb_body, mass):
+        # above lod_budget bodies the VBO gets the LOD vertices: near bodies + impostors of the far cells
+        self.lod = None
+
+        if self.app.lod_budget and nb_body > self.app.lod_budget:
+            self.lod = LOD(self.app.lod_budget, grid=self.app.lod_grid)
+            self.lod_mass = mass
+            self.lod_mass_key = (0, 0, nb_body)
+            self.lod_input = np.empty((nb_body, 3), dtype='f4')
+
+    def create_staging(self, nb_body):
+        self.vbo_format = self.app.vbo_format
+        _, dtype = VBO_FORMATS[self.vbo_format]
+
+        nb_vertex = self.lod.budget if self.lod else nb_body
+
+        # packed positions, what is uploaded (f32: the host positions themselves)
+        self.vbo_pos = np.empty((nb_vertex, 3), dtype=dtype)
+        self.pack_work = np.empty((nb_vertex, 3), dtype='f4') if self.vbo_format == "i16" else None
+        self.nb_vertex = nb_vertex
+
+        self.set_pos_transform((0.0, 0.0, 0.0), (1.0, 1.0, 1.0))
+
+    def set_pos_transform(self, offset, scale):
+        self.set_uniform('u_pos_offset', tuple(float(x) for x in offset))
+        self.set_uniform('u_pos_scale', tuple(float(x) for x in scale))
+
+    def i16_transform(self, lo, hi):
+        # offset = box center, one int16 step = scale
+        offset = (lo + hi) * 0.5
+        scale = np.maximum((hi - lo) * 0.5, 1e-6) / I16_MAX
+        return offset, scale
+
+    def pack_system(self):
+        # fused export + packing kernels on the system, the merged bodies (after n_active) are not drawn
+        n = self.nbody_system.n_active
+
+        if self.vbo_format == "f32":
+            self.nbody_system.export_pos(self.host_pos)
+            return self.host_pos[:n]
+
+        if self.vbo_format == "f16":
+            self.nbody_system.export_pos_f16(self.vbo_pos)
+        else:
+            offset, scale = self.i16_transform(*self.nbody_system.pos_bounds())
+            self.nbody_system.export_pos_i16(self.vbo_pos, ti.math.vec3(*offset), ti.math.vec3(*(1.0 / scale)))
+            self.set_pos_transform(offset, scale)
+
+        return self.vbo_pos[:n]
+
+    def pack_host(self, host_pos):
+        # same packing on the host, for positions already in a numpy array (threaded snapshots, replay, LOD)
+        n = len(host_pos)
+        vbo_pos = self.vbo_pos[:n]
+
+        if self.vbo_format == "i16":
+            pack_work = self.pack_work[:n]
+            offset, scale = self.i16_transform(host_pos.min(axis=0).astype('f4'), host_pos.max(axis=0).astype('f4'))
+            np.subtract(host_pos, offset, out=pack_work)
+            np.multiply(pack_work, 1.0 / scale, out=pack_work)
+            np.rint(pack_work, out=pack_work)
+            np.copyto(vbo_pos, pack_work, casting='unsafe')
+            self.set_pos_transform(offset, scale)
+            return vbo_pos
+
+        if host_pos.dtype == vbo_pos.dtype:
+            return host_pos
+
+        np.copyto(vbo_pos, host_pos, casting='same_kind')
+        return vbo_pos
+
+    def prepare(self, host_pos):
+        # host positions -> (VBO positions, weights or None)
+        if not self.lod:
+            return self.pack_host(host_pos), None
+
+        with self.app.timer.phase("lod"):
+            if host_pos.dtype != self.lod_input.dtype:
+                lod_input = self.lod_input[:len(host_pos)]
+                np.copyto(lod_input, host_pos, casting='same_kind')
+                host_pos = lod_input
+
+            pos, weight = self.lod.update(host_pos, self.lod_masses(self.nbody_system), self.camera_pos())
+
+        return self.pack_host(pos), weight
+
+    def export_active(self, system, buffer):
+        # in the stepper thread
+        system.export_pos(buffer[0])
+        buffer[1] = system.n_active
+
+    def export_lod(self, system, buffer):
+        # in the stepper thread
+        system.export_pos(self.host_pos)
+
+        with self.app.timer.phase("lod"):
+            pos, _ = self.lod.update(self.host_pos[:system.n_active], self.lod_masses(system), self.lod_cam, out=buffer[:2])
+        buffer[2] = len(pos)
+
+    def lod_masses(self, system):
+        # the masses follow the bodies when the system reorders, merges, adds or removes them
+        if system is not None and (system.reorder_count, system.edit_count, system.n_active) != self.lod_mass_key:
+            self.lod_mass = system.mass.to_numpy()
+            self.lod_mass_key = (system.reorder_count, system.edit_count, system.n_active)
+
+        return self.lod_mass
+
+    def camera_pos(self):
+        return np.array(self.app.camera.position, dtype='f4')
+
+    def get_upload_bytes(self):
+        weight_bytes = self.lod.weight.itemsize if self.lod else 0
+        return self.nb_vertex * (self.vbo_pos.itemsize * 3 + weight_bytes)
 
     def update(self):
         self.nbody_program['m_model'].write(self.m_model)
         self.nbody_program['m_view'].write(self.app.camera.m_view)
         #self.nbody_program['cam_pos'].write(self.app.camera.position)
 
-        self.nbody_system.update(self.app.dt, self.app.eps)
+        timer = self.app.timer
+
+        self.grow_deferred()
+
+        if self.stepper:
+            self.stepper.dt = self.app.dt
+            self.stepper.eps = self.app.eps
+
+            host_pos, version = self.stepper.acquire()
+
+            if self.lod:
+                self.lod_cam = self.camera_pos()
+
+            if version != self.uploaded_version:
+                t0 = time.perf_counter()
+                with timer.phase("transfer"):
+                    if self.lod:
+                        pos, weight, nb_vertex = host_pos
+                        vbo_pos, weight = self.pack_host(pos[:nb_vertex]), weight[:nb_vertex]
+                    else:
+                        pos, nb_active = host_pos
+                        vbo_pos, weight = self.prepare(pos[:nb_active])
+                with timer.phase("upload"):
+                    self.upload_pos(vbo_pos, weight)
+                self.upload_times.append(time.perf_counter() - t0)
 
-        vertex_data = np.asarray(self.nbody_system.pos.to_numpy(), dtype='f4')
-        self.vbo.write(vertex_data)
+                self.uploaded_version = version
+        else:
+            # as many steps as the frame pacing leaves room for (nbody.timing.FramePacer)
+            for _ in range(self.app.pacer.substeps):
+                t0 = time.perf_counter()
+                with timer.phase("step", sync=True):
+                    self.nbody_system.update(self.app.dt, self.app.eps)
+                self.step_times.append(time.perf_counter() - t0)
+                self.app.pacer.add_step(self.step_times[-1])
+
+                self.after_step(self.nbody_system)
+
+            t0 = time.perf_counter()
+            with timer.phase("transfer"):
+                if self.lod:
+                    self.nbody_system.export_pos(self.host_pos)
+                    vbo_pos, weight = self.prepare(self.host_pos[:self.nbody_system.n_active])
+                else:
+                    vbo_pos, weight = self.pack_system(), None
+            with timer.phase("upload"):
+                self.upload_pos(vbo_pos, weight)
+            self.upload_times.append(time.perf_counter() - t0)
+
+    # recording / checkpointing / diagnostics, in the stepper thread when threaded
+    def after_step(self, system):
+        timer = self.app.timer
+
+        if self.writer:
+            with timer.phase("record"):
+                self.writer.write(system)
+
+        if self.diagnostics:
+            with timer.phase("diagnostics", sync=True):
+                self.diagnostics.update(system, self.app.eps)
+
+        if self.checkpointer:
+            with timer.phase("checkpoint"):
+                self.checkpointer.update(system, self.app.dt, self.app.eps)
+
+    def upload_pos(self, host_pos, weight=None):
+        self.current = (self.current + 1) % len(self.vbos)
+        vbo = self.vbos[self.current]
+
+        if self.upload == "orphan":
+            vbo.orphan()
+
+        vbo.write(host_pos)
+        self.nb_vertex = len(host_pos)
+
+        if weight is not None:
+            weight_vbo = self.weight_vbos[self.current]
+            if self.upload == "orphan":
+                weight_vbo.orphan()
+            weight_vbo.write(weight)
+
+    def get_steps_per_sec(self):
+        if self.stepper:
+            return self.stepper.get_steps_per_sec()
+
+        total_time = sum(self.step_times)
+        if total_time == 0:
+            return 0
+        else:
+            return len(self.step_times) / total_time
+
+    def get_upload_time(self):
+        if not self.upload_times:
+            return 0.0
+        return sum(self.upload_times) / len(self.upload_times)
 
     def render(self):
-        self.vao.render(MODE) # mgl.POINTS)
+        self.vaos[self.current].render(MODE, vertices=self.nb_vertex) # mgl.POINTS)
 
     def destroy(self):
-        self.vbo.release()
-        self.vao.release()
+        if self.stepper:
+            self.stepper.stop()
+
+        if self.writer:
+            self.writer.close()
+            print_writer_metrics(self.writer)
+
+        # the window is closed: last checkpoint
+        if self.checkpointer:
+            self.checkpointer.save(self.nbody_system, self.app.dt, self.app.eps)
+
+        self.release_buffers()
+
+    def release_buffers(self):
+        for vbo in set(self.vbos + self.weight_vbos):
+            vbo.release()
+        for vao in self.vaos:
+            vao.release()
 
     def set_uniform(self, u_name, u_value):
         try:
             self.nbody_program[u_name] = u_value
         except KeyError:
-            pass
\ No newline at end of file
+            pass
+
+# -----------------------------------------------------------------------------------------------------------
+# replay of a recorded trajectory: no NBodySystem, the frames go from the (memory-mapped) file to the VBO
+
+class Replay(Simulation):
+
+    def __init__(self, app, nbody_program):
+        self.app = app
+        self.ctx = app.ctx
+
+        self.nbody_program = nbody_program
+
+        self.m_model = glm.mat4()
+
+        self.nbody_program['m_model'].write(self.m_model)
+        self.nbody_program['m_proj'].write(self.app.camera.m_proj)
+        self.nbody_program['m_view'].write(self.app.camera.m_view)
+
+        self.player = Player(self.app.replay, speed=self.app.replay_speed, mode=self.app.replay_mode)
+
+        self.nbody_system = None
+        self.writer = None
+        self.diagnostics = None
+        self.stepper = None
+
+        # float16 recordings are uploaded as is with the f16 VBO format
+        self.create_lod(self.player.nb_body, np.ones(self.player.nb_body, dtype='f4'))
+        self.create_staging(self.player.nb_body)
+        self.shown_pos = self.player.positions()
+        self.create_buffers(*self.prepare(self.shown_pos))
+
+        self.last_time = time.perf_counter()
+
+    def update(self):
+        self.nbody_program['m_model'].write(self.m_model)
+        self.nbody_program['m_view'].write(self.app.camera.m_view)
+
+        t = time.perf_counter()
+        self.player.advance(t - self.last_time)
+        self.last_time = t
+
+        with self.app.timer.phase("transfer"):
+            host_pos = self.player.positions()
+
+            # the LOD follows the camera: rebuilt every frame from the positions shown
+            if host_pos is None and self.lod:
+                host_pos = self.shown_pos
+            self.shown_pos = host_pos
+
+            if host_pos is not None:
+                vbo_pos, weight = self.prepare(host_pos)
+
+        if host_pos is not None:
+            t0 = time.perf_counter()
+            with self.app.timer.phase("upload"):
+                self.upload_pos(vbo_pos, weight)
+            self.upload_times.append(time.perf_counter() - t0)
+
+    def get_steps_per_sec(self):
+        # simulation steps shown per second of replay
+        if self.player.paused:
+            return 0
+        return abs(self.player.speed) * self.player.header["every"]
+
+    def destroy(self):
+        self.release_buffers()
@@ -0,0 +1,19 @@
+import importlib
+
+# the public names are imported on first use: the submodules without kernels (cli, timing, trajectory...)
+# do not pay the taichi import, nor `python -m nbody --help` / `compare` (see cli.main)
+EXPORTS = {
+    "FORCES": "nbody.forces",
+    "register_force": "nbody.forces",
+    "INTEGRATORS": "nbody.integrators",
+    "register_integrator": "nbody.integrators",
+    "NBodySystem": "nbody.system",
+    "SOLVERS": "nbody.system",
+}
+
+__all__ = list(EXPORTS)
+
+def __getattr__(name):
+    if name not in EXPORTS:
+        raise AttributeError("module 'nbody' has no attribute %s" % name)
+    return getattr(importlib.import_module(EXPORTS[name]), name)
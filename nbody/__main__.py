@@ -0,0 +1,3 @@
+from nbody.cli import main
+
+main()
@@ -0,0 +1,49 @@
+import os
+
+import taichi as ti
+
+# -----------------------------------------------------------------------------------------------------------
+
+ARCHS = ("cpu", "x64", "gpu", "cuda", "opengl", "vulkan")
+
+# offline kernel cache: the compiled kernels are kept on disk between runs (least recently used files
+# dropped above the size), the next run with the same settings loads them instead of compiling
+KERNEL_CACHE_SIZE = 512 * 1024 * 1024
+
+def default_kernel_cache():
+    return os.path.join(os.path.expanduser("~"), ".cache", "nbody", "kernels")
+
+def kernel_cache_options(kernel_cache):
+    # None: the Taichi default, "": no cache, otherwise the cache directory
+    if kernel_cache is None:
+        return {}
+    if not kernel_cache:
+        return {"offline_cache": False}
+    return {"offline_cache": True, "offline_cache_file_path": kernel_cache, "offline_cache_max_size_of_files": KERNEL_CACHE_SIZE,
+            "offline_cache_cleaning_policy": "lru"}
+
+def init_taichi(arch="cpu", kernel_cache=None, **kwargs):
+    kwargs.update(kernel_cache_options(kernel_cache))
+
+    if arch in ("cpu", "x64"):
+        ti.init(ti.cpu, debug=0, default_ip=ti.i32, default_fp=ti.f32, **kwargs)
+
+    elif arch in ("gpu", "cuda"):
+        ti.init(ti.gpu, **kwargs)
+    elif arch in ("opengl",):
+        ti.init(ti.opengl, **kwargs)
+    elif arch in ("vulkan",):
+        ti.init(ti.vulkan, **kwargs)
+
+    else:
+        raise ValueError("Unknown arch %s, expected one of %s" % (arch, ARCHS))
+
+# f64 fields / atomics: the LLVM backends only, the diagnostics reductions fall back to f32 elsewhere
+def has_f64():
+    from taichi.lang import impl
+    return impl.current_cfg().arch in (ti.x64, ti.arm64, ti.cuda)
+
+# fast math lets the compiler reassociate (t - a) - b into 0 and silently drops Kahan compensations
+def has_fast_math():
+    from taichi.lang import impl
+    return impl.current_cfg().fast_math
@@ -0,0 +1,266 @@
+import taichi as ti
+
+from nbody.reorder import RadixSort, spread_bits
+
+# -----------------------------------------------------------------------------------------------------------
+# Barnes-Hut octree, rebuilt every step from the body positions.
+#
+# the build is parallel, over the bodies or over the nodes of a depth:
+#   - keys      : Morton key of every body in the root cube (KEY_BITS levels, 3 bits each in the octant
+#                 order), the bodies sorted by key with the radix sort of nbody.reorder
+#   - split     : a node is a range of the sorted bodies, top-down, one launch per depth. A node is split at
+#                 the first level where its bodies are not all in the same octant into 2..8 children (the
+#                 levels in between are skipped: < 2N nodes), a single body or equal keys make a leaf
+#   - monopoles : bottom-up, one launch per depth
+#
+# the nodes of a depth are contiguous (depth_start), children always get a bigger index than their parent:
+#   - internal node: node_body = EMPTY, children node_first -> node_next -> ... in octant order
+#   - leaf node    : node_body = head of a body linked list (body_next), a single body except for equal keys
+#
+# the tree is "threaded" by the split (node_first / node_next) so the force walk is stackless:
+# open a node => go to node_first, accept a node (or a leaf) => go to node_next.
+# The indices of the nodes of a depth depend on the thread timing, the sums do not (children in octant
+# order, leaf bodies in key order)
+
+EMPTY = -1
+
+# levels of the keys (21 bits per axis, 63-bit keys): bodies closer than root_size / 2^21 share a leaf
+KEY_BITS = 21
+
+# the root at depth 0, every split goes at least one level down
+MAX_DEPTH = KEY_BITS + 1
+
+@ti.data_oriented
+class BarnesHut:
+    def __init__(self, system):
+
+        self.system = system
+        self.nb_body = system.nb_body
+
+        # every internal node has 2+ children: < 2N nodes
+        self.max_node = 2 * self.nb_body + 1
+
+        self.node_body   = ti.field(dtype=ti.i32, shape=self.max_node)
+        self.node_first  = ti.field(dtype=ti.i32, shape=self.max_node)
+        self.node_next   = ti.field(dtype=ti.i32, shape=self.max_node)
+
+        # sorted bodies node_begin .. node_end, level of the cell (0 = root)
+        self.node_begin  = ti.field(dtype=ti.i32, shape=self.max_node)
+        self.node_end    = ti.field(dtype=ti.i32, shape=self.max_node)
+        self.node_level  = ti.field(dtype=ti.i32, shape=self.max_node)
+
+        self.node_center = ti.Vector.field(3, dtype=ti.f32, shape=self.max_node)
+        self.node_size   = ti.field(dtype=ti.f32, shape=self.max_node) # half width
+        self.node_mass   = ti.field(dtype=ti.f32, shape=self.max_node)
+        self.node_com    = ti.Vector.field(3, dtype=ti.f32, shape=self.max_node)
+
+        self.node_count  = ti.field(dtype=ti.i32, shape=())
+        self.depth_start = ti.field(dtype=ti.i32, shape=MAX_DEPTH + 2)
+        self.body_next   = ti.field(dtype=ti.i32, shape=self.nb_body)
+
+        self.bbox_min    = ti.Vector.field(3, dtype=ti.f32, shape=())
+        self.bbox_max    = ti.Vector.field(3, dtype=ti.f32, shape=())
+
+        self.sorter = RadixSort(self.nb_body)
+
+    @ti.func
+    def offset(self, octant, h):
+        return ti.Vector([h if octant & 1 else -h, h if octant & 2 else -h, h if octant & 4 else -h])
+
+    # octant of a key at a level (0 = the children of the root)
+    @ti.func
+    def key_digit(self, key, level):
+        return ti.cast((key >> ti.cast(3 * (KEY_BITS - 1 - level), ti.u64)) & ti.u64(7), ti.i32)
+
+    @ti.kernel
+    def keys(self, pos: ti.template()):
+        n_active = self.system.nb_active[None]
+
+        # bounding cube of the active bodies
+        self.bbox_min[None] = [ti.math.inf, ti.math.inf, ti.math.inf]
+        self.bbox_max[None] = [-ti.math.inf, -ti.math.inf, -ti.math.inf]
+
+        for i in range(n_active):
+            ti.atomic_min(self.bbox_min[None], pos[i])
+            ti.atomic_max(self.bbox_max[None], pos[i])
+
+        # root: every body, depth 0
+        center = (self.bbox_min[None] + self.bbox_max[None]) * 0.5
+        size = (self.bbox_max[None] - self.bbox_min[None]).max() * 0.5 * 1.0001 + 1e-6
+
+        self.node_count[None] = 1
+        self.node_center[0] = center
+        self.node_size[0] = size
+        self.node_begin[0] = 0
+        self.node_end[0] = n_active
+        self.node_level[0] = 0
+        self.node_next[0] = EMPTY
+        self.depth_start[0] = 0
+        self.depth_start[1] = 1
+
+        lo = center - size
+        scale = (1 << KEY_BITS) / (2.0 * size)
+
+        for i in range(n_active):
+            q = ti.cast(ti.math.clamp((pos[i] - lo) * scale, 0.0, (1 << KEY_BITS) - 1), ti.u64)
+            self.sorter.keys[0, i] = spread_bits(q.x) | (spread_bits(q.y) << 1) | (spread_bits(q.z) << 2)
+            self.sorter.slots[0, i] = i
+
+    @ti.kernel
+    def split(self, depth: ti.i32):
+        for n in range(self.depth_start[depth], self.depth_start[depth + 1]):
+            a, b = self.node_begin[n], self.node_end[n]
+
+            # first level where the bodies are not all in the same octant, KEY_BITS: equal keys
+            level = KEY_BITS
+            if b - a > 1:
+                diff = self.sorter.keys[0, a] ^ self.sorter.keys[0, b - 1]
+                level = self.node_level[n]
+                while level < KEY_BITS:
+                    if self.key_digit(diff, level) != 0:
+                        break
+                    level += 1
+
+            if level == KEY_BITS:
+                # leaf, its bodies chained in key order (none for an empty root)
+                self.node_body[n] = self.sorter.slots[0, a] if b > a else EMPTY
+                self.node_first[n] = EMPTY
+
+                for k in range(a, b):
+                    nxt = EMPTY
+                    if k + 1 < b:
+                        nxt = self.sorter.slots[0, k + 1]
+                    self.body_next[self.sorter.slots[0, k]] = nxt
+
+            else:
+                # the cell shrinks down to the split level (the octants shared by all its bodies)
+                key = self.sorter.keys[0, a]
+                c = self.node_center[n]
+                h = self.node_size[n]
+                for l in range(self.node_level[n], level):
+                    h *= 0.5
+                    c += self.offset(self.key_digit(key, l), h)
+
+                self.node_center[n] = c
+                self.node_size[n] = h
+                self.node_level[n] = level
+                self.node_body[n] = EMPTY
+
+                # the octant is sorted in a .. b: ends[o] = first body of an octant > o
+                ends = ti.Vector([b] * 8)
+                nb_child = 0
+                begin = a
+                for o in ti.static(range(8)):
+                    if ti.static(o < 7):
+                        lo, hi = begin, b
+                        while lo < hi:
+                            mid = (lo + hi) // 2
+                            if self.key_digit(self.sorter.keys[0, mid], level) <= o:
+                                lo = mid + 1
+                            else:
+                                hi = mid
+                        ends[o] = lo
+                    if ends[o] > begin:
+                        nb_child += 1
+                    begin = ends[o]
+
+                # children, threaded in octant order, the last one continues with the node_next of the node
+                child = ti.atomic_add(self.node_count[None], nb_child)
+                self.node_first[n] = child
+
+                begin = a
+                for o in ti.static(range(8)):
+                    if ends[o] > begin:
+                        self.node_begin[child] = begin
+                        self.node_end[child] = ends[o]
+                        self.node_level[child] = level + 1
+                        self.node_center[child] = c + self.offset(o, h * 0.5)
+                        self.node_size[child] = h * 0.5
+                        self.node_next[child] = child + 1
+                        child += 1
+                    begin = ends[o]
+
+                self.node_next[child - 1] = self.node_next[n]
+
+        self.depth_start[depth + 2] = self.node_count[None]
+
+    @ti.kernel
+    def monopoles(self, depth: ti.i32, pos: ti.template(), mass: ti.template()):
+        for n in range(self.depth_start[depth], self.depth_start[depth + 1]):
+            m = 0.0
+            c = ti.Vector([0.0, 0.0, 0.0])
+
+            if self.node_body[n] != EMPTY:
+                for k in range(self.node_begin[n], self.node_end[n]):
+                    j = self.sorter.slots[0, k]
+                    m += mass[j]
+                    c += pos[j] * mass[j]
+            else:
+                ch = self.node_first[n]
+                while ch != self.node_next[n]:
+                    m += self.node_mass[ch]
+                    c += self.node_com[ch] * self.node_mass[ch]
+                    ch = self.node_next[ch]
+
+            self.node_mass[n] = m
+            self.node_com[n] = c / m
+
+    def build(self, pos, mass):
+        self.keys(pos)
+        self.sorter.sort(self.system.n_active)
+
+        for depth in range(MAX_DEPTH):
+            self.split(depth)
+
+        for depth in reversed(range(MAX_DEPTH)):
+            self.monopoles(depth, pos, mass)
+
+    @ti.kernel
+    def walk(self, pos: ti.template(), acc: ti.template(), pot: ti.template(), mass: ti.template(), theta: ti.f32, eps: ti.f32,
+             with_pot: ti.template()):
+
+        theta2 = theta * theta
+
+        for i in range(self.system.target_begin, self.system.target_stop()):
+            p = pos[i]
+            a = ti.Vector([0.0, 0.0, 0.0])
+            phi = 0.0
+
+            n = 0
+            while n != EMPTY:
+
+                if self.node_body[n] != EMPTY:
+                    j = self.node_body[n]
+                    while j != EMPTY:
+                        if j != i:
+                            DR = pos[j] - p
+                            DR2 = ti.math.dot(DR, DR) + eps * eps
+                            a += DR * (mass[j] / (ti.sqrt(DR2) * DR2))
+                            if ti.static(with_pot):
+                                phi -= mass[j] / ti.sqrt(DR2)
+                        j = self.body_next[j]
+
+                    n = self.node_next[n]
+
+                else:
+                    DR = self.node_com[n] - p
+                    D2 = ti.math.dot(DR, DR)
+                    s = self.node_size[n] * 2.0
+
+                    # opening criterion: s / d < theta
+                    if s * s < theta2 * D2:
+                        DR2 = D2 + eps * eps
+                        a += DR * (self.node_mass[n] / (ti.sqrt(DR2) * DR2))
+                        if ti.static(with_pot):
+                            phi -= self.node_mass[n] / ti.sqrt(DR2)
+                        n = self.node_next[n]
+                    else:
+                        n = self.node_first[n]
+
+            acc[i] = a
+            if ti.static(with_pot):
+                pot[i] = phi
+
+    def compute(self, eps, with_pot=False):
+        self.build(self.system.pos, self.system.mass)
+        self.walk(self.system.pos, self.system.acc, self.system.pot, self.system.mass, self.system.theta, eps, with_pot)
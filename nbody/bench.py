@@ -0,0 +1,234 @@
+import csv, json, os, platform, statistics, subprocess, time
+
+import numpy as np
+
+# -----------------------------------------------------------------------------------------------------------
+# benchmark sweep: bodies x arch x solver x layout x reorder (one integrator)
+#
+# every configuration is warmed up (JIT) then timed twice:
+#   - "step"      : NBodySystem.update alone (ti.sync() so async backends are measured too)
+#   - "step_host" : update + pos.to_numpy(), what a viewer pays per frame
+#
+# every configuration runs in a fresh Taichi runtime (ti.reset), the fields and kernels of the previous ones
+# are released. pairs/s (N (N - 1) pair interactions per force evaluation) is only reported for the O(N^2)
+# solvers, bh / pm do not compute the pairs.
+#
+# reorder_every > 0 sorts the bodies in Morton order once before the timings, then every reorder_every steps.
+# "locality" is the memory order quality seen by the caches: mean distance between bodies in consecutive
+# slots / mean distance between random bodies (~1 in random order, -> 0 in Morton order). Hardware cache
+# misses need a profiler, e.g. perf stat -e cache-misses python3 -m nbody bench ...
+
+BODIES = (256, 1024, 4096, 16384, 65536)
+
+# solvers computing every pair
+PAIRWISE = ("direct", "tiled")
+
+# taichi is imported by the functions that run kernels: the results files (load / compare) do not need it
+
+# results files written before the integrator / layout / reorder choices existed are kdk / soa / 0
+def result_key(r):
+    return (r["arch"], r["solver"], r.get("integrator", "kdk"), r.get("layout", "soa"), r.get("reorder_every", 0), r["nb_body"])
+
+def machine_info():
+    import taichi as ti
+
+    info = {
+        "host": platform.node(),
+        "system": platform.system(),
+        "release": platform.release(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "taichi": ".".join(str(v) for v in ti.__version__),
+        "numpy": np.__version__,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+    try:
+        info["commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                        cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        info["commit"] = ""
+
+    return info
+
+def time_steps(system, repeat, dt, eps, transfer=False):
+    import taichi as ti
+
+    times = []
+
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+
+        system.update(dt, eps)
+        if transfer:
+            system.pos.to_numpy()
+
+        ti.sync()
+        times.append(time.perf_counter() - t0)
+
+    return times
+
+def summary(prefix, times, nb_body, force_evals, pairwise=True):
+    median = statistics.median(times)
+
+    result = {
+        prefix + "_median": median,
+        prefix + "_min": min(times),
+        prefix + "_mean": statistics.fmean(times),
+        prefix + "_stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        prefix + "_steps_per_sec": 1.0 / median,
+    }
+
+    if pairwise:
+        result[prefix + "_pairs_per_sec"] = nb_body * (nb_body - 1) * force_evals / median
+
+    return result
+
+def locality(system, nb_sample=65536, seed=0):
+    pos = system.pos.to_numpy().astype(np.float64)
+    rng = np.random.default_rng(seed)
+
+    i = rng.integers(0, len(pos) - 1, min(nb_sample, len(pos) - 1))
+    j = rng.integers(0, len(pos), len(i))
+
+    consecutive = np.linalg.norm(pos[i + 1] - pos[i], axis=1).mean()
+    random = np.linalg.norm(pos[j] - pos[i], axis=1).mean()
+
+    return consecutive / random if random > 0 else 1.0
+
+def bench_one(arch, solver, nb_body, layout="soa", repeat=5, warmup=2, max_seconds=10.0, dt=0.005, eps=0.5, theta=0.5, integrator="kdk",
+              reorder_every=0):
+    import taichi as ti
+
+    from nbody.system import NBodySystem
+
+    result = {"arch": arch, "solver": solver, "integrator": integrator, "layout": layout, "reorder_every": reorder_every, "nb_body": nb_body,
+              "repeat": repeat}
+
+    system = NBodySystem(nb_body=nb_body, solver=solver, theta=theta, integrator=integrator, layout=layout)
+    force_evals = system.integrator.force_evals
+    system.init()
+
+    if reorder_every:
+        system.set_reorder(reorder_every)
+        t0 = time.perf_counter()
+        system.reorder()
+        ti.sync()
+        result["reorder_first"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    system.update(dt, eps)
+    ti.sync()
+    result["compile"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    time_steps(system, warmup, dt, eps)
+    step = (time.perf_counter() - t0) / max(warmup, 1)
+
+    # too slow (typically direct solvers at large N): keep the row, flagged, without timings
+    if step * repeat * 2 > max_seconds:
+        result["skipped"] = True
+        return result
+
+    result["skipped"] = False
+    pairwise = solver in PAIRWISE
+    result.update(summary("step", time_steps(system, repeat, dt, eps), nb_body, force_evals, pairwise))
+    result.update(summary("step_host", time_steps(system, repeat, dt, eps, transfer=True), nb_body, force_evals, pairwise))
+    result["locality"] = locality(system)
+
+    return result
+
+def run_bench(archs, solvers, bodies, layouts=("soa",), repeat=5, warmup=2, max_seconds=10.0, theta=0.5, integrator="kdk", reorders=(0,),
+              verbose=True):
+    import taichi as ti
+
+    from nbody.backend import init_taichi
+
+    results = []
+
+    for arch in archs:
+        for solver in solvers:
+            for layout in layouts:
+                for reorder_every in reorders:
+                    for nb_body in bodies:
+                        ti.reset()
+                        init_taichi(arch)
+
+                        r = bench_one(arch, solver, nb_body, layout=layout, repeat=repeat, warmup=warmup, max_seconds=max_seconds,
+                                      theta=theta, integrator=integrator, reorder_every=reorder_every)
+                        results.append(r)
+
+                        if verbose:
+                            if r["skipped"]:
+                                print("%-6s %-6s %-6s reorder %-4d %8d  skipped (> %.0f s)" % (arch, solver, layout, reorder_every, nb_body,
+                                      max_seconds))
+                            else:
+                                pairs = "%.3e pairs/s" % r["step_pairs_per_sec"] if "step_pairs_per_sec" in r else "-"
+                                print("%-6s %-6s %-6s reorder %-4d %8d  %9.2f steps/s  %15s  | + to_numpy %9.2f steps/s  | locality %.4f" % (
+                                      arch, solver, layout, reorder_every, nb_body, r["step_steps_per_sec"], pairs,
+                                      r["step_host_steps_per_sec"], r["locality"]))
+
+    return {"machine": machine_info(), "results": results}
+
+# -----------------------------------------------------------------------------------------------------------
+# JSON or CSV, chosen by extension. In CSV the machine info is repeated on every row (machine_* columns)
+
+def save_results(data, path):
+    if path.endswith(".csv"):
+        rows = [dict(r, **{"machine_" + k: v for k, v in data["machine"].items()}) for r in data["results"]]
+        fieldnames = []
+        for row in rows:
+            fieldnames += [k for k in row if k not in fieldnames]
+
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+
+def load_results(path):
+    if not path.endswith(".csv"):
+        with open(path) as f:
+            return json.load(f)
+
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    machine = {k[len("machine_"):]: v for k, v in rows[0].items() if k.startswith("machine_")} if rows else {}
+    results = []
+
+    for row in rows:
+        r = {}
+        for k, v in row.items():
+            if k.startswith("machine_") or v == "":
+                continue
+            if k in ("arch", "solver", "integrator", "layout"):
+                r[k] = v
+            elif k == "skipped":
+                r[k] = v == "True"
+            else:
+                r[k] = float(v) if "." in v or "e" in v else int(v)
+        results.append(r)
+
+    return {"machine": machine, "results": results}
+
+def compare_results(old, new, threshold=0.05, metric="step_steps_per_sec"):
+    # returns [(key, old, new, ratio, regression)], ratio = new / old throughput
+    old_rows = {result_key(r): r for r in old["results"] if not r.get("skipped")}
+    rows = []
+
+    for r in new["results"]:
+        key = result_key(r)
+        # pairs/s is only there for the O(N^2) solvers
+        if r.get("skipped") or key not in old_rows or metric not in r or metric not in old_rows[key]:
+            continue
+
+        a, b = old_rows[key][metric], r[metric]
+        ratio = b / a
+        rows.append((key, a, b, ratio, ratio < 1.0 - threshold))
+
+    return rows
@@ -0,0 +1,136 @@
+import json, os, time
+
+import numpy as np
+
+# -----------------------------------------------------------------------------------------------------------
+# checkpoint / restart
+#
+# a single uncompressed .npz: the body fields (+ the precision policy ones), the integrator state fields and
+# a "meta" JSON string (step, time, seed, dt, eps, solver settings). It is written next to the target then
+# renamed over it, so a crash while saving never leaves a truncated checkpoint.
+
+BODY_FIELDS = ("pos", "vel", "acc", "mass")
+
+def state_arrays(system):
+    # -> {name: array} the body fields, the slot ids and the integrator state
+    arrays = {name: getattr(system, name).to_numpy() for name in BODY_FIELDS + system.precision_fields}
+    arrays["ids"] = system.ids.to_numpy()
+
+    for name in getattr(system.integrator, "state_fields", ()):
+        arrays["integrator_" + name] = getattr(system.integrator, name).to_numpy()
+
+    return arrays
+
+def load_state_arrays(system, arrays):
+    for name in BODY_FIELDS + system.precision_fields:
+        getattr(system, name).from_numpy(arrays[name])
+
+    # the slot order of a reordered system (older checkpoints: the original order)
+    system.ids.from_numpy(arrays["ids"] if "ids" in arrays else np.arange(system.nb_body, dtype=np.int32))
+
+    for name in getattr(system.integrator, "state_fields", ()):
+        getattr(system.integrator, name).from_numpy(arrays["integrator_" + name])
+
+def save_checkpoint(system, path, dt, eps, seed=0):
+    t0 = time.perf_counter()
+
+    arrays = state_arrays(system)
+    integrator = system.integrator
+
+    meta = {
+        "version": 1,
+        "nb_body": system.nb_body,
+        "step": system.step_count,
+        "nb_active": system.n_active,
+        "time": system.time,
+        "seed": seed,
+        "dt": dt,
+        "eps": eps,
+        "solver": system.solver,
+        "theta": system.theta,
+        "grid": system.grid,
+        "periodic": system.periodic,
+        "integrator": system.integrator_name,
+        "layout": system.layout,
+        "precision": system.precision,
+        "scale": system.scale,
+        "primed": getattr(integrator, "primed", False),
+    }
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp, path)
+
+    return time.perf_counter() - t0
+
+def read_checkpoint_meta(path):
+    with np.load(path) as data:
+        return json.loads(str(data["meta"]))
+
+def restore_checkpoint(system, path):
+    # loads the fields of a checkpoint into an already built system (same nb_body / integrator)
+    with np.load(path) as data:
+        meta = json.loads(str(data["meta"]))
+
+        if meta["nb_body"] != system.nb_body:
+            raise ValueError("Checkpoint %s has %d bodies, the system %d" % (path, meta["nb_body"], system.nb_body))
+
+        load_state_arrays(system, data)
+
+    integrator = system.integrator
+    if hasattr(integrator, "primed"):
+        integrator.primed = meta["primed"]
+
+    system.set_active(meta.get("nb_active", system.nb_body))
+    system.step_count = meta["step"]
+    system.time = meta["time"]
+
+    return meta
+
+def system_from_checkpoint(path):
+    # builds the system the checkpoint was written with, then restores it. Returns (system, meta)
+    from nbody.system import NBodySystem
+
+    meta = read_checkpoint_meta(path)
+
+    system = NBodySystem(nb_body=meta["nb_body"], solver=meta["solver"], theta=meta["theta"], integrator=meta["integrator"],
+                         scale=meta["scale"], layout=meta["layout"], precision=meta.get("precision", "f32"),
+                         grid=meta.get("grid", 128), periodic=meta.get("periodic", False))
+    restore_checkpoint(system, path)
+
+    return system, meta
+
+# -----------------------------------------------------------------------------------------------------------
+
+class Checkpointer:
+    # saves every `every` steps and / or every `interval` seconds of wall clock (0 = disabled)
+
+    def __init__(self, path, every=0, interval=0.0, seed=0, verbose=True):
+        self.path = path
+        self.every = every
+        self.interval = interval
+        self.seed = seed
+        self.verbose = verbose
+
+        self.last_time = time.perf_counter()
+        self.save_times = []
+
+    def save(self, system, dt, eps):
+        elapsed = save_checkpoint(system, self.path, dt, eps, seed=self.seed)
+
+        self.last_time = time.perf_counter()
+        self.save_times.append(elapsed)
+
+        if self.verbose:
+            print("checkpoint %s: step %d  t = %.4f  (%.3f s)" % (self.path, system.step_count, system.time, elapsed))
+
+    def update(self, system, dt, eps):
+        # called after every step
+        if self.every and system.step_count % self.every == 0:
+            self.save(system, dt, eps)
+        elif self.interval and time.perf_counter() - self.last_time >= self.interval:
+            self.save(system, dt, eps)
@@ -0,0 +1,439 @@
+import argparse, math, sys, time
+
+# headless entry point: no pygame / moderngl / imgui import here, only taichi (+ numpy)
+#
+# python3 -m nbody run --arch=cpu --body=4096 --steps=100 --solver=tiled
+# python3 -m nbody run --arch=cpu --body=65536 --time=0.5 --solver=bh --theta=0.5
+# python3 -m nbody run --arch=cpu --body=4096 --steps=1000 --solver=tiled --diag_every=50
+# python3 -m nbody run --arch=cpu --body=262144 --steps=100 --solver=bh --reorder_every=10
+# python3 -m nbody run --arch=cpu --body=65536 --steps=1000 --solver=bh --ic=disk --collision_radius=0.02 --log_every=100
+# python3 -m nbody run --arch=cpu --body=16384 --steps=1000 --solver=bh --capacity=65536 --spawn_every=100 --spawn_body=4096
+# python3 -m nbody run --arch=cpu --body=2097152 --steps=100 --solver=pm --grid=256 --periodic
+# python3 -m nbody run --arch=cpu --body=65536 --steps=1000 --solver=bh --ic=plummer --seed=1 --eps=0.05 --diag_every=100
+# python3 -m nbody run --arch=cpu --body=16384 --steps=1000 --solver=bh --record=run.nbt --record_every=10 --record_dtype=float16
+# python3 -m nbody run --arch=cpu --body=65536 --steps=10000 --solver=bh --checkpoint=run.npz --checkpoint_interval=60
+# python3 -m nbody run --arch=cpu --steps=10000 --restart=run.npz --checkpoint=run.npz --checkpoint_interval=60
+# python3 -m nbody run --arch=cpu --body=65536 --steps=10 --solver=bh --startup_profile
+# python3 -m nbody ensemble --arch=cpu --body=128 --dt=0.001,0.002,0.005 --eps=0.1,0.5 --seeds=32 --ic=plummer --steps=500 --out=study.npz
+# python3 -m nbody distributed --body=262144 --solver=bh --workers=1,2,4 --pin --steps=20
+# python3 -m nbody bench --archs=cpu --solvers=direct,tiled,bh --bodies=256,1024,4096 --layouts=soa,aos,packed --out=bench.json
+# python3 -m nbody bench --archs=cpu --solvers=bh,pm --bodies=65536,262144 --reorders=0,10 --out=reorder.json
+# python3 -m nbody compare old.json bench.json --threshold=0.05
+
+# origin of the startup profile (run): building the parsers imports taichi for their choices
+START = time.perf_counter()
+
+# -----------------------------------------------------------------------------------------------------------
+
+def add_system_args(parser):
+    from nbody.integrators import INTEGRATORS
+    from nbody.system import LAYOUTS, PRECISIONS, SOLVERS
+
+    parser.add_argument('-a', '--arch', help='Taichi backend', default="cpu", action="store")
+    parser.add_argument('-b', '--body', help='NB Body', default=4096, type=int)
+    parser.add_argument('-s', '--solver', help='Force solver', default="direct", choices=SOLVERS)
+    parser.add_argument('-t', '--theta', help='Barnes-Hut opening angle', default=0.5, type=float)
+    parser.add_argument('-g', '--grid', help='Particle-mesh cells per axis', default=128, type=int)
+    parser.add_argument('--periodic', help='Particle-mesh periodic box (the initial cube)', default=False, action="store_true")
+    parser.add_argument('-i', '--integrator', help='Integrator', default="kdk", choices=tuple(INTEGRATORS))
+    parser.add_argument('-l', '--layout', help='Body fields memory layout', default="soa", choices=LAYOUTS)
+    parser.add_argument('-p', '--precision', help='Integration precision (forces are f32)', default="f32", choices=PRECISIONS)
+    parser.add_argument('--dt', help='Time step', default=0.005, type=float)
+    parser.add_argument('--eps', help='Softening', default=0.5, type=float)
+    parser.add_argument('--collision_radius', help='Collision radius of a unit mass body (radius * mass^(1/3)), colliding bodies merge, 0 for none', default=0.0, type=float)
+    parser.add_argument('--reorder_every', help='Morton reorder the bodies every N steps (memory locality), 0 for never', default=0, type=int)
+    parser.add_argument('--capacity', help='Body slots allocated up front, bodies added at run time fit without a recompile', default=0, type=int)
+
+def add_record_args(parser):
+    from nbody.trajectory import COMPRESSIONS, DTYPES
+
+    parser.add_argument('-r', '--record', help='Trajectory file to write', default=None)
+    parser.add_argument('--record_every', help='Record a frame every N steps', default=10, type=int)
+    parser.add_argument('--record_dtype', help='Recorded pos / vel dtype', default="float32", choices=DTYPES)
+    parser.add_argument('--record_compression', help='Recorded frames compression', default="none", choices=COMPRESSIONS)
+
+def add_diagnostics_args(parser):
+    parser.add_argument('--diag_every', help='Energy / momentum diagnostics every N steps, 0 for none', default=0, type=int)
+
+def add_timing_args(parser):
+    parser.add_argument('--profile', help='Time the kick / drift / force phases of the steps (synchronized)', default=False, action="store_true")
+    parser.add_argument('--trace', help='Chrome trace-event JSON written on exit', default=None)
+
+def add_startup_args(parser):
+    from nbody.backend import default_kernel_cache
+
+    parser.add_argument('--kernel_cache', help='Taichi offline kernel cache directory, "" for none', default=default_kernel_cache())
+    parser.add_argument('--startup_profile', '--startup-profile', help='Print the startup breakdown: imports, taichi init, initial conditions, compile (+ window, first frame)',
+                        default=False, action="store_true")
+
+def add_checkpoint_args(parser):
+    parser.add_argument('--seed', help='Random seed of the Taichi RNG and the initial conditions (taken from the checkpoint on restart)', default=0, type=int)
+    parser.add_argument('-c', '--checkpoint', help='Checkpoint file to write', default=None)
+    parser.add_argument('--checkpoint_every', help='Checkpoint every N steps, 0 for none', default=0, type=int)
+    parser.add_argument('--checkpoint_interval', help='Checkpoint every N seconds, 0 for none', default=0.0, type=float)
+    parser.add_argument('--restart', help='Checkpoint file to restart from', default=None)
+
+def add_ic_args(parser):
+    from nbody.ic import ICS, default_ic_cache
+
+    parser.add_argument('--ic', help='Initial conditions', default="cube", choices=ICS)
+    parser.add_argument('--ic_params', help='Initial conditions parameters, e.g. a=2,W0=7 (lengths default to fractions of the cube)', default="")
+    parser.add_argument('--ic_cache', help='Generated initial conditions cache directory, "" for none', default=default_ic_cache())
+
+def pair_interactions(nb_body, force_evals=1):
+    # computed by the direct summations only (bench.PAIRWISE solvers, hermite, ensemble)
+    return nb_body * (nb_body - 1) * force_evals
+
+# -----------------------------------------------------------------------------------------------------------
+
+def run(args):
+    from nbody.timing import StartupProfile
+
+    startup = StartupProfile(START)
+
+    import numpy as np
+    import taichi as ti
+
+    from nbody.backend import init_taichi
+    from nbody.bench import PAIRWISE
+    from nbody.checkpoint import Checkpointer, read_checkpoint_meta, system_from_checkpoint
+    from nbody.diagnostics import Diagnostics, format_sample
+    from nbody.ic import cluster_ic, parse_ic_params
+    from nbody.system import NBodySystem
+    from nbody.trajectory import open_writer, print_writer_metrics
+
+    startup.mark("imports")
+
+    seed = args.seed
+
+    if args.restart:
+        meta = read_checkpoint_meta(args.restart)
+        seed, args.precision = meta["seed"], meta.get("precision", "f32")
+
+    # fast math would drop the Kahan compensations
+    init_taichi(args.arch, kernel_cache=args.kernel_cache, random_seed=seed, fast_math=args.precision != "kahan")
+    startup.mark("taichi init")
+
+    if args.restart:
+        # the checkpoint settings (bodies, solver, integrator, dt, eps...) win over the command line
+        system, meta = system_from_checkpoint(args.restart)
+        args.body, args.solver, args.integrator, args.layout = meta["nb_body"], meta["solver"], meta["integrator"], meta["layout"]
+        args.dt, args.eps = meta["dt"], meta["eps"]
+        print("restarted from %s: step %d  t = %.4f" % (args.restart, system.step_count, system.time))
+    else:
+        system = NBodySystem(nb_body=args.body, solver=args.solver, theta=args.theta, integrator=args.integrator, layout=args.layout,
+                             precision=args.precision, grid=args.grid, periodic=args.periodic, capacity=args.capacity)
+        system.init(ic=args.ic, seed=seed, params=parse_ic_params(args.ic_params), cache_dir=args.ic_cache)
+
+    system.set_reorder(args.reorder_every)
+    system.set_collisions(args.collision_radius)
+    startup.mark("initial conditions")
+
+    if args.time is not None:
+        steps = max(1, math.ceil(args.time / args.dt))
+    else:
+        steps = args.steps
+
+    # clusters added every spawn_every steps, the system grows when they do not fit
+    rng = np.random.default_rng(seed)
+    nb_spawn = steps // args.spawn_every if args.spawn_every else 0
+    nb_slot = system.nb_body
+
+    if args.record and system.n_active + nb_spawn * args.spawn_body > nb_slot:
+        # the recorded frames have a fixed size
+        raise ValueError("Recording needs room for the spawned bodies: %d slots for %d bodies, see --capacity" % (nb_slot,
+                         system.n_active + nb_spawn * args.spawn_body))
+
+    checkpointer = None
+    if args.checkpoint:
+        checkpointer = Checkpointer(args.checkpoint, every=args.checkpoint_every, interval=args.checkpoint_interval, seed=seed)
+
+    writer = None
+    if args.record:
+        writer = open_writer(system, args.record, args.dt, args.eps, every=args.record_every, dtype=args.record_dtype,
+                             compression=args.record_compression)
+
+    diagnostics = None
+    if args.diag_every:
+        diagnostics = Diagnostics(system, every=args.diag_every)
+        print(format_sample(diagnostics.sample(args.eps)))
+
+    # JIT compilation (or offline cache load) of every kernel of the steps, not timed
+    system.warmup(args.dt, args.eps)
+    ti.sync()
+    startup.mark("compile")
+
+    if args.startup_profile:
+        print(startup.format())
+
+    # active bodies and their pairs summed over the steps (merges and spawns change the count), the pairs
+    # only for the solvers computing every pair
+    pairwise = system.solver in PAIRWISE
+    body_steps = 0
+    pairs = 0
+
+    t0 = time.perf_counter()
+
+    for step in range(steps):
+        body_steps += system.n_active
+        if pairwise:
+            pairs += pair_interactions(system.n_active)
+
+        system.update(args.dt, args.eps)
+
+        if args.spawn_every and (step + 1) % args.spawn_every == 0:
+            scale = system.scale
+            grown = system.spawn(*cluster_ic(args.spawn_body, rng, scale=scale, center=rng.uniform(-0.8, 0.8, 3) * scale))
+
+            if grown is not system:
+                print("step %d: %d slots -> %d" % (step + 1, system.nb_body, grown.nb_body))
+                system = grown
+                if diagnostics:
+                    diagnostics = Diagnostics(system, every=args.diag_every)
+
+        if writer:
+            writer.write(system)
+        if checkpointer:
+            checkpointer.update(system, args.dt, args.eps)
+        if diagnostics:
+            sample = diagnostics.update(system, args.eps)
+            if sample:
+                print(format_sample(sample))
+
+        if args.log_every and (step + 1) % args.log_every == 0:
+            ti.sync()
+            elapsed = time.perf_counter() - t0
+            print("step %d / %d  t = %.4f  %.2f steps/s" % (step + 1, steps, system.time, (step + 1) / elapsed))
+
+    ti.sync()
+    elapsed = time.perf_counter() - t0
+
+    steps_per_sec = steps / elapsed
+    print("bodies %d (%.0f active on average)  solver %s  integrator %s  layout %s  precision %s  arch %s" % (system.n_active, body_steps / max(steps, 1),
+          args.solver, args.integrator, args.layout, args.precision, args.arch))
+    print("steps %d  sim time %.4f  wall %.3f s  (compile %.3f s)" % (steps, system.time, elapsed, dict(startup.stages)["compile"]))
+    if pairwise:
+        print("%.2f steps/s  %.3e pair interactions/s  (%.2f force evals/step)" % (steps_per_sec,
+              pairs * system.integrator.force_evals / elapsed, system.integrator.force_evals))
+    else:
+        print("%.2f steps/s  %.3e body-steps/s  (%.2f force evals/step)" % (steps_per_sec, body_steps / elapsed, system.integrator.force_evals))
+
+    if args.spawn_every:
+        print("spawned: %d clusters of %d bodies  %d / %d slots used (%d allocated up front)" % (nb_spawn, args.spawn_body, system.n_active,
+              system.nb_body, nb_slot))
+
+    if system.collisions:
+        print("collisions: %d merges  %d / %d bodies active" % (system.collisions.merges, system.n_active, system.nb_body))
+
+    if writer:
+        writer.close()
+        print_writer_metrics(writer)
+
+    if checkpointer:
+        checkpointer.save(system, args.dt, args.eps)
+
+def bench(args):
+    from nbody.bench import run_bench, save_results
+
+    data = run_bench(args.archs.split(","), args.solvers.split(","), [int(n) for n in args.bodies.split(",")], args.layouts.split(","),
+                     repeat=args.repeat, warmup=args.warmup, max_seconds=args.max_seconds, theta=args.theta,
+                     integrator=args.integrator, reorders=[int(k) for k in args.reorders.split(",")])
+
+    if args.out:
+        save_results(data, args.out)
+        print("results saved to %s" % args.out)
+
+def ensemble(args):
+    import numpy as np
+    import taichi as ti
+
+    from nbody.backend import init_taichi
+    from nbody.ensemble import Ensemble, parameter_grid
+    from nbody.ic import parse_ic_params
+
+    init_taichi(args.arch)
+
+    dt, eps, seeds = parameter_grid([float(x) for x in args.dt.split(",")], [float(x) for x in args.eps.split(",")], args.seeds, seed=args.seed)
+
+    system = Ensemble(len(dt), args.body)
+    system.set_params(dt, eps)
+    system.init(seeds, ic=args.ic, params=parse_ic_params(args.ic_params))
+
+    energy0 = system.energies().sum(axis=1)
+
+    # JIT compilation, not timed
+    t0 = time.perf_counter()
+    system.update(1)
+    ti.sync()
+    compile_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    system.update(args.steps)
+    ti.sync()
+    elapsed = time.perf_counter() - t0
+
+    energy = system.energies().sum(axis=1)
+    error = (energy - energy0) / np.abs(energy0)
+
+    print("systems %d x bodies %d  ic %s  arch %s" % (system.nb_system, args.body, args.ic, args.arch))
+    print("steps %d  wall %.3f s  (first step + compile %.3f s)" % (args.steps, elapsed, compile_time))
+    print("%.2f system-steps/s  %.3e body-steps/s  %.3e pair interactions/s" % (system.nb_system * args.steps / elapsed,
+          system.nb_system * args.body * args.steps / elapsed, system.nb_system * pair_interactions(args.body) * args.steps / elapsed))
+
+    print("%10s %10s  %12s %12s" % ("dt", "eps", "mean |dE/E|", "max |dE/E|"))
+    for d, e in sorted(set(zip(dt, eps))):
+        rows = np.abs(error[(dt == d) & (eps == e)])
+        print("%10g %10g  %12.3e %12.3e" % (d, e, rows.mean(), rows.max()))
+
+    if args.out:
+        np.savez(args.out, dt=dt, eps=eps, seed=seeds, state=system.state(), energy0=energy0, energy=energy, energy_error=error,
+                 time=system.time)
+        print("results saved to %s" % args.out)
+
+def distributed(args):
+    import json
+
+    from nbody.distributed import STATS, DistributedRun, load_balance
+    from nbody.ic import cube_ic, make_ic, parse_ic_params
+
+    if args.ic == "cube":
+        pos, vel, mass = cube_ic(args.body, seed=args.seed)
+    else:
+        pos, vel, mass = make_ic(args.ic, args.body, seed=args.seed, params=parse_ic_params(args.ic_params), cache_dir=args.ic_cache)
+
+    counts = [int(w) for w in args.workers.split(",")]
+    results = []
+
+    print("bodies %d  solver %s  steps %d  transport %s%s" % (args.body, args.solver, args.steps, args.transport, "  pinned" if args.pin else ""))
+    if args.solver == "bh":
+        print("note: every worker builds the whole octree (all %d bodies), only the tree walks are split: the build bounds the speedup" % args.body)
+
+    for nb_worker in counts:
+        run = DistributedRun(args.body, nb_worker, solver=args.solver, theta=args.theta, dt=args.dt, eps=args.eps, arch=args.arch,
+                             threads=args.threads, pin=args.pin, transport=args.transport)
+        r = run.run(pos, vel, mass, args.steps)
+        del r["pos"], r["vel"]
+        results.append(r)
+
+        # strong scaling against the first worker count
+        speedup = r["steps_per_sec"] / results[0]["steps_per_sec"]
+        efficiency = speedup * counts[0] / nb_worker
+        r.update(speedup=speedup, efficiency=efficiency, load_balance=load_balance(r), threads=run.config["threads"])
+
+        print("workers %2d x %2d threads  %9.2f steps/s  speedup %5.2f  efficiency %5.1f%%  load balance (max / mean busy) %.3f" % (
+              nb_worker, r["threads"], r["steps_per_sec"], speedup, efficiency * 100, r["load_balance"]))
+
+        for w in r["workers"]:
+            print("    worker %2d  bodies %8d  %s" % (w["rank"], w["end"] - w["begin"], "  ".join("%s %8.3f ms" % (name, w[name] * 1000)
+                  for name in STATS)))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+        print("results saved to %s" % args.out)
+
+def compare(args):
+    from nbody.bench import compare_results, load_results
+
+    rows = compare_results(load_results(args.old), load_results(args.new), threshold=args.threshold, metric=args.metric)
+    regressions = 0
+
+    for (arch, solver, integrator, layout, reorder_every, nb_body), a, b, ratio, regression in rows:
+        print("%-6s %-6s %-8s %-6s reorder %-4d %8d  %11.3f -> %11.3f  x%.3f %s" % (arch, solver, integrator, layout, reorder_every, nb_body,
+              a, b, ratio, "REGRESSION" if regression else ""))
+        regressions += regression
+
+    print("%d configurations compared, %d regressions (threshold %.1f%%)" % (len(rows), regressions, args.threshold * 100))
+
+    if regressions:
+        sys.exit(1)
+
+# -----------------------------------------------------------------------------------------------------------
+
+def add_run_args(p):
+    add_system_args(p)
+    add_ic_args(p)
+    p.add_argument('-n', '--steps', help='Number of steps', default=100, type=int)
+    p.add_argument('--time', help='Simulated time to reach (overrides --steps)', default=None, type=float)
+    p.add_argument('--log_every', help='Print progress every N steps, 0 for none', default=0, type=int)
+    add_diagnostics_args(p)
+    add_record_args(p)
+    add_checkpoint_args(p)
+    add_startup_args(p)
+    p.add_argument('--spawn_every', help='Add a Plummer cluster every N steps, 0 for never', default=0, type=int)
+    p.add_argument('--spawn_body', help='Bodies of the spawned clusters', default=1024, type=int)
+
+def add_bench_args(p):
+    p.add_argument('--bodies', help='Comma separated body counts', default="256,1024,4096,16384,65536")
+    p.add_argument('--archs', help='Comma separated Taichi backends', default="cpu")
+    p.add_argument('--solvers', help='Comma separated force solvers', default="direct,tiled,bh")
+    p.add_argument('--layouts', help='Comma separated body memory layouts', default="soa")
+    p.add_argument('--reorders', help='Comma separated Morton reorder periods (steps), 0 for none', default="0")
+    p.add_argument('-t', '--theta', help='Barnes-Hut opening angle', default=0.5, type=float)
+    p.add_argument('-i', '--integrator', help='Integrator', default="kdk")
+    p.add_argument('--repeat', help='Timed steps per configuration', default=5, type=int)
+    p.add_argument('--warmup', help='Untimed steps after compilation', default=2, type=int)
+    p.add_argument('--max_seconds', help='Skip configurations slower than this', default=10.0, type=float)
+    p.add_argument('-o', '--out', help='Results file, .json or .csv', default=None)
+
+def add_ensemble_args(p):
+    p.add_argument('-a', '--arch', help='Taichi backend', default="cpu", action="store")
+    p.add_argument('-b', '--body', help='NB Body per system', default=128, type=int)
+    p.add_argument('--dt', help='Comma separated time steps', default="0.005")
+    p.add_argument('--eps', help='Comma separated softenings', default="0.5")
+    p.add_argument('--seeds', help='Systems per (dt, eps), seeds seed..seed + N - 1', default=8, type=int)
+    p.add_argument('--seed', help='First seed', default=0, type=int)
+    add_ic_args(p)
+    p.add_argument('-n', '--steps', help='Number of steps', default=100, type=int)
+    p.add_argument('-o', '--out', help='Results .npz (parameters, final state, energy errors)', default=None)
+
+def add_distributed_args(p):
+    p.add_argument('-a', '--arch', help='Taichi backend of the workers', default="cpu", action="store")
+    p.add_argument('-b', '--body', help='NB Body', default=65536, type=int)
+    p.add_argument('-s', '--solver', help='Force solver', default="bh", choices=("direct", "bh"))
+    p.add_argument('-t', '--theta', help='Barnes-Hut opening angle', default=0.5, type=float)
+    p.add_argument('--dt', help='Time step', default=0.005, type=float)
+    p.add_argument('--eps', help='Softening', default=0.5, type=float)
+    p.add_argument('-w', '--workers', help='Comma separated worker counts, one run each', default="1,2,4")
+    p.add_argument('--threads', help='Cpu threads per worker, 0 for its share of the cpus', default=0, type=int)
+    p.add_argument('--pin', help='Pin every worker to its share of the cpus', default=False, action="store_true")
+    p.add_argument('--transport', help='Positions exchange', default="shm", choices=("shm",))
+    p.add_argument('--seed', help='Initial conditions seed', default=0, type=int)
+    add_ic_args(p)
+    p.add_argument('-n', '--steps', help='Number of steps', default=20, type=int)
+    p.add_argument('-o', '--out', help='Results .json', default=None)
+
+def add_compare_args(p):
+    p.add_argument('old', help='Reference results (.json or .csv)')
+    p.add_argument('new', help='New results (.json or .csv)')
+    p.add_argument('--threshold', help='Relative slowdown flagged as regression', default=0.05, type=float)
+    p.add_argument('--metric', help='Throughput column compared', default="step_steps_per_sec")
+
+# name: (help, arguments, function)
+COMMANDS = {
+    "run": ("advance the system as fast as possible", add_run_args, run),
+    "bench": ("benchmark sweep over bodies, archs and solvers", add_bench_args, bench),
+    "ensemble": ("many small independent systems advanced together (parameter studies)", add_ensemble_args, ensemble),
+    "distributed": ("domain decomposed stepping over worker processes, strong scaling", add_distributed_args, distributed),
+    "compare": ("compare two bench result files, exit 1 on regression", add_compare_args, compare),
+}
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    parser = argparse.ArgumentParser(prog="nbody", description="Headless Leapfrog N-Body")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # only the command being run gets its arguments: the solver / integrator choices import taichi, so
+    # `nbody compare` or `nbody --help` do not pay it (there are no global options, the command comes first)
+    for name, (help, add_args, func) in COMMANDS.items():
+        p = commands.add_parser(name, help=help)
+        if argv[:1] == [name]:
+            add_args(p)
+        p.set_defaults(func=func)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import taichi as ti
+
+# -----------------------------------------------------------------------------------------------------------
+# collisions: bodies closer than the sum of their radii merge, momentum (and centre of mass) conserved
+#
+# a body of mass m has the radius radius * m^(1/3) (constant density, merged bodies grow). Every step:
+#
+#   hash    : uniform grid of cells of the biggest diameter, cells hashed into nb_bucket buckets. Counting
+#             sort: atomic count per bucket, exclusive scan, atomic scatter of the body indices
+#   detect  : every body tests the bodies of the 27 cells around it, target = the lowest overlapping index
+#             below its own (-1: none, the body survives the step)
+#   merge   : a body whose target survives is added into it (atomics), a chain (a <- b <- c) merges one
+#             link per step, the rest waits for the next steps
+#   compact : only when something merged, the survivors are moved to the first slots (stable) and
+#             nb_active drops, so every later loop skips the merged bodies (mass 0, kept after nb_active)
+#
+# the detection is a single kernel, the counters are the only read back.
+
+# spatial hash primes
+HASH = (73856093, 19349663, 83492791)
+
+# counters
+MERGES, NB_ALIVE = 0, 1
+
+@ti.data_oriented
+class Collisions:
+    def __init__(self, system, radius):
+        self.system = system
+        self.radius = radius
+
+        n = system.nb_body
+
+        # power of two >= 2 N buckets
+        self.nb_bucket = 1
+        while self.nb_bucket < 2 * n:
+            self.nb_bucket *= 2
+
+        self.bucket_count = ti.field(dtype=ti.i32, shape=self.nb_bucket)
+        self.bucket_start = ti.field(dtype=ti.i32, shape=self.nb_bucket)
+        self.bucket_fill = ti.field(dtype=ti.i32, shape=self.nb_bucket)
+
+        self.body_bucket = ti.field(dtype=ti.i32, shape=n)
+        self.sorted = ti.field(dtype=ti.i32, shape=n)
+        self.target = ti.field(dtype=ti.i32, shape=n)
+        self.merged = ti.field(dtype=ti.i32, shape=n)
+
+        # merged state accumulated into the survivors: mass, m pos, m vel, m acc
+        self.sum_mass = ti.field(dtype=ti.f32, shape=n)
+        self.sum_pos = ti.Vector.field(3, dtype=ti.f32, shape=n)
+        self.sum_vel = ti.Vector.field(3, dtype=ti.f32, shape=n)
+        self.sum_acc = ti.Vector.field(3, dtype=ti.f32, shape=n)
+
+        self.max_mass = ti.field(dtype=ti.f32, shape=())
+        self.counters = ti.field(dtype=ti.i32, shape=2)
+
+        self.permutation = system.get_permutation()
+
+        # stats
+        self.merges = 0
+        self.last_merges = 0
+
+    @ti.func
+    def body_radius(self, m):
+        return self.radius * ti.pow(m, 1.0 / 3.0)
+
+    @ti.func
+    def cell(self, p, inv_size):
+        return ti.cast(ti.floor(p * inv_size), ti.i32)
+
+    @ti.func
+    def bucket(self, c):
+        h = (c.x * HASH[0]) ^ (c.y * HASH[1]) ^ (c.z * HASH[2])
+        return h & (self.nb_bucket - 1)
+
+    @ti.kernel
+    def detect(self):
+        n = self.system.nb_active[None]
+
+        for k in range(self.nb_bucket):
+            self.bucket_count[k] = 0
+
+        self.max_mass[None] = 0.0
+        for k in range(2):
+            self.counters[k] = 0
+
+        for i in range(n):
+            ti.atomic_max(self.max_mass[None], self.system.mass[i])
+
+        inv_size = 1.0 / ti.max(2.0 * self.body_radius(self.max_mass[None]), 1e-30)
+
+        for i in range(n):
+            b = self.bucket(self.cell(self.system.pos[i], inv_size))
+            self.body_bucket[i] = b
+            ti.atomic_add(self.bucket_count[b], 1)
+
+        ti.loop_config(serialize=True)
+        for _ in range(1):
+            total = 0
+            for k in range(self.nb_bucket):
+                self.bucket_start[k] = total
+                self.bucket_fill[k] = total
+                total += self.bucket_count[k]
+
+        for i in range(n):
+            self.sorted[ti.atomic_add(self.bucket_fill[self.body_bucket[i]], 1)] = i
+
+        for i in range(n):
+            p = self.system.pos[i]
+            r = self.body_radius(self.system.mass[i])
+            c = self.cell(p, inv_size)
+            best = i
+
+            for dx, dy, dz in ti.static(ti.ndrange((-1, 2), (-1, 2), (-1, 2))):
+                b = self.bucket(c + ti.Vector([dx, dy, dz]))
+                for k in range(self.bucket_start[b], self.bucket_start[b] + self.bucket_count[b]):
+                    j = self.sorted[k]
+                    if j < best:
+                        d = self.system.pos[j] - p
+                        reach = r + self.body_radius(self.system.mass[j])
+                        if ti.math.dot(d, d) < reach * reach:
+                            best = j
+
+            self.target[i] = best if best < i else -1
+
+        # merged now: the target survives (a target that merges itself waits for the next step)
+        for i in range(n):
+            t = self.target[i]
+            self.merged[i] = 0
+            if t >= 0:
+                if self.target[t] == -1:
+                    self.merged[i] = 1
+
+        for i in range(n):
+            m = self.system.mass[i]
+            self.sum_mass[i] = m
+            self.sum_pos[i] = self.system.pos[i] * m
+            self.sum_vel[i] = self.system.vel[i] * m
+            self.sum_acc[i] = self.system.acc[i] * m
+
+        for i in range(n):
+            if self.merged[i]:
+                t = self.target[i]
+                m = self.system.mass[i]
+                ti.atomic_add(self.sum_mass[t], m)
+                ti.atomic_add(self.sum_pos[t], self.system.pos[i] * m)
+                ti.atomic_add(self.sum_vel[t], self.system.vel[i] * m)
+                ti.atomic_add(self.sum_acc[t], self.system.acc[i] * m)
+                ti.atomic_add(self.counters[MERGES], 1)
+            else:
+                ti.atomic_add(self.counters[NB_ALIVE], 1)
+
+    @ti.kernel
+    def merge(self):
+        n = self.system.nb_active[None]
+
+        for i in range(n):
+            if not self.merged[i]:
+                m = self.sum_mass[i]
+                if m > self.system.mass[i]:
+                    self.system.mass[i] = m
+                    self.system.pos[i] = self.sum_pos[i] / m
+                    self.system.vel[i] = self.sum_vel[i] / m
+                    self.system.acc[i] = self.sum_acc[i] / m
+                    self.system.sync_body(i)
+            else:
+                self.system.mass[i] = 0.0
+                self.system.vel[i] = [0.0, 0.0, 0.0]
+                self.system.acc[i] = [0.0, 0.0, 0.0]
+                self.system.sync_body(i)
+
+        # stable compaction: survivors first, then the bodies merged now, then the older ones
+        ti.loop_config(serialize=True)
+        for _ in range(1):
+            alive = 0
+            dead = self.counters[NB_ALIVE]
+            for i in range(n):
+                if not self.merged[i]:
+                    self.permutation.order[alive] = i
+                    alive += 1
+                else:
+                    self.permutation.order[dead] = i
+                    dead += 1
+
+        for i in range(n, self.system.nb_body):
+            self.permutation.order[i] = i
+
+    def update(self):
+        self.detect()
+
+        merges, nb_alive = (int(x) for x in self.counters.to_numpy())
+        self.last_merges = merges
+
+        if merges:
+            self.merge()
+            self.permutation.apply()
+            self.system.set_active(nb_alive)
+            self.merges += merges
+
+    def get_info(self):
+        return {"merges": self.merges, "last_merges": self.last_merges, "active": self.system.n_active}
@@ -0,0 +1,118 @@
+import collections
+
+import taichi as ti
+
+from nbody.backend import has_f64
+
+# -----------------------------------------------------------------------------------------------------------
+# conservation diagnostics: kinetic / potential energy, linear / angular momentum and virial ratio
+#
+# parallel reductions into a handful of accumulators, only those scalars are read back. A sample is
+# taken every `every` steps, the potential comes from the force pass of that step (system.pot_every):
+# with "kdk" the last force pass of a step is at the final positions so it costs nothing extra,
+# otherwise (other integrators, sample() out of schedule) one extra force pass is made, acc is saved and
+# restored around it
+
+# accumulators
+KINETIC, POTENTIAL, MOMENTUM, ANGULAR, MASS = 0, 1, 2, 5, 8
+NB_SUM = 9
+
+@ti.data_oriented
+class Diagnostics:
+
+    def __init__(self, system, every=10, history=512):
+        self.system = system
+        self.every = max(1, every)
+
+        self.dtype = ti.f64 if has_f64() else ti.f32
+        self.sums = ti.field(dtype=self.dtype, shape=NB_SUM)
+
+        # the kdk force pass at the end of a step is at the final positions
+        self.synced = getattr(system.integrator, "synced_forces", False)
+        if self.synced:
+            system.pot_every = self.every
+
+        self.acc_save = ti.Vector.field(3, dtype=ti.f32, shape=system.nb_body)
+
+        self.samples = collections.deque(maxlen=history)
+        self.energy0 = None
+
+    @ti.kernel
+    def copy_acc(self, src: ti.template(), dst: ti.template()):
+        for i in range(self.system.nb_active[None]):
+            dst[i] = src[i]
+
+    @ti.kernel
+    def reduce(self):
+        for k in range(NB_SUM):
+            self.sums[k] = 0.0
+
+        for i in range(self.system.nb_active[None]):
+            m = self.system.mass[i]
+            p = self.system.pos[i]
+            v = self.system.vel[i]
+
+            mv = v * m
+            L = ti.math.cross(p, mv)
+
+            self.sums[KINETIC] += ti.cast(0.5 * ti.math.dot(mv, v), self.dtype)
+            self.sums[POTENTIAL] += ti.cast(0.5 * m * self.system.pot[i], self.dtype)
+            for c in ti.static(range(3)):
+                self.sums[MOMENTUM + c] += ti.cast(mv[c], self.dtype)
+                self.sums[ANGULAR + c] += ti.cast(L[c], self.dtype)
+            self.sums[MASS] += ti.cast(m, self.dtype)
+
+    def potential(self, eps):
+        # one extra force pass at the current positions, the integrator keeps its acc
+        self.copy_acc(self.system.acc, self.acc_save)
+
+        with_pot = self.system.with_pot
+        self.system.with_pot = True
+        self.system.compute_forces(eps)
+        self.system.with_pot = with_pot
+
+        self.copy_acc(self.acc_save, self.system.acc)
+
+    def sample(self, eps):
+        if not (self.synced and self.system.with_pot):
+            self.potential(eps)
+
+        self.reduce()
+        s = self.sums.to_numpy()
+
+        kinetic, potential = float(s[KINETIC]), float(s[POTENTIAL])
+        energy = kinetic + potential
+
+        if self.energy0 is None:
+            self.energy0 = energy
+
+        sample = {
+            "step": self.system.step_count,
+            "time": self.system.time,
+            "kinetic": kinetic,
+            "potential": potential,
+            "energy": energy,
+            "energy_error": (energy - self.energy0) / abs(self.energy0) if self.energy0 else 0.0,
+            "momentum": [float(x) for x in s[MOMENTUM:MOMENTUM + 3]],
+            "angular_momentum": [float(x) for x in s[ANGULAR:ANGULAR + 3]],
+            "virial": 2.0 * kinetic / abs(potential) if potential else 0.0,
+            "mass": float(s[MASS]),
+        }
+
+        self.samples.append(sample)
+        return sample
+
+    def update(self, system, eps):
+        # called after every step, returns the new sample or None
+        if system.step_count % self.every:
+            return None
+        return self.sample(eps)
+
+    def series(self, key):
+        return [s[key] for s in self.samples]
+
+def format_sample(s):
+    P = sum(x * x for x in s["momentum"]) ** 0.5
+    L = sum(x * x for x in s["angular_momentum"]) ** 0.5
+    return "step %d  t = %.4f  E = %.6e  dE/E = %+.3e  K = %.4e  W = %.4e  2K/|W| = %.4f  |P| = %.3e  |L| = %.3e" % (
+           s["step"], s["time"], s["energy"], s["energy_error"], s["kinetic"], s["potential"], s["virial"], P, L)
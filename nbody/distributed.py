@@ -0,0 +1,255 @@
+import multiprocessing, os, threading, time
+from multiprocessing import shared_memory
+
+import numpy as np
+import taichi as ti
+
+# -----------------------------------------------------------------------------------------------------------
+# multi-process stepping: the bodies are split in contiguous slices, one per worker process (own Taichi
+# runtime, optionally pinned to its share of the cpus, e.g. one per socket). Every worker holds a full
+# NBodySystem restricted to its slice (targets): it integrates all the bodies but only its own are right,
+# the others are refreshed from the exchanged positions before each force pass. Leapfrog KDK, f32:
+#
+#   kick 1/2 + drift, publish own positions | exchange (barrier) | load all positions, forces on own bodies
+#   (direct: against all, bh: through a tree of all, remote bodies pruned), kick 1/2
+#
+# with bh every worker builds the whole octree (over all N bodies, on its own threads), only the tree walks
+# are split: the build time is the ceiling of the strong scaling
+#
+# the positions go through a transport. "shm": a double buffered (2, N, 3) array in shared memory, the
+# buffer of step k is written again at step k + 2, after every worker passed the barrier of step k + 1, so
+# one barrier per step is enough. A socket transport (several hosts) would implement the same two calls.
+#
+# the coordinator only starts the workers, times the run between two rendez-vous and gathers per worker
+# counters (force / exchange / wait seconds) for the load balance.
+
+# per worker counters, seconds summed over the steps
+KICK_DRIFT, FORCE, WAIT, NB_STAT = 0, 1, 2, 3
+STATS = ("kick_drift", "force", "wait")
+
+# -----------------------------------------------------------------------------------------------------------
+
+class SharedArrays:
+    # numpy arrays in named shared memory blocks: created by the coordinator (names=None), attached by name in the workers
+
+    def __init__(self, specs, names=None):
+        self.specs = specs
+        self.blocks = {}
+        self.arrays = {}
+
+        for name, (shape, dtype) in specs.items():
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            if names is None:
+                block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            else:
+                block = shared_memory.SharedMemory(name=names[name])
+
+            self.blocks[name] = block
+            self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def names(self):
+        return {name: block.name for name, block in self.blocks.items()}
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self, unlink=False):
+        self.arrays.clear()
+        for block in self.blocks.values():
+            block.close()
+            if unlink:
+                block.unlink()
+
+# a transport has buffer(step, begin, end), where a worker writes the positions of its bodies (or
+# publish(step, begin, pos), a copy), and exchange(step), which returns all the positions of the step once
+# every worker wrote them
+
+class SharedMemoryTransport:
+
+    def __init__(self, arrays, barrier):
+        self.pos = arrays["pos"]
+        self.barrier = barrier
+
+    def buffer(self, step, begin, end):
+        # where to write in place (no copy)
+        return self.pos[step % 2, begin:end]
+
+    def publish(self, step, begin, pos):
+        self.pos[step % 2, begin:begin + len(pos)] = pos
+
+    def exchange(self, step):
+        self.barrier.wait()
+        return self.pos[step % 2]
+
+TRANSPORTS = {"shm": SharedMemoryTransport}
+
+def partition(nb_body, nb_worker):
+    # contiguous, as equal as possible: [(begin, end)] per worker
+    bounds = [nb_body * w // nb_worker for w in range(nb_worker + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def worker_cpus(rank, nb_worker):
+    # contiguous share of the cpus (the sockets are usually numbered in blocks), at least one
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < nb_worker:
+        return [cpus[rank % len(cpus)]]
+    return cpus[len(cpus) * rank // nb_worker:len(cpus) * (rank + 1) // nb_worker]
+
+@ti.kernel
+def export_range(pos: ti.template(), out: ti.types.ndarray(dtype=ti.math.vec3, ndim=1), begin: ti.i32):
+    for k in range(out.shape[0]):
+        out[k] = pos[begin + k]
+
+# -----------------------------------------------------------------------------------------------------------
+
+def worker_main(rank, config, specs, names, barrier, rendezvous):
+    from nbody.backend import init_taichi
+    from nbody.system import NBodySystem
+
+    if config["pin"]:
+        os.sched_setaffinity(0, config["cpus"][rank])
+
+    init_taichi(config["arch"], cpu_max_num_threads=config["threads"])
+
+    arrays = SharedArrays(specs, names)
+    transport = TRANSPORTS[config["transport"]](arrays, barrier)
+
+    begin, end = config["partition"][rank]
+    dt, eps, steps = config["dt"], config["eps"], config["steps"]
+
+    system = NBodySystem(nb_body=config["nb_body"], solver=config["solver"], theta=config["theta"], targets=(begin, end))
+    system.set_bodies(arrays["pos"][1], arrays["vel"], arrays["mass"])
+
+    # forces of the initial positions + compilation of every kernel, before the timed run
+    system.compute_forces(eps)
+    system.kick(0.0)
+    system.drift(0.0)
+    export_range(system.pos, transport.buffer(1, begin, end), begin)
+    ti.sync()
+
+    stats = arrays["stats"][rank]
+    rendezvous.wait()
+
+    for step in range(steps):
+        t0 = time.perf_counter()
+        system.kick(dt * 0.5)
+        system.drift(dt)
+        export_range(system.pos, transport.buffer(step, begin, end), begin)
+        ti.sync()
+
+        t1 = time.perf_counter()
+        pos = transport.exchange(step)
+
+        t2 = time.perf_counter()
+        system.pos.from_numpy(pos)
+        system.compute_forces(eps)
+        system.kick(dt * 0.5)
+        ti.sync()
+
+        t3 = time.perf_counter()
+        stats[KICK_DRIFT] += t1 - t0
+        stats[WAIT] += t2 - t1
+        stats[FORCE] += t3 - t2
+
+    arrays["vel"][begin:end] = system.vel.to_numpy()[begin:end]
+
+    rendezvous.wait()
+    arrays.close()
+
+# -----------------------------------------------------------------------------------------------------------
+
+class DistributedRun:
+
+    def __init__(self, nb_body, nb_worker, solver="bh", theta=0.5, dt=0.005, eps=0.5, arch="cpu", threads=0, pin=False, transport="shm"):
+
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown transport %s, expected one of %s" % (transport, tuple(TRANSPORTS)))
+        if solver == "tiled":
+            raise ValueError("Solver tiled computes the pairs of every body, use direct or bh")
+
+        self.nb_body = nb_body
+        self.nb_worker = nb_worker
+
+        # cpu threads of each worker runtime, 0 = its share of the cpus
+        threads = threads or max(1, len(os.sched_getaffinity(0)) // nb_worker)
+
+        self.config = {
+            "nb_body": nb_body, "solver": solver, "theta": theta, "dt": dt, "eps": eps, "arch": arch, "threads": threads,
+            "pin": pin, "cpus": [worker_cpus(w, nb_worker) for w in range(nb_worker)], "transport": transport,
+            "partition": partition(nb_body, nb_worker),
+        }
+
+        self.specs = {
+            "pos": ((2, nb_body, 3), 'f4'),
+            "vel": ((nb_body, 3), 'f4'),
+            "mass": ((nb_body,), 'f4'),
+            "stats": ((nb_worker, NB_STAT), 'f8'),
+        }
+
+    def run(self, pos, vel, mass, steps):
+        # -> dict: wall time, steps/s, per worker stats, final positions / velocities
+        ctx = multiprocessing.get_context("spawn")
+
+        arrays = SharedArrays(self.specs)
+        arrays["pos"][:] = pos
+        arrays["vel"][:] = vel
+        arrays["mass"][:] = mass
+        arrays["stats"][:] = 0.0
+
+        barrier = ctx.Barrier(self.nb_worker)
+        rendezvous = ctx.Barrier(self.nb_worker + 1)
+
+        config = dict(self.config, steps=steps)
+        workers = [ctx.Process(target=worker_main, args=(rank, config, self.specs, arrays.names(), barrier, rendezvous),
+                               name="nbody-worker-%d" % rank, daemon=True) for rank in range(self.nb_worker)]
+
+        # a worker that dies would leave the others in a barrier
+        failed = threading.Event()
+        done = threading.Event()
+
+        def watch():
+            while not done.wait(0.2):
+                if any(w.exitcode not in (None, 0) for w in workers):
+                    failed.set()
+                    barrier.abort()
+                    rendezvous.abort()
+                    return
+
+        for w in workers:
+            w.start()
+        threading.Thread(target=watch, daemon=True).start()
+
+        try:
+            rendezvous.wait()
+            t0 = time.perf_counter()
+            rendezvous.wait()
+            wall = time.perf_counter() - t0
+        except threading.BrokenBarrierError:
+            raise RuntimeError("a distributed worker failed, exit codes %s" % [w.exitcode for w in workers]) from None
+        finally:
+            done.set()
+            for w in workers:
+                w.join(timeout=10.0)
+                if w.is_alive():
+                    w.terminate()
+
+        result = {
+            "nb_body": self.nb_body,
+            "nb_worker": self.nb_worker,
+            "steps": steps,
+            "wall": wall,
+            "steps_per_sec": steps / wall,
+            "workers": [dict({"rank": rank, "begin": begin, "end": end}, **{name: float(arrays["stats"][rank, k]) / steps
+                        for k, name in enumerate(STATS)}) for rank, (begin, end) in enumerate(self.config["partition"])],
+            "pos": arrays["pos"][(steps - 1) % 2].copy() if steps else arrays["pos"][1].copy(),
+            "vel": arrays["vel"].copy(),
+        }
+
+        arrays.close(unlink=True)
+
+        return result
+
+def load_balance(result):
+    # busy time (kick / drift + forces) per step: max / mean, 1 = perfectly balanced
+    busy = [w["kick_drift"] + w["force"] for w in result["workers"]]
+    return max(busy) / (sum(busy) / len(busy)) if sum(busy) else 1.0
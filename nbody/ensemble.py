@@ -0,0 +1,154 @@
+import itertools
+
+import numpy as np
+import taichi as ti
+
+from nbody.backend import has_f64
+from nbody.ic import cube_ic, make_ic
+
+# -----------------------------------------------------------------------------------------------------------
+# ensemble of independent small systems, advanced together
+#
+# the body fields are shaped (nb_system, nb_body), every system has its own dt / eps (fields, so changing them
+# does not recompile). A step is a single kernel launch for the whole ensemble: its top level loops (half
+# kick + drift, direct forces, half kick) run one after the other, each parallel over (system, body).
+# Leapfrog KDK with direct summation (the systems are small), f32.
+
+@ti.data_oriented
+class Ensemble:
+
+    def __init__(self, nb_system, nb_body, scale=8.0):
+        self.nb_system = nb_system
+        self.nb_body = nb_body
+        self.scale = scale
+
+        shape = (nb_system, nb_body)
+
+        self.pos = ti.Vector.field(3, dtype=ti.f32, shape=shape)
+        self.vel = ti.Vector.field(3, dtype=ti.f32, shape=shape)
+        self.acc = ti.Vector.field(3, dtype=ti.f32, shape=shape)
+        self.mass = ti.field(dtype=ti.f32, shape=shape)
+
+        self.dt = ti.field(dtype=ti.f32, shape=nb_system)
+        self.eps = ti.field(dtype=ti.f32, shape=nb_system)
+
+        # kinetic / potential energy per system
+        self.dtype = ti.f64 if has_f64() else ti.f32
+        self.energy = ti.field(dtype=self.dtype, shape=(nb_system, 2))
+
+        self.dt_host = np.zeros(nb_system)
+        self.step_count = 0
+        self.time = np.zeros(nb_system)
+
+    def init(self, seeds, ic="cube", params=None):
+        # one seed per system, "cube" = uniform at rest (the numpy one, so it follows the seed)
+        pos = np.empty((self.nb_system, self.nb_body, 3), dtype='f4')
+        vel = np.zeros_like(pos)
+        mass = np.ones((self.nb_system, self.nb_body), dtype='f4')
+
+        for s, seed in enumerate(seeds):
+            if ic == "cube":
+                pos[s], vel[s], mass[s] = cube_ic(self.nb_body, seed=seed, scale=self.scale)
+            else:
+                pos[s], vel[s], mass[s] = make_ic(ic, self.nb_body, seed=seed, params=params, scale=self.scale, verbose=False)
+
+        self.pos.from_numpy(pos)
+        self.vel.from_numpy(vel)
+        self.mass.from_numpy(mass)
+
+        self.step_count = 0
+        self.time[:] = 0.0
+
+        self.forces()
+
+    def set_params(self, dt, eps):
+        # scalars or one value per system
+        self.dt_host = np.broadcast_to(np.asarray(dt, dtype='f4'), self.nb_system).copy()
+        self.dt.from_numpy(self.dt_host)
+        self.eps.from_numpy(np.broadcast_to(np.asarray(eps, dtype='f4'), self.nb_system).copy())
+
+        # the accelerations of the current positions follow the new eps (the next half kick uses them)
+        self.forces()
+
+    @ti.func
+    def force(self, s, i):
+        acc = ti.Vector([0.0, 0.0, 0.0])
+        eps2 = self.eps[s] * self.eps[s]
+        p_i = self.pos[s, i]
+
+        for j in range(self.nb_body):
+            if i != j:
+                DR = self.pos[s, j] - p_i
+                DR2 = ti.math.dot(DR, DR) + eps2
+                acc += DR * (self.mass[s, j] / (ti.sqrt(DR2) * DR2))
+
+        return acc
+
+    @ti.kernel
+    def forces(self):
+        for s, i in ti.ndrange(self.nb_system, self.nb_body):
+            self.acc[s, i] = self.force(s, i)
+
+    @ti.kernel
+    def step(self):
+        for s, i in ti.ndrange(self.nb_system, self.nb_body):
+            self.vel[s, i] += self.acc[s, i] * (0.5 * self.dt[s])
+            self.pos[s, i] += self.vel[s, i] * self.dt[s]
+
+        for s, i in ti.ndrange(self.nb_system, self.nb_body):
+            self.acc[s, i] = self.force(s, i)
+
+        for s, i in ti.ndrange(self.nb_system, self.nb_body):
+            self.vel[s, i] += self.acc[s, i] * (0.5 * self.dt[s])
+
+    def update(self, nb_step=1):
+        for _ in range(nb_step):
+            self.step()
+
+        self.step_count += nb_step
+        self.time += nb_step * self.dt_host
+
+    @ti.kernel
+    def compute_energy(self):
+        for s, k in self.energy:
+            self.energy[s, k] = 0.0
+
+        for s, i in ti.ndrange(self.nb_system, self.nb_body):
+            m = self.mass[s, i]
+            v = self.vel[s, i]
+            pot = 0.0
+
+            for j in range(self.nb_body):
+                if i != j:
+                    DR = self.pos[s, j] - self.pos[s, i]
+                    pot -= self.mass[s, j] / ti.sqrt(ti.math.dot(DR, DR) + self.eps[s] * self.eps[s])
+
+            self.energy[s, 0] += ti.cast(0.5 * m * ti.math.dot(v, v), self.dtype)
+            self.energy[s, 1] += ti.cast(0.5 * m * pot, self.dtype)
+
+    def energies(self):
+        # -> (nb_system, 2) kinetic, potential
+        self.compute_energy()
+        return self.energy.to_numpy()
+
+    @ti.kernel
+    def export(self, out: ti.types.ndarray(dtype=ti.f32, ndim=3)):
+        for s, i in ti.ndrange(self.nb_system, self.nb_body):
+            for c in ti.static(range(3)):
+                out[s, i, c] = self.pos[s, i][c]
+                out[s, i, 3 + c] = self.vel[s, i][c]
+
+    def state(self, out=None):
+        # -> (nb_system, nb_body, 6) positions, velocities in a single array
+        if out is None:
+            out = np.empty((self.nb_system, self.nb_body, 6), dtype='f4')
+        self.export(out)
+        return out
+
+# -----------------------------------------------------------------------------------------------------------
+
+def parameter_grid(dts, epss, nb_seed, seed=0):
+    # cartesian product dt x eps x seeds -> (dt, eps, seed) arrays, one entry per system
+    rows = list(itertools.product(dts, epss, range(seed, seed + nb_seed)))
+    dt, eps, seeds = (np.array(column) for column in zip(*rows))
+    return dt, eps, seeds
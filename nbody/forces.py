@@ -0,0 +1,255 @@
+import numpy as np
+import taichi as ti
+
+from nbody.barnes_hut import BarnesHut
+from nbody.pm import ParticleMesh
+
+# -----------------------------------------------------------------------------------------------------------
+# force solvers registry, a solver is built with the system and fills system.acc in compute(eps, with_pot)
+# for the active bodies system.target_begin .. target_end (all of them, except in distributed workers),
+# with_pot (compile time) also fills system.pot with the softened potential -sum m_j / sqrt(r^2 + eps^2)
+# in the same loop. The acc arithmetic is the same in both variants.
+#
+#   "direct" : O(N^2), the accuracy reference
+#   "tiled"  : O(N^2) symmetric, each pair computed once
+#   "bh"     : Barnes-Hut octree O(N log N)
+#   "pm"     : particle-mesh, FFT Poisson solve on a grid^3 mesh, isolated or periodic
+
+FORCES = {}
+
+def register_force(name):
+    def register(cls):
+        FORCES[name] = cls
+        return cls
+    return register
+
+# bodies per tile for the "tiled" solver: a pair of tiles (pos + acc) stays in L1
+TILE = 128
+
+# bodies per register block of the "tiled" solver, the f32 SIMD width of the CPU target (SSE2: 4)
+LANES = 4
+
+# position of the padding lanes of a partial block (zero mass): far from every body, no 0 / 0 even with eps = 0
+FAR = 1e10
+
+# -----------------------------------------------------------------------------------------------------------
+
+@register_force("direct")
+@ti.data_oriented
+class DirectForce:
+    def __init__(self, system):
+        self.system = system
+
+    @ti.kernel
+    def compute(self, eps: ti.f32, with_pot: ti.template()):
+        # ! only the outer loop is optimized => avoid nested for loops
+        #for i, j in ti.ndrange(self.nb_body, self.nb_body):
+        for i in range(self.system.target_begin, self.system.target_stop()):
+            acc = ti.Vector([0.0, 0.0, 0.0])
+            pot = 0.0
+            p_i, _ = self.system.source(i)
+
+            for j in range(self.system.nb_active[None]):
+                if i != j:
+                    p_j, m_j = self.system.source(j)
+
+                    DR = p_j - p_i
+                    DR2 = ti.math.dot(DR, DR)
+                    DR2 += eps * eps
+
+                    PHI = m_j / (ti.sqrt(DR2) * DR2)
+
+                    acc += DR * PHI
+
+                    if ti.static(with_pot):
+                        pot -= m_j / ti.sqrt(DR2)
+
+            self.system.acc[i] = acc
+
+            if ti.static(with_pot):
+                self.system.pot[i] = pot
+
+# -----------------------------------------------------------------------------------------------------------
+# Newton's third law: each unordered pair is computed once and accumulated into both bodies.
+#
+# The bodies are read in blocks of LANES as component vectors (x, y, z, m), LLVM maps them to SIMD registers.
+# A block of tile i against a block of tile j is computed in LANES rotations: lane b of rotation r pairs
+# body i0 + b with body j0 + (b + r) % LANES, so both sides accumulate lane-wise in registers and acc / pot
+# of a block are written once per block pair, not per pair (the direct kernel is vectorized over j by LLVM,
+# a per pair read-modify-write of acc[j] would cost more than the halved pair count saves).
+# acc[j] is written with a plain load/store (not +=, which would be atomic), races are avoided by the schedule.
+# Only the tiles of the active bodies are scheduled (the slots after nb_active are empty, see
+# NBodySystem.set_active), the schedule is computed in the kernels from their count: no recompile when it changes
+
+@register_force("tiled")
+@ti.data_oriented
+class TiledForce:
+    def __init__(self, system, tile=TILE):
+        self.system = system
+
+        if (system.target_begin, system.target_end) != (0, system.nb_body):
+            raise ValueError("Solver tiled computes the pairs of every body, it cannot be restricted to targets")
+        if tile % LANES:
+            raise ValueError("Tile %d is not a multiple of %d bodies" % (tile, LANES))
+
+        self.tile = tile
+
+    # round-robin schedule (circle method) of the tile pairs: in a round every tile appears at most once,
+    # so the pairs of a round can update both of their tiles in parallel without atomics. n is the tile
+    # count rounded up to even (an odd count gets a dummy tile, a bye), -1 for the pairs with the dummy
+    @ti.func
+    def tile_pair(self, r, p, n, nb_tile):
+        tile_i, tile_j = r, n - 1
+        if p > 0:
+            tile_i, tile_j = (r + p) % (n - 1), (r - p + n - 1) % (n - 1)
+        if tile_i >= nb_tile or tile_j >= nb_tile:
+            tile_i, tile_j = -1, -1
+        return tile_i, tile_j
+
+    @ti.func
+    def load(self, k0, end):
+        x = ti.Vector([FAR] * LANES)
+        y = ti.Vector([FAR] * LANES)
+        z = ti.Vector([FAR] * LANES)
+        m = ti.Vector([0.0] * LANES)
+
+        for b in ti.static(range(LANES)):
+            if k0 + b < end:
+                p, m_b = self.system.source(k0 + b)
+                x[b], y[b], z[b], m[b] = p[0], p[1], p[2], m_b
+
+        return x, y, z, m
+
+    @ti.func
+    def store(self, k0, end, ax, ay, az, pot, with_pot: ti.template()):
+        for b in ti.static(range(LANES)):
+            if k0 + b < end:
+                self.system.acc[k0 + b] = self.system.acc[k0 + b] + ti.Vector([ax[b], ay[b], az[b]])
+                if ti.static(with_pot):
+                    self.system.pot[k0 + b] = self.system.pot[k0 + b] + pot[b]
+
+    # lane b <- lane (b + r) % LANES
+    @ti.func
+    def rotate(self, v, r: ti.template()):
+        return ti.Vector([v[(b + r) % LANES] for b in ti.static(range(LANES))])
+
+    @ti.func
+    def inner(self, eps, i0, end, with_pot: ti.template()):
+        # the pairs inside the block i0, both orders (the block is its own j side)
+        x, y, z, m = self.load(i0, end)
+
+        ax = ti.Vector([0.0] * LANES)
+        ay = ti.Vector([0.0] * LANES)
+        az = ti.Vector([0.0] * LANES)
+        pot = ti.Vector([0.0] * LANES)
+
+        for r in ti.static(range(1, LANES)):
+            dx = self.rotate(x, r) - x
+            dy = self.rotate(y, r) - y
+            dz = self.rotate(z, r) - z
+            m_j = self.rotate(m, r)
+
+            DR2 = dx * dx + dy * dy + dz * dz + eps * eps
+            PHI = m_j / (ti.sqrt(DR2) * DR2)
+
+            ax += dx * PHI
+            ay += dy * PHI
+            az += dz * PHI
+
+            if ti.static(with_pot):
+                pot -= m_j / ti.sqrt(DR2)
+
+        self.store(i0, end, ax, ay, az, pot, with_pot)
+
+    @ti.func
+    def row(self, eps, i0, end_i, j0, end_j, with_pot: ti.template()):
+        # the block i0 against the blocks j0, j0 + LANES... < end_j, disjoint from it
+        x, y, z, m_i = self.load(i0, end_i)
+
+        ax = ti.Vector([0.0] * LANES)
+        ay = ti.Vector([0.0] * LANES)
+        az = ti.Vector([0.0] * LANES)
+        pot_i = ti.Vector([0.0] * LANES)
+
+        for k in range((end_j - j0 + LANES - 1) // LANES):
+            k0 = j0 + k * LANES
+            xj, yj, zj, m_j = self.load(k0, end_j)
+
+            bx = ti.Vector([0.0] * LANES)
+            by = ti.Vector([0.0] * LANES)
+            bz = ti.Vector([0.0] * LANES)
+            pot_j = ti.Vector([0.0] * LANES)
+
+            for r in ti.static(range(LANES)):
+                dx = self.rotate(xj, r) - x
+                dy = self.rotate(yj, r) - y
+                dz = self.rotate(zj, r) - z
+
+                DR2 = dx * dx + dy * dy + dz * dz + eps * eps
+                PHI = 1.0 / (ti.sqrt(DR2) * DR2)
+
+                f_i = PHI * self.rotate(m_j, r)
+                f_j = PHI * m_i
+
+                ax += dx * f_i
+                ay += dy * f_i
+                az += dz * f_i
+
+                # back to the lanes of the j block
+                bx -= self.rotate(dx * f_j, LANES - r)
+                by -= self.rotate(dy * f_j, LANES - r)
+                bz -= self.rotate(dz * f_j, LANES - r)
+
+                if ti.static(with_pot):
+                    INV_R = 1.0 / ti.sqrt(DR2)
+                    pot_i -= INV_R * self.rotate(m_j, r)
+                    pot_j -= self.rotate(INV_R * m_i, LANES - r)
+
+            self.store(k0, end_j, bx, by, bz, pot_j, with_pot)
+
+        self.store(i0, end_i, ax, ay, az, pot_i, with_pot)
+
+    @ti.kernel
+    def diagonal(self, eps: ti.f32, nb_tile: ti.i32, tile: ti.i32, with_pot: ti.template()):
+        n_active = self.system.nb_active[None]
+
+        for i in range(n_active):
+            self.system.acc[i] = [0.0, 0.0, 0.0]
+            if ti.static(with_pot):
+                self.system.pot[i] = 0.0
+
+        # pairs inside a tile, the blocks of a tile one after the other
+        for t in range(nb_tile):
+            end = ti.min((t + 1) * tile, n_active)
+
+            for k in range((end - t * tile + LANES - 1) // LANES):
+                i0 = t * tile + k * LANES
+                self.inner(eps, i0, end, with_pot)
+                self.row(eps, i0, end, i0 + LANES, end, with_pot)
+
+    @ti.kernel
+    def round(self, eps: ti.f32, r: ti.i32, nb_tile: ti.i32, tile: ti.i32, with_pot: ti.template()):
+        n_active = self.system.nb_active[None]
+        n = nb_tile + nb_tile % 2
+
+        for p in range(n // 2):
+            tile_i, tile_j = self.tile_pair(r, p, n, nb_tile)
+
+            if tile_i >= 0:
+                end_i = ti.min((tile_i + 1) * tile, n_active)
+                end_j = ti.min((tile_j + 1) * tile, n_active)
+
+                for k in range((end_i - tile_i * tile + LANES - 1) // LANES):
+                    self.row(eps, tile_i * tile + k * LANES, end_i, tile_j * tile, end_j, with_pot)
+
+    def compute(self, eps, with_pot=False):
+        nb_tile = (self.system.n_active + self.tile - 1) // self.tile
+        self.diagonal(eps, nb_tile, self.tile, with_pot)
+
+        for r in range(nb_tile + nb_tile % 2 - 1):
+            self.round(eps, r, nb_tile, self.tile, with_pot)
+
+# -----------------------------------------------------------------------------------------------------------
+
+register_force("bh")(BarnesHut)
+register_force("pm")(ParticleMesh)
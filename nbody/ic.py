@@ -0,0 +1,330 @@
+import hashlib, inspect, json, math, os, time
+
+import numpy as np
+
+# -----------------------------------------------------------------------------------------------------------
+# initial conditions, vectorised numpy generators in G = 1 units
+#
+# a generator is gen(n, rng, mass, scale, **params) -> (pos, vel, mass) float64 arrays (n, 3), (n, 3), (n,),
+# `mass` is the total mass (None: 1 per body, like the cube) and `scale` the half width of the default cube:
+# the lengths default to fractions of it so every configuration fits the same view. The result is centered
+# on the center of mass, with no net momentum.
+#
+#   "cube"      : uniform random cube at rest, in a kernel with the Taichi RNG (NBodySystem.init_cube)
+#   "plummer"   : Plummer sphere, isotropic, in equilibrium
+#   "hernquist" : Hernquist sphere, isotropic, in equilibrium
+#   "king"      : King (lowered isothermal) sphere of concentration W0, in equilibrium
+#   "disk"      : exponential disk + Plummer bulge, in rotation on circular orbits
+#   "collision" : two galaxies (disk or plummer) on a parabolic encounter
+#
+# the sets are cached as .npy (pos, vel, mass float32 columns) keyed by (generator, params, N, seed)
+
+IC_GENERATORS = {}
+
+def register_ic(name):
+    def register(fn):
+        IC_GENERATORS[name] = fn
+        return fn
+    return register
+
+# bumped when a generator changes, so stale cache entries are not loaded
+IC_VERSION = 1
+
+# the outermost mass fraction is dropped (a few bodies at huge radii otherwise)
+MAX_MASS_FRACTION = 0.99
+
+# velocity sampling: rejection per chunk of bodies
+CHUNK = 65536
+
+def isotropic(rng, n):
+    u = rng.standard_normal((n, 3))
+    return u / np.linalg.norm(u, axis=1, keepdims=True)
+
+def escape_fractions(rng, psi, df):
+    # speed / escape speed of bodies at relative potentials psi, for an isotropic distribution function
+    # df(relative energy): the density of s = v / v_esc is s^2 df(psi (1 - s^2)), sampled by rejection
+    # under its maximum (on a log grid, the peak is close to 0 in the cores)
+    s_grid = np.geomspace(1e-4, 1.0, 128, endpoint=False)
+
+    s = np.empty(len(psi))
+
+    for start in range(0, len(psi), CHUNK):
+        p = psi[start:start + CHUNK, None]
+        g_max = 1.1 * np.max(s_grid ** 2 * df(p * (1.0 - s_grid ** 2)), axis=1)
+
+        out = s[start:start + CHUNK]
+        todo = np.arange(len(out))
+
+        while len(todo):
+            x = rng.random(len(todo))
+            y = rng.random(len(todo)) * g_max[todo]
+            accept = y < x * x * df(p[todo, 0] * (1.0 - x * x))
+            out[todo[accept]] = x[accept]
+            todo = todo[~accept]
+
+    return s
+
+def center(pos, vel, mass):
+    m = mass[:, None] / mass.sum()
+    return pos - (pos * m).sum(axis=0), vel - (vel * m).sum(axis=0)
+
+def total_mass(mass, n):
+    return float(n) if mass is None else float(mass)
+
+# -----------------------------------------------------------------------------------------------------------
+
+@register_ic("plummer")
+def plummer(n, rng, mass=None, scale=8.0, a=None):
+    M = total_mass(mass, n)
+    a = 0.25 * scale if a is None else a
+
+    X = rng.random(n) * MAX_MASS_FRACTION
+    r = a / np.sqrt(X ** (-2.0 / 3.0) - 1.0)
+
+    psi = M / np.sqrt(r * r + a * a)
+    s = escape_fractions(rng, psi, lambda e: np.maximum(e, 0.0) ** 3.5)
+
+    pos = isotropic(rng, n) * r[:, None]
+    vel = isotropic(rng, n) * (s * np.sqrt(2.0 * psi))[:, None]
+    m = np.full(n, M / n)
+
+    return center(pos, vel, m) + (m,)
+
+@register_ic("hernquist")
+def hernquist(n, rng, mass=None, scale=8.0, a=None):
+    M = total_mass(mass, n)
+    a = 0.125 * scale if a is None else a
+
+    # M(r) = M r^2 / (r + a)^2
+    X = np.sqrt(rng.random(n) * MAX_MASS_FRACTION)
+    r = a * X / (1.0 - X)
+
+    # Hernquist 1990, eq. 17 (up to a constant), of q^2 = E a / (G M)
+    def df(e):
+        q2 = np.clip(e, 0.0, 1.0 - 1e-12)
+        q = np.sqrt(q2)
+        return (3.0 * np.arcsin(q) + q * np.sqrt(1.0 - q2) * (1.0 - 2.0 * q2) * (8.0 * q2 * q2 - 8.0 * q2 - 3.0)) / (1.0 - q2) ** 2.5
+
+    psi = a / (r + a)
+    s = escape_fractions(rng, psi, df)
+
+    pos = isotropic(rng, n) * r[:, None]
+    vel = isotropic(rng, n) * (s * np.sqrt(2.0 * psi * M / a))[:, None]
+    m = np.full(n, M / n)
+
+    return center(pos, vel, m) + (m,)
+
+def king_profile(W0, h=0.002):
+    # dimensionless King model (sigma = G = r0 = 1, rho0 = 9 / 4 pi): W(r) and M(r) out to the tidal radius.
+    # RK4 in ln r of W'' + 2 W' / r = -9 rho(W) / rho(W0)
+    def rho(W):
+        W = max(W, 0.0)
+        return math.exp(W) * math.erf(math.sqrt(W)) - math.sqrt(4.0 * W / math.pi) * (1.0 + 2.0 * W / 3.0)
+
+    rho0 = rho(W0)
+
+    def deriv(t, y):
+        r = math.exp(t)
+        W, p = y
+        return (r * p, -9.0 * r * rho(W) / rho0 - 2.0 * p)
+
+    # series at the center: W = W0 - 1.5 r^2
+    t = math.log(1e-3)
+    y = (W0 - 1.5e-6, -3e-3)
+    rs, Ws, ps = [math.exp(t)], [y[0]], [y[1]]
+
+    while y[0] > 0.0:
+        k1 = deriv(t, y)
+        k2 = deriv(t + h / 2, (y[0] + h / 2 * k1[0], y[1] + h / 2 * k1[1]))
+        k3 = deriv(t + h / 2, (y[0] + h / 2 * k2[0], y[1] + h / 2 * k2[1]))
+        k4 = deriv(t + h, (y[0] + h * k3[0], y[1] + h * k3[1]))
+        y = (y[0] + h / 6 * (k1[0] + 2 * k2[0] + 2 * k3[0] + k4[0]), y[1] + h / 6 * (k1[1] + 2 * k2[1] + 2 * k3[1] + k4[1]))
+        t += h
+        rs.append(math.exp(t))
+        Ws.append(y[0])
+        ps.append(y[1])
+
+    r, W, p = np.array(rs), np.maximum(np.array(Ws), 0.0), np.array(ps)
+
+    # G M(r) = -r^2 dPhi/dr, with W = (Phi(rt) - Phi) / sigma^2
+    return r, W, -r * r * p
+
+@register_ic("king")
+def king(n, rng, mass=None, scale=8.0, W0=6.0, rt=None):
+    M = total_mass(mass, n)
+    rt = scale if rt is None else rt
+
+    r_k, W_k, M_k = king_profile(W0)
+
+    # tidal radius -> rt, total mass -> M
+    length, mass_unit = rt / r_k[-1], M / M_k[-1]
+    velocity = math.sqrt(mass_unit / length)
+
+    X = rng.random(n) * M_k[-1]
+    r = np.interp(X, M_k, r_k)
+    W = np.interp(r, r_k, W_k)
+
+    s = escape_fractions(rng, W, lambda e: np.expm1(np.maximum(e, 0.0)))
+
+    pos = isotropic(rng, n) * (r * length)[:, None]
+    vel = isotropic(rng, n) * (s * np.sqrt(2.0 * W) * velocity)[:, None]
+    m = np.full(n, M / n)
+
+    return center(pos, vel, m) + (m,)
+
+@register_ic("disk")
+def disk(n, rng, mass=None, scale=8.0, rd=None, z0=None, bulge=0.2, sigma=0.05, eps=0.0):
+    # exponential surface density of scale length rd, sech^2 vertical profile of scale height z0, `bulge` of
+    # the mass in a Plummer bulge of radius rd / 5. The disk bodies are on circular orbits (the enclosed mass
+    # taken spherical, softened by eps) + a `sigma` fraction of the circular speed of isotropic dispersion
+    M = total_mass(mass, n)
+    rd = 0.25 * scale if rd is None else rd
+    z0 = 0.1 * rd if z0 is None else z0
+
+    nb_bulge = int(round(n * bulge))
+    nb_disk = n - nb_bulge
+
+    # M(<R) / M = 1 - (1 + x) exp(-x), x = R / rd, inverted on a table
+    x = np.linspace(0.0, 20.0, 4096)
+    X = rng.random(nb_disk) * MAX_MASS_FRACTION
+    R = np.interp(X, 1.0 - (1.0 + x) * np.exp(-x), x) * rd
+
+    phi = rng.random(nb_disk) * 2.0 * math.pi
+    z = z0 * np.arctanh(2.0 * rng.random(nb_disk) * MAX_MASS_FRACTION - MAX_MASS_FRACTION)
+
+    pos = np.empty((n, 3))
+    vel = np.zeros((n, 3))
+    m = np.full(n, M / n)
+
+    pos[:nb_disk] = np.stack([R * np.cos(phi), z, R * np.sin(phi)], axis=1)
+
+    if nb_bulge:
+        bulge_pos, bulge_vel, _ = plummer(nb_bulge, rng, mass=M * nb_bulge / n, a=0.2 * rd)
+        pos[nb_disk:], vel[nb_disk:] = bulge_pos, bulge_vel
+
+    # circular speed from the mass inside the spherical radius of each body
+    r = np.linalg.norm(pos, axis=1)
+    order = np.argsort(r)
+    enclosed = np.empty(n)
+    enclosed[order] = np.cumsum(m[order])
+
+    rr = r[:nb_disk]
+    vc = np.sqrt(enclosed[:nb_disk] * rr * rr / (rr * rr + eps * eps) ** 1.5)
+
+    # rotation in the disk plane (y up, like the camera)
+    vel[:nb_disk] = np.stack([-np.sin(phi), np.zeros(nb_disk), np.cos(phi)], axis=1) * vc[:, None]
+    vel[:nb_disk] += rng.standard_normal((nb_disk, 3)) * (sigma * vc)[:, None]
+
+    return center(pos, vel, m) + (m,)
+
+@register_ic("collision")
+def collision(n, rng, mass=None, scale=8.0, galaxy="disk", ratio=1.0, distance=None, impact=None, speed=1.0, incline=30.0, eps=0.0):
+    # two galaxies of masses 1 : ratio (same body mass), `distance` apart along x with an `impact` parameter
+    # along z, approaching at `speed` times the parabolic speed. The second one is tilted by `incline` degrees
+    # around x.
+    M = total_mass(mass, n)
+    distance = 2.0 * scale if distance is None else distance
+    impact = 0.25 * scale if impact is None else impact
+
+    if galaxy not in ("disk", "plummer"):
+        raise ValueError("Unknown collision galaxy %s, expected one of %s" % (galaxy, ("disk", "plummer")))
+
+    n1 = int(round(n / (1.0 + ratio)))
+    n2 = n - n1
+    M1, M2 = M * n1 / n, M * n2 / n
+
+    # each galaxy at half the scale
+    kwargs = {"eps": eps} if galaxy == "disk" else {}
+    p1, v1, m1 = IC_GENERATORS[galaxy](n1, rng, mass=M1, scale=0.5 * scale, **kwargs)
+    p2, v2, m2 = IC_GENERATORS[galaxy](n2, rng, mass=M2, scale=0.5 * scale, **kwargs)
+
+    c, s = math.cos(math.radians(incline)), math.sin(math.radians(incline))
+    tilt = np.array([[1.0, 0.0, 0.0], [0.0, c, -s], [0.0, s, c]])
+    p2, v2 = p2 @ tilt.T, v2 @ tilt.T
+
+    # relative orbit, each galaxy moves around the common center of mass
+    offset = np.array([distance, 0.0, impact])
+    v_rel = np.array([-speed * math.sqrt(2.0 * M / np.linalg.norm(offset)), 0.0, 0.0])
+
+    pos = np.concatenate([p1 - offset * M2 / M, p2 + offset * M1 / M])
+    vel = np.concatenate([v1 - v_rel * M2 / M, v2 + v_rel * M1 / M])
+    m = np.concatenate([m1, m2])
+
+    return center(pos, vel, m) + (m,)
+
+# "cube" is not a generator here, see the header
+ICS = ("cube",) + tuple(IC_GENERATORS)
+
+# -----------------------------------------------------------------------------------------------------------
+
+def parse_ic_params(text):
+    # "a=2,W0=7" -> {"a": 2.0, "W0": 7.0}, non numbers are kept as strings (galaxy=plummer)
+    params = {}
+
+    for item in filter(None, (text or "").split(",")):
+        key, _, value = item.partition("=")
+        try:
+            params[key.strip()] = float(value)
+        except ValueError:
+            params[key.strip()] = value.strip()
+
+    return params
+
+def ic_cache_path(cache_dir, name, n, seed, params):
+    key = json.dumps({"version": IC_VERSION, "generator": name, "n": n, "seed": seed, "params": params}, sort_keys=True)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "%s-%d-%d-%s.npy" % (name, n, seed, digest))
+
+def make_ic(name, n, seed=0, params=None, scale=8.0, cache_dir=None, verbose=True):
+    # -> (pos, vel, mass) float32, from the cache when there (cache_dir None / "" = no cache)
+    if name not in IC_GENERATORS:
+        raise ValueError("Unknown initial conditions %s, expected one of %s" % (name, tuple(IC_GENERATORS)))
+
+    generator = IC_GENERATORS[name]
+
+    params = dict(params or {})
+    unknown = set(params) - set(inspect.signature(generator).parameters) - {"mass"}
+    if unknown:
+        raise ValueError("Unknown %s parameters %s" % (name, sorted(unknown)))
+
+    params.setdefault("scale", scale)
+
+    path = ic_cache_path(cache_dir, name, n, seed, params) if cache_dir else None
+
+    t0 = time.perf_counter()
+
+    if path and os.path.exists(path):
+        data = np.load(path)
+        source = "loaded from " + path
+    else:
+        pos, vel, mass = generator(n, np.random.default_rng(seed), **params)
+        data = np.concatenate([pos, vel, mass[:, None]], axis=1).astype('f4')
+        source = "generated"
+
+        if path:
+            # written next to the target then renamed over it, like the checkpoints
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, data)
+            os.replace(tmp, path)
+            source += ", cached in " + path
+
+    if verbose:
+        print("initial conditions %s (%d bodies, seed %d): %s in %.3f s" % (name, n, seed, source, time.perf_counter() - t0))
+
+    return np.ascontiguousarray(data[:, 0:3]), np.ascontiguousarray(data[:, 3:6]), np.ascontiguousarray(data[:, 6])
+
+def cube_ic(n, seed=0, scale=8.0):
+    # numpy version of the "cube" (the kernel one follows the Taichi RNG of the process)
+    pos = np.random.default_rng(seed).uniform(-scale, scale, (n, 3)).astype('f4')
+    return pos, np.zeros_like(pos), np.ones(n, dtype='f4')
+
+def cluster_ic(n, rng, scale=8.0, center=(0.0, 0.0, 0.0), velocity=(0.0, 0.0, 0.0), a=None):
+    # a small Plummer cluster (unit masses) at center moving at velocity, added to a running simulation
+    # (NBodySystem.add_bodies)
+    pos, vel, mass = plummer(n, rng, scale=scale, a=0.05 * scale if a is None else a)
+    return (pos + center).astype('f4'), (vel + velocity).astype('f4'), mass.astype('f4')
+
+def default_ic_cache():
+    return os.path.join(os.path.expanduser("~"), ".cache", "nbody", "ic")
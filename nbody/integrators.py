@@ -0,0 +1,336 @@
+import taichi as ti
+
+# -----------------------------------------------------------------------------------------------------------
+# integrators registry, an integrator is built with the system and advances it by dt in step(dt, eps)
+#
+# force_evals is the number of force computations per step, to compare accuracy per force evaluation.
+# synced_forces: the last force computation of a step is at the final positions (free potential energy)
+# uses_kick_drift: pos / vel are only updated by the system kick / drift kernels (precision policies)
+#   "kdk"      : leapfrog kick-drift-kick, 2nd order, 1 force eval (acc reused from the previous step)
+#   "dkd"      : leapfrog drift-kick-drift, 2nd order, 1 force eval
+#   "yoshida4" : Yoshida 4th order symplectic (3 leapfrogs), 3 force evals
+#   "rk4"      : classic Runge-Kutta 4th order (not symplectic), 4 force evals
+
+INTEGRATORS = {}
+
+def register_integrator(name):
+    def register(cls):
+        INTEGRATORS[name] = cls
+        return cls
+    return register
+
+# -----------------------------------------------------------------------------------------------------------
+
+@register_integrator("kdk")
+class LeapfrogKDK:
+    force_evals = 1
+    synced_forces = True
+    uses_kick_drift = True
+
+    def __init__(self, system):
+        self.system = system
+        self.primed = False
+
+    def reset(self):
+        self.primed = False
+
+    def step(self, dt, eps):
+        # the first half kick needs the forces at the current positions
+        if not self.primed:
+            self.system.compute_forces(eps)
+            self.primed = True
+
+        self.system.kick_drift(dt * 0.5, dt)
+        self.system.compute_forces(eps)
+        self.system.kick(dt * 0.5)
+
+@register_integrator("dkd")
+class LeapfrogDKD:
+    force_evals = 1
+    uses_kick_drift = True
+
+    def __init__(self, system):
+        self.system = system
+
+    def reset(self):
+        pass
+
+    def step(self, dt, eps):
+        self.system.drift(dt * 0.5)
+        self.system.compute_forces(eps)
+        self.system.kick_drift(dt, dt * 0.5)
+
+@register_integrator("yoshida4")
+class Yoshida4:
+    force_evals = 3
+    uses_kick_drift = True
+
+    W0 = -2.0 ** (1.0 / 3.0) / (2.0 - 2.0 ** (1.0 / 3.0))
+    W1 = 1.0 / (2.0 - 2.0 ** (1.0 / 3.0))
+
+    C = (W1 * 0.5, (W0 + W1) * 0.5, (W0 + W1) * 0.5, W1 * 0.5) # drifts
+    D = (W1, W0, W1)                                           # kicks
+
+    def __init__(self, system):
+        self.system = system
+
+    def reset(self):
+        pass
+
+    def step(self, dt, eps):
+        self.system.drift(self.C[0] * dt)
+
+        for k in range(3):
+            self.system.compute_forces(eps)
+            self.system.kick_drift(self.D[k] * dt, self.C[k + 1] * dt)
+
+@register_integrator("rk4")
+@ti.data_oriented
+class RK4:
+    force_evals = 4
+
+    def __init__(self, system):
+        self.system = system
+
+        self.pos0 = ti.Vector.field(3, dtype=ti.f32, shape=system.nb_body)
+        self.vel0 = ti.Vector.field(3, dtype=ti.f32, shape=system.nb_body)
+        self.dpos = ti.Vector.field(3, dtype=ti.f32, shape=system.nb_body)
+        self.dvel = ti.Vector.field(3, dtype=ti.f32, shape=system.nb_body)
+
+    def reset(self):
+        pass
+
+    @ti.kernel
+    def save(self):
+        for i in range(self.system.nb_active[None]):
+            self.pos0[i] = self.system.pos[i]
+            self.vel0[i] = self.system.vel[i]
+            self.dpos[i] = [0.0, 0.0, 0.0]
+            self.dvel[i] = [0.0, 0.0, 0.0]
+
+    # accumulate k_n = (vel, acc) with weight w, then move to the next stage state x0 + h * k_n
+    @ti.kernel
+    def stage(self, w: ti.f32, h: ti.f32):
+        for i in range(self.system.nb_active[None]):
+            v = self.system.vel[i]
+            a = self.system.acc[i]
+
+            self.dpos[i] += v * w
+            self.dvel[i] += a * w
+
+            self.system.pos[i] = self.pos0[i] + v * h
+            self.system.vel[i] = self.vel0[i] + a * h
+
+    @ti.kernel
+    def finish(self, dt: ti.f32):
+        for i in range(self.system.nb_active[None]):
+            self.system.pos[i] = self.pos0[i] + (self.dpos[i] + self.system.vel[i]) * (dt / 6.0)
+            self.system.vel[i] = self.vel0[i] + (self.dvel[i] + self.system.acc[i]) * (dt / 6.0)
+
+    def step(self, dt, eps):
+        self.save()
+
+        for w, h in ((1.0, 0.5), (2.0, 0.5), (2.0, 1.0)):
+            self.system.compute_forces(eps)
+            self.stage(w, h * dt)
+
+        self.system.compute_forces(eps)
+        self.finish(dt)
+
+# -----------------------------------------------------------------------------------------------------------
+# 4th order Hermite predictor-corrector with individual block timesteps (Makino & Aarseth 1992)
+#
+# a step(dt) is split in 2^MAX_LEVEL integer ticks, every body has its own power of two timestep dt_i <= dt
+# (in ticks). A substep only computes acc + jerk for the "active" bodies (t_i + dt_i == t_next), all the
+# other bodies are predicted to t_next. All the bodies are synchronized again at the end of step(dt).
+#
+# forces + jerk are computed here by direct summation (the system solver is not used)
+
+@register_integrator("hermite")
+@ti.data_oriented
+class Hermite:
+
+    MAX_LEVEL = 20
+    END = 1 << MAX_LEVEL
+
+    ETA = 0.02   # Aarseth timestep criterion
+    ETA_S = 0.01 # starting timestep |a| / |j|
+
+    # saved / restored by the checkpoints
+    state_fields = ("jerk", "t_body", "dt_body", "t_next")
+
+    def __init__(self, system):
+        self.system = system
+
+        n = system.nb_body
+
+        self.jerk      = ti.Vector.field(3, dtype=ti.f32, shape=n)
+        self.pred_pos  = ti.Vector.field(3, dtype=ti.f32, shape=n)
+        self.pred_vel  = ti.Vector.field(3, dtype=ti.f32, shape=n)
+        self.new_acc   = ti.Vector.field(3, dtype=ti.f32, shape=n)
+        self.new_jerk  = ti.Vector.field(3, dtype=ti.f32, shape=n)
+
+        self.t_body    = ti.field(dtype=ti.i32, shape=n) # ticks
+        self.dt_body   = ti.field(dtype=ti.i32, shape=n) # ticks, power of two
+
+        self.active    = ti.field(dtype=ti.i32, shape=n)
+        self.nb_active = ti.field(dtype=ti.i32, shape=())
+        self.t_next    = ti.field(dtype=ti.i32, shape=())
+        self.evals     = ti.field(dtype=ti.i32, shape=()) # body force evaluations during the current step
+
+        self.primed = False
+
+        # stats: body force evaluations (1 = N - 1 pair interactions) and block substeps
+        self.body_evals = 0
+        self.substeps = 0
+        self.steps = 0
+
+        # active bodies summed over the steps (the count changes with merges / added bodies)
+        self.body_steps = 0
+
+    def reset(self):
+        self.primed = False
+
+    # average number of full force evaluations (the active bodies) per step
+    @property
+    def force_evals(self):
+        if self.body_steps == 0:
+            return 1.0
+        return self.body_evals / self.body_steps
+
+    @ti.func
+    def acc_jerk(self, i, eps):
+        acc = ti.Vector([0.0, 0.0, 0.0])
+        jerk = ti.Vector([0.0, 0.0, 0.0])
+
+        for j in range(self.system.nb_active[None]):
+            if i != j:
+                DR = self.pred_pos[j] - self.pred_pos[i]
+                DV = self.pred_vel[j] - self.pred_vel[i]
+                DR2 = ti.math.dot(DR, DR) + eps * eps
+
+                PHI = self.system.mass[j] / (ti.sqrt(DR2) * DR2)
+                RV = 3.0 * ti.math.dot(DR, DV) / DR2
+
+                acc += DR * PHI
+                jerk += (DV - DR * RV) * PHI
+
+        return acc, jerk
+
+    @ti.func
+    def find_t_next(self):
+        self.t_next[None] = 2 * self.END + 1
+        for i in range(self.system.nb_active[None]):
+            ti.atomic_min(self.t_next[None], self.t_body[i] + self.dt_body[i])
+
+    @ti.kernel
+    def start(self, eps: ti.f32, tick: ti.f32):
+        for i in range(self.system.nb_active[None]):
+            self.pred_pos[i] = self.system.pos[i]
+            self.pred_vel[i] = self.system.vel[i]
+
+        for i in range(self.system.nb_active[None]):
+            acc, jerk = self.acc_jerk(i, eps)
+            self.system.acc[i] = acc
+            self.jerk[i] = jerk
+
+            # cold start (bodies at rest => no jerk): also bounded by the time to move by ~eps
+            dt = ti.min(self.ETA_S * acc.norm() / (jerk.norm() + 1e-30), ti.sqrt(self.ETA_S * eps / (acc.norm() + 1e-30)))
+
+            ticks = self.END
+            while ticks > 1 and ticks * tick > dt:
+                ticks //= 2
+
+            self.t_body[i] = 0
+            self.dt_body[i] = ticks
+
+        self.find_t_next()
+
+    @ti.kernel
+    def substep(self, eps: ti.f32, tick: ti.f32):
+        t = self.t_next[None]
+
+        self.nb_active[None] = 0
+        for i in range(self.system.nb_active[None]):
+            if self.t_body[i] + self.dt_body[i] == t:
+                self.active[ti.atomic_add(self.nb_active[None], 1)] = i
+
+        # predict everybody to t
+        for i in range(self.system.nb_active[None]):
+            h = (t - self.t_body[i]) * tick
+            a = self.system.acc[i]
+            j = self.jerk[i]
+
+            self.pred_pos[i] = self.system.pos[i] + (self.system.vel[i] + (a * 0.5 + j * (h / 6.0)) * h) * h
+            self.pred_vel[i] = self.system.vel[i] + (a + j * (h * 0.5)) * h
+
+        for k in range(self.nb_active[None]):
+            i = self.active[k]
+            self.new_acc[i], self.new_jerk[i] = self.acc_jerk(i, eps)
+
+        self.evals[None] += self.nb_active[None]
+
+        # correct the active bodies, then pick their next timestep level
+        for k in range(self.nb_active[None]):
+            i = self.active[k]
+
+            ticks = self.dt_body[i]
+            h = ticks * tick
+
+            a0, j0 = self.system.acc[i], self.jerk[i]
+            a1, j1 = self.new_acc[i], self.new_jerk[i]
+
+            v1 = self.system.vel[i] + (a0 + a1) * (h * 0.5) + (j0 - j1) * (h * h / 12.0)
+            x1 = self.system.pos[i] + (self.system.vel[i] + v1) * (h * 0.5) + (a0 - a1) * (h * h / 12.0)
+
+            # snap / crackle from the Hermite interpolation, at t
+            snap = (-6.0 * (a0 - a1) - h * (4.0 * j0 + 2.0 * j1)) / (h * h)
+            crackle = (12.0 * (a0 - a1) + 6.0 * h * (j0 + j1)) / (h * h * h)
+            snap += crackle * h
+
+            num = a1.norm() * snap.norm() + j1.norm_sqr()
+            den = j1.norm() * crackle.norm() + snap.norm_sqr()
+            dt = ti.sqrt(self.ETA * num / (den + 1e-30))
+
+            # halve as much as needed, double only once and when it stays aligned on the block grid
+            while ticks > 1 and ticks * tick > dt:
+                ticks //= 2
+            if ticks == self.dt_body[i] and ticks < self.END and 2 * ticks * tick <= dt and t % (2 * ticks) == 0:
+                ticks *= 2
+
+            self.system.pos[i] = x1
+            self.system.vel[i] = v1
+            self.system.acc[i] = a1
+            self.jerk[i] = j1
+
+            self.t_body[i] = t
+            self.dt_body[i] = ticks
+
+        self.find_t_next()
+
+    # everybody is at END: back to 0 for the next step
+    @ti.kernel
+    def rebase(self):
+        for i in range(self.system.nb_active[None]):
+            self.t_body[i] = 0
+
+        self.find_t_next()
+        self.evals[None] = 0
+
+    def step(self, dt, eps):
+        tick = dt / self.END
+
+        if not self.primed:
+            self.start(eps, tick)
+            self.body_evals += self.system.n_active
+            self.primed = True
+
+        while self.t_next[None] <= self.END:
+            self.substep(eps, tick)
+            self.substeps += 1
+
+        self.body_evals += self.evals[None]
+        self.body_steps += self.system.n_active
+        self.steps += 1
+
+        self.rebase()
@@ -0,0 +1,162 @@
+import numpy as np
+import taichi as ti
+
+# -----------------------------------------------------------------------------------------------------------
+# level of detail for the viewer, no GL here: positions in, at most `budget` vertices out
+#
+# the bodies are binned into a grid x grid x grid density grid over their bounding box, an occupied cell
+# becomes one impostor at its centre of mass with its body count as weight. The bodies closer than `radius`
+# to the camera are drawn one by one (weight 1) instead, as many as the budget leaves once every occupied
+# cell has its vertex. So:
+#
+#   vertices = near bodies + occupied cells <= budget    (grid^3 <= budget)
+#
+# the near radius follows the camera: it shrinks when the near bodies overflow their share of the budget
+# and grows back when they use less than LOW of it. Everything runs in a single kernel (its loops are
+# executed in order), only the vertex count is read back.
+
+# near bodies / near capacity band of the radius controller
+LOW, HIGH = 0.8, 1.0
+SHRINK, GROW = 0.85, 1.05
+
+# counters
+NEAR, NEAR_CAP, NB_VERTEX = 0, 1, 2
+
+@ti.data_oriented
+class LOD:
+
+    def __init__(self, budget, grid=64, radius=None):
+        self.budget = budget
+
+        # every occupied cell must fit in the budget
+        self.grid = max(1, min(grid, int(round(budget ** (1.0 / 3.0)))))
+        while self.grid ** 3 > budget:
+            self.grid -= 1
+
+        self.nb_cell = self.grid ** 3
+
+        self.cell_pos = ti.Vector.field(3, dtype=ti.f32, shape=self.nb_cell)
+        self.cell_mass = ti.field(dtype=ti.f32, shape=self.nb_cell)
+        self.cell_count = ti.field(dtype=ti.i32, shape=self.nb_cell)
+
+        self.bounds = ti.Vector.field(3, dtype=ti.f32, shape=2)
+        self.counters = ti.field(dtype=ti.i32, shape=3)
+
+        # default outputs, the first nb_vertex rows are valid
+        self.pos, self.weight = self.new_output()
+
+        # None: from the distance to the first bounding box
+        self.radius = radius
+
+        self.nb_near = 0
+        self.near_cap = 0
+        self.nb_vertex = 0
+
+    @ti.kernel
+    def build(self, pos: ti.types.ndarray(dtype=ti.math.vec3, ndim=1), mass: ti.types.ndarray(dtype=ti.f32, ndim=1),
+              cam_x: ti.f32, cam_y: ti.f32, cam_z: ti.f32, radius: ti.f32,
+              out_pos: ti.types.ndarray(dtype=ti.math.vec3, ndim=1), out_weight: ti.types.ndarray(dtype=ti.f32, ndim=1)):
+
+        self.bounds[0] = [ti.math.inf, ti.math.inf, ti.math.inf]
+        self.bounds[1] = [-ti.math.inf, -ti.math.inf, -ti.math.inf]
+        for k in range(3):
+            self.counters[k] = 0
+
+        for c in range(self.nb_cell):
+            self.cell_pos[c] = [0.0, 0.0, 0.0]
+            self.cell_mass[c] = 0.0
+            self.cell_count[c] = 0
+
+        for i in range(pos.shape[0]):
+            ti.atomic_min(self.bounds[0], pos[i])
+            ti.atomic_max(self.bounds[1], pos[i])
+
+        # occupied cells (a plain store, any writer wins) => room left for the near bodies
+        for i in range(pos.shape[0]):
+            self.cell_count[self.cell(pos[i])] = 1
+
+        for c in range(self.nb_cell):
+            if self.cell_count[c] > 0:
+                self.counters[NEAR_CAP] += 1
+                self.cell_count[c] = 0
+
+        self.counters[NEAR_CAP] = self.budget - self.counters[NEAR_CAP]
+
+        # near bodies one by one while there is room, the others aggregated in their cell
+        # (taking bodies out of the cells can only empty some)
+        cam = ti.Vector([cam_x, cam_y, cam_z])
+
+        for i in range(pos.shape[0]):
+            near = False
+
+            d = pos[i] - cam
+            if ti.math.dot(d, d) < radius * radius:
+                slot = ti.atomic_add(self.counters[NEAR], 1)
+                if slot < self.counters[NEAR_CAP]:
+                    out_pos[slot] = pos[i]
+                    out_weight[slot] = 1.0
+                    near = True
+
+            if not near:
+                c = self.cell(pos[i])
+                self.cell_pos[c] += pos[i] * mass[i]
+                self.cell_mass[c] += mass[i]
+                self.cell_count[c] += 1
+
+        self.counters[NB_VERTEX] = ti.min(self.counters[NEAR], self.counters[NEAR_CAP])
+
+        for c in range(self.nb_cell):
+            n = self.cell_count[c]
+            if n > 0:
+                k = ti.atomic_add(self.counters[NB_VERTEX], 1)
+                out_pos[k] = self.center(c)
+                if self.cell_mass[c] > 0.0:
+                    out_pos[k] = self.cell_pos[c] / self.cell_mass[c]
+                out_weight[k] = ti.cast(n, ti.f32)
+
+    @ti.func
+    def cell(self, p):
+        lo, hi = self.bounds[0], self.bounds[1]
+        g = ti.cast((p - lo) / ti.max(hi - lo, 1e-6) * self.grid, ti.i32)
+        g = ti.math.clamp(g, 0, self.grid - 1)
+        return (g[0] * self.grid + g[1]) * self.grid + g[2]
+
+    @ti.func
+    def center(self, c):
+        lo, hi = self.bounds[0], self.bounds[1]
+        g = ti.Vector([c // (self.grid * self.grid), (c // self.grid) % self.grid, c % self.grid])
+        return lo + (g + 0.5) * (hi - lo) / self.grid
+
+    def new_output(self):
+        return np.empty((self.budget, 3), dtype='f4'), np.empty(self.budget, dtype='f4')
+
+    def update(self, pos, mass, cam, out=None):
+        # -> (positions, weights) views on the first nb_vertex rows of out (or the default outputs)
+        out_pos, out_weight = out or (self.pos, self.weight)
+
+        if self.radius is None:
+            lo, hi = pos.min(axis=0), pos.max(axis=0)
+            self.radius = float(np.linalg.norm(cam - np.clip(cam, lo, hi)) + 0.25 * np.max(hi - lo))
+
+        self.build(pos, mass, float(cam[0]), float(cam[1]), float(cam[2]), self.radius, out_pos, out_weight)
+
+        self.nb_near, self.near_cap, self.nb_vertex = (int(x) for x in self.counters.to_numpy())
+        self.nb_vertex = min(self.nb_vertex, self.budget)
+
+        self.adapt(cam)
+
+        return out_pos[:self.nb_vertex], out_weight[:self.nb_vertex]
+
+    def adapt(self, cam):
+        # radius for the next frame, no need to grow past the farthest corner of the bounding box
+        lo, hi = self.bounds.to_numpy()
+        far = float(np.linalg.norm(np.maximum(np.abs(lo - cam), np.abs(hi - cam))))
+
+        if self.nb_near > HIGH * self.near_cap:
+            self.radius *= SHRINK
+        elif self.nb_near < LOW * self.near_cap:
+            self.radius = min(self.radius * GROW, far)
+
+    def get_info(self):
+        return {"vertices": self.nb_vertex, "near": min(self.nb_near, self.near_cap), "cells": self.nb_vertex - min(self.nb_near, self.near_cap),
+                "radius": self.radius}
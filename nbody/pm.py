@@ -0,0 +1,170 @@
+import numpy as np
+import taichi as ti
+
+# -----------------------------------------------------------------------------------------------------------
+# particle-mesh gravity, O(N + G^3 log G) per step for a G x G x G mesh
+#
+#   deposit     : cloud in cell, the mass of each body is spread over the 8 nearest cells (kernel)
+#   poisson     : phi = mass (*) green, a product in Fourier space (host FFT: scipy.fft if installed, numpy.fft)
+#   interpolate : -grad phi by central differences on the mesh, read back at the bodies with the same
+#                 cloud in cell weights (kernel), so there is no self force
+#
+# isolated (default): the mesh follows the bounding box of the bodies, they only occupy the first G/2 cells
+# of each axis and the rest is zero padding, so the cyclic convolution with the 1 / r green function has
+# no images. The cell size is snapped to steps of 2^(1/8): the transform of the green function is only
+# recomputed when it changes.
+# periodic: the mesh is the fixed box [-scale, scale]^3 (the initial cube) and the green function is
+# -4 pi / k^2, the mean density is dropped. The positions are not wrapped, the mesh sees them modulo the box.
+#
+# the softening is eps or the cell size, whichever is bigger: the mesh does not resolve anything smaller,
+# use a tree for the close encounters. pot is the mesh potential (it includes a smoothed self term).
+
+# cell size ladder of the isolated mesh
+SNAP = 8
+
+def get_fft():
+    # scipy.fft works in float32 on every core, numpy.fft in float64 on one
+    try:
+        import scipy.fft
+        return scipy.fft, {"workers": -1}
+    except ImportError:
+        return np.fft, {}
+
+@ti.data_oriented
+class ParticleMesh:
+    def __init__(self, system):
+
+        self.system = system
+        self.grid = system.grid
+        self.periodic = system.periodic
+
+        if self.grid < 16 or self.grid % 2:
+            raise ValueError("Solver pm needs an even grid >= 16, not %d" % self.grid)
+
+        G = self.grid
+
+        # host arrays, the kernels read / write them in place on the cpu backend
+        self.rho = np.zeros((G, G, G), dtype='f4')
+        self.phi = np.zeros((G, G, G), dtype='f4')
+
+        self.fft, self.fft_kw = get_fft()
+
+        # transform of the green function for (cell size, eps)
+        self.green = None
+        self.green_key = None
+
+        # mesh lower corner and cell size of the last step
+        self.origin = np.zeros(3)
+        self.h = 0.0
+
+    @ti.func
+    def index(self, c):
+        g = c
+        if ti.static(self.periodic):
+            g = c % self.grid
+        else:
+            g = ti.math.clamp(c, 0, self.grid - 1)
+        return g
+
+    @ti.kernel
+    def deposit(self, rho: ti.types.ndarray(dtype=ti.f32, ndim=3), origin: ti.math.vec3, inv_h: ti.f32):
+        for c in ti.grouped(rho):
+            rho[c] = 0.0
+
+        for i in range(self.system.nb_active[None]):
+            p, m = self.system.source(i)
+            u = (p - origin) * inv_h
+            b = ti.floor(u)
+            f = u - b
+            b_i = ti.cast(b, ti.i32)
+
+            for dx, dy, dz in ti.static(ti.ndrange(2, 2, 2)):
+                w = (f.x if dx else 1.0 - f.x) * (f.y if dy else 1.0 - f.y) * (f.z if dz else 1.0 - f.z)
+                rho[self.index(b_i + ti.Vector([dx, dy, dz]))] += m * w
+
+    @ti.kernel
+    def interpolate(self, phi: ti.types.ndarray(dtype=ti.f32, ndim=3), origin: ti.math.vec3, inv_h: ti.f32, with_pot: ti.template()):
+        for i in range(self.system.target_begin, self.system.target_stop()):
+            p, _ = self.system.source(i)
+            u = (p - origin) * inv_h
+            b = ti.floor(u)
+            f = u - b
+            b_i = ti.cast(b, ti.i32)
+
+            a = ti.Vector([0.0, 0.0, 0.0])
+            pot = 0.0
+
+            for dx, dy, dz in ti.static(ti.ndrange(2, 2, 2)):
+                w = (f.x if dx else 1.0 - f.x) * (f.y if dy else 1.0 - f.y) * (f.z if dz else 1.0 - f.z)
+                c = b_i + ti.Vector([dx, dy, dz])
+
+                grad = ti.Vector([0.0, 0.0, 0.0])
+                for k in ti.static(range(3)):
+                    e = ti.Vector([int(k == 0), int(k == 1), int(k == 2)])
+                    grad[k] = phi[self.index(c + e)] - phi[self.index(c - e)]
+
+                a -= grad * (w * 0.5 * inv_h)
+
+                if ti.static(with_pot):
+                    pot += phi[self.index(c)] * w
+
+            self.system.acc[i] = a
+
+            if ti.static(with_pot):
+                self.system.pot[i] = pot
+
+    def green_isolated(self, h, eps):
+        G = self.grid
+        d = np.minimum(np.arange(G), G - np.arange(G)) * h
+        r2 = d[:, None, None] ** 2 + d[None, :, None] ** 2 + d[None, None, :] ** 2
+
+        g = -1.0 / np.sqrt(r2 + max(eps, h) ** 2)
+
+        return self.fft.rfftn(g.astype(self.rho.dtype), **self.fft_kw)
+
+    def green_periodic(self, h, eps):
+        G = self.grid
+        k = 2.0 * np.pi * np.fft.fftfreq(G, d=h)
+        k2 = k[:, None, None] ** 2 + k[None, :, None] ** 2 + k[None, None, :G // 2 + 1] ** 2
+        k2[0, 0, 0] = 1.0
+
+        # mass per cell -> density, gaussian smoothing at the softening length
+        g = -4.0 * np.pi / (k2 * h ** 3) * np.exp(-0.5 * k2 * max(eps, h) ** 2)
+        g[0, 0, 0] = 0.0
+
+        return g.astype(np.complex64 if self.fft is not np.fft else np.complex128)
+
+    def mesh(self):
+        # -> lower corner, cell size
+        G = self.grid
+
+        if self.periodic:
+            return np.full(3, -self.system.scale), 2.0 * self.system.scale / G
+
+        # bodies in cells [1, G / 2 - 3]: the cloud in cell and the differences stay below G / 2
+        span = G // 2 - 4
+        lo, hi = self.system.pos_bounds()
+        extent = max(float(np.max(hi - lo)), 1e-6)
+        h = 2.0 ** (np.ceil(np.log2(extent / span) * SNAP) / SNAP)
+
+        return (lo + hi) * 0.5 - h * (span + 2) * 0.5, h
+
+    def compute(self, eps, with_pot=False):
+        self.origin, self.h = self.mesh()
+
+        key = (self.h, eps)
+        if key != self.green_key:
+            self.green = self.green_periodic(self.h, eps) if self.periodic else self.green_isolated(self.h, eps)
+            self.green_key = key
+
+        origin = ti.math.vec3(*self.origin.astype('f4'))
+        inv_h = 1.0 / self.h
+
+        self.deposit(self.rho, origin, inv_h)
+
+        G = self.grid
+        rho_k = self.fft.rfftn(self.rho, **self.fft_kw)
+        rho_k *= self.green
+        self.phi[:] = self.fft.irfftn(rho_k, s=(G, G, G), **self.fft_kw)
+
+        self.interpolate(self.phi, origin, inv_h, with_pot)
@@ -0,0 +1,146 @@
+import taichi as ti
+
+# -----------------------------------------------------------------------------------------------------------
+# Morton (Z-order) reordering of the bodies: bodies close in space end up close in memory, so the force
+# loops (tiles, tree leaves, mesh cells) read cache lines that the neighbouring iterations also use
+#
+#   keys    : 21 bits per axis of the position in the bounding box, interleaved => 63 bits
+#   sort    : LSD radix sort of (key, slot), RADIX_BITS per pass. A pass is a single kernel: per block digit
+#             histograms, one exclusive scan over (digit, block), then every block scatters its bodies in
+#             order => stable, the blocks run in parallel (RadixSort, also used by the Barnes-Hut build)
+#   permute : every per body field (system.body_fields) is gathered through the sorted slots, see
+#             Permutation (also used by the compaction of nbody.collisions)
+#
+# system.ids[slot] is the original index of the body in slot (the order of init / set_bodies), the outputs
+# that must not depend on the order (trajectories) scatter through it. The inactive bodies (merged) get the
+# biggest key and stay at the end.
+
+RADIX_BITS = 8
+RADIX = 1 << RADIX_BITS
+NB_PASS = 8 # 64 / RADIX_BITS, even => the sorted slots end up in buffer 0
+
+# bodies per block of the radix sort
+BLOCK = 4096
+
+# 21 bits -> every third bit of 63
+SPREAD = ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249))
+
+@ti.func
+def spread_bits(x):
+    for shift, mask in ti.static(SPREAD):
+        x = (x | (x << shift)) & ti.u64(mask)
+    return x
+
+@ti.data_oriented
+class Permutation:
+    # moves the bodies between slots: new slot i <- old slot order[i], for every per body field
+
+    def __init__(self, system):
+        self.system = system
+
+        n = system.nb_body
+
+        self.order = ti.field(dtype=ti.i32, shape=n)
+
+        # the per body fields and a scratch field per (components, dtype) for the gathers
+        self.fields = system.body_fields
+
+        self.scratch = {}
+        for f in self.fields:
+            key = (getattr(f, "n", 0), f.dtype)
+            if key not in self.scratch:
+                self.scratch[key] = ti.Vector.field(f.n, dtype=f.dtype, shape=n) if key[0] else ti.field(dtype=f.dtype, shape=n)
+
+    @ti.kernel
+    def gather(self, field: ti.template(), tmp: ti.template()):
+        for i in range(self.system.nb_body):
+            tmp[i] = field[self.order[i]]
+
+        for i in range(self.system.nb_body):
+            field[i] = tmp[i]
+
+    def apply(self):
+        for f in self.fields:
+            self.gather(f, self.scratch[(getattr(f, "n", 0), f.dtype)])
+
+@ti.data_oriented
+class RadixSort:
+    # stable sort of (key, slot) pairs by their u64 key, the first n of capacity: fill keys[0, :n] /
+    # slots[0, :n], sort(n), the result is back in keys[0] / slots[0] (NB_PASS is even)
+
+    def __init__(self, capacity):
+        self.keys = ti.field(dtype=ti.u64, shape=(2, capacity))
+        self.slots = ti.field(dtype=ti.i32, shape=(2, capacity))
+
+        self.offsets = ti.field(dtype=ti.i32, shape=((capacity + BLOCK - 1) // BLOCK, RADIX))
+
+    @ti.func
+    def digit(self, src, i, shift):
+        return ti.cast((self.keys[src, i] >> ti.cast(shift, ti.u64)) & ti.u64(RADIX - 1), ti.i32)
+
+    @ti.kernel
+    def radix_pass(self, src: ti.i32, shift: ti.i32, n: ti.i32):
+        nb_block = (n + BLOCK - 1) // BLOCK
+
+        for b in range(nb_block):
+            for d in range(RADIX):
+                self.offsets[b, d] = 0
+            # the row of a block is its own: a plain load / store (+= would be atomic)
+            for i in range(b * BLOCK, ti.min((b + 1) * BLOCK, n)):
+                d = self.digit(src, i, shift)
+                self.offsets[b, d] = self.offsets[b, d] + 1
+
+        # exclusive scan, digit major: the bodies of a digit keep the block order
+        ti.loop_config(serialize=True)
+        for _ in range(1):
+            total = 0
+            for d in range(RADIX):
+                for b in range(nb_block):
+                    count = self.offsets[b, d]
+                    self.offsets[b, d] = total
+                    total += count
+
+        for b in range(nb_block):
+            for i in range(b * BLOCK, ti.min((b + 1) * BLOCK, n)):
+                d = self.digit(src, i, shift)
+                k = self.offsets[b, d]
+                self.offsets[b, d] = k + 1
+                self.keys[1 - src, k] = self.keys[src, i]
+                self.slots[1 - src, k] = self.slots[src, i]
+
+    def sort(self, n):
+        for p in range(NB_PASS):
+            self.radix_pass(p % 2, p * RADIX_BITS, n)
+
+@ti.data_oriented
+class MortonOrder:
+    def __init__(self, system):
+        self.system = system
+        self.permutation = system.get_permutation()
+        self.sorter = RadixSort(system.nb_body)
+
+    @ti.kernel
+    def compute_keys(self):
+        lo, hi = self.system.bounds[0], self.system.bounds[1]
+        scale = (2 ** 21 - 1) / ti.max(hi - lo, 1e-30)
+
+        for i in range(self.system.nb_body):
+            key = ti.u64(1) << ti.u64(63)
+            if i < self.system.nb_active[None]:
+                q = ti.cast((self.system.pos[i] - lo) * scale, ti.u64)
+                key = (spread_bits(q.x) << 2) | (spread_bits(q.y) << 1) | spread_bits(q.z)
+
+            self.sorter.keys[0, i] = key
+            self.sorter.slots[0, i] = i
+
+    @ti.kernel
+    def sorted_order(self):
+        for i in range(self.system.nb_body):
+            self.permutation.order[i] = self.sorter.slots[0, i]
+
+    def reorder(self):
+        self.system.compute_bounds()
+        self.compute_keys()
+        self.sorter.sort(self.system.nb_body)
+        self.sorted_order()
+        self.permutation.apply()
@@ -0,0 +1,117 @@
+import math
+
+import numpy as np
+
+from nbody.trajectory import TrajectoryReader
+
+# -----------------------------------------------------------------------------------------------------------
+# trajectory playback, no physics
+#
+# the play head is a fractional frame index moved by `speed` frames per second of wall clock
+# (negative = backward, wraps around when looping). Between two recorded frames:
+#   "skip"    : the frame under the play head, a view on the memory-mapped file (uncompressed files)
+#   "linear"  : linear interpolation of the positions
+#   "hermite" : cubic Hermite interpolation from the positions and velocities of both frames
+
+REPLAY_MODES = ("skip", "linear", "hermite")
+
+class Player:
+
+    def __init__(self, path, speed=30.0, mode="skip", loop=True):
+
+        if mode not in REPLAY_MODES:
+            raise ValueError("Unknown replay mode %s, expected one of %s" % (mode, REPLAY_MODES))
+
+        self.reader = TrajectoryReader(path)
+        self.header = self.reader.header
+        self.nb_body = self.reader.nb_body
+        self.nb_frame = len(self.reader)
+
+        if not self.nb_frame:
+            raise ValueError("%s has no frames" % path)
+
+        self.speed = speed
+        self.mode = mode
+        self.loop = loop
+        self.paused = False
+
+        self.position = 0.0
+
+        # hermite falls back to linear on files recorded without the velocities
+        self.has_vel = "vel" in self.header["fields"]
+
+        # interpolation: float32 work buffers, the result in the file dtype so the VBO format never changes
+        self.dtype = np.dtype(self.header["dtype"])
+        self.out = np.empty((self.nb_body, 3), dtype=self.dtype)
+        self.work = [np.empty((self.nb_body, 3), dtype='f4') for _ in range(2)]
+
+        # last (frame, fraction, mode) handed out, None when the play head has not moved since
+        self.shown = None
+
+    def seek(self, position):
+        last = self.nb_frame - 1
+
+        if self.loop and last > 0:
+            position = math.fmod(position, last)
+            if position < 0:
+                position += last
+        else:
+            position = min(max(position, 0.0), last)
+
+        self.position = position
+
+    def advance(self, seconds):
+        if not self.paused:
+            self.seek(self.position + self.speed * seconds)
+
+    def step(self, n=1):
+        # one recorded frame forward / backward, snapped to a frame
+        self.seek(math.floor(self.position) + n)
+
+    def frame(self, k):
+        return self.reader.frame(k)
+
+    def current(self):
+        return int(self.position)
+
+    def positions(self):
+        # positions under the play head, or None if they did not change since the last call
+        k = int(self.position)
+        s = self.position - k
+
+        if self.mode == "skip" or k + 1 >= self.nb_frame:
+            s = 0.0
+
+        if (k, s, self.mode) == self.shown:
+            return None
+        self.shown = (k, s, self.mode)
+
+        if s == 0.0:
+            return self.frame(k)["pos"]
+
+        a, b = self.frame(k), self.frame(k + 1)
+        w0, w1 = self.work
+
+        if self.mode == "linear" or not self.has_vel:
+            np.multiply(a["pos"], 1.0 - s, out=w0)
+            np.multiply(b["pos"], s, out=w1)
+            np.add(w0, w1, out=self.out, casting="same_kind")
+            return self.out
+
+        # Hermite basis, the velocities are scaled by the time between the two frames
+        h = b["time"] - a["time"]
+        s2, s3 = s * s, s * s * s
+
+        np.multiply(a["pos"], 2 * s3 - 3 * s2 + 1, out=w0)
+        np.multiply(b["pos"], -2 * s3 + 3 * s2, out=w1)
+        w0 += w1
+        np.multiply(a["vel"], (s3 - 2 * s2 + s) * h, out=w1)
+        w0 += w1
+        np.multiply(b["vel"], (s3 - s2) * h, out=w1)
+        np.add(w0, w1, out=self.out, casting="same_kind")
+
+        return self.out
+
+    def get_frame_info(self):
+        frame = self.frame(self.current())
+        return int(frame["step"]), float(frame["time"])
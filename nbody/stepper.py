@@ -0,0 +1,134 @@
+import collections, threading, time
+
+import numpy as np
+
+# -----------------------------------------------------------------------------------------------------------
+# background stepping: a worker thread advances the system continuously and publishes the positions
+# in a triple buffer. The reader always gets the latest complete snapshot without waiting for the step
+# in flight, the writer always has a buffer that is neither the latest one nor the one being read.
+#
+# once started, only the worker thread calls Taichi (kernels, to_numpy, ...): a call from the main thread
+# while the worker compiles a kernel is taken for a call inside that kernel.
+# Taichi keeps the GIL during a kernel launch, so the reader runs between the kernels of a step
+# (and the worker runs while the reader waits on vsync / clock.tick)
+
+class Stepper:
+
+    def __init__(self, system, dt=0.005, eps=0.5, nb_buffer=3, on_step=None, timer=None, export=None, new_buffer=None):
+
+        self.system = system
+
+        # optional nbody.timing.FrameTimer, the steps are timed in the worker thread
+        self.timer = timer
+
+        # called in the worker thread after each step, with the system
+        self.on_step = on_step
+
+        # read by the worker before each step, can be changed at any time (sliders)
+        self.dt = dt
+        self.eps = eps
+
+        # what is published: by default the positions, export(system, buffer) fills a new_buffer() in the
+        # worker thread (e.g. the LOD vertices of the viewer)
+        self.export = export or (lambda system, buffer: system.export_pos(buffer))
+        new_buffer = new_buffer or (lambda: np.empty((system.nb_body, 3), dtype='f4'))
+
+        self.buffers = [new_buffer() for _ in range(nb_buffer)]
+        for buffer in self.buffers:
+            self.export(system, buffer)
+
+        self.lock = threading.Lock()
+        self.latest = 0
+        self.reading = 0
+        self.version = 0
+
+        self.steps = 0
+        self.step_times = collections.deque(maxlen=60)
+
+        # fn(system) calls queued by submit, run in the worker before the next step
+        self.requests = collections.deque()
+
+        self.running = threading.Event()
+        self.thread = None
+
+        # exception that stopped the worker, raised in the main thread by the next acquire() / stop()
+        self.error = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="nbody-stepper", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn):
+        # changes of the system from the main thread (add / remove bodies...), applied between two steps
+        self.requests.append(fn)
+
+    def take_requests(self):
+        # -> the requests not run yet, once stopped
+        requests = list(self.requests)
+        self.requests.clear()
+        return requests
+
+    def run(self):
+        # an exception stops the worker, it is kept for the main thread rather than lost with the thread
+        try:
+            while self.running.is_set():
+                self.step()
+        except Exception as e:
+            self.error = e
+            self.running.clear()
+
+    def step(self):
+        while self.requests:
+            self.requests.popleft()(self.system)
+
+        t0 = time.perf_counter()
+
+        if self.timer:
+            with self.timer.phase("step", sync=True):
+                self.system.update(self.dt, self.eps)
+        else:
+            self.system.update(self.dt, self.eps)
+
+        if self.on_step:
+            self.on_step(self.system)
+
+        with self.lock:
+            index = next(k for k in range(len(self.buffers)) if k != self.latest and k != self.reading)
+
+        self.export(self.system, self.buffers[index])
+
+        with self.lock:
+            self.latest = index
+            self.version += 1
+
+        self.steps += 1
+        self.step_times.append(time.perf_counter() - t0)
+
+    def acquire(self):
+        # latest published snapshot, it stays untouched until the next acquire()
+        self.raise_error()
+
+        with self.lock:
+            self.reading = self.latest
+            return self.buffers[self.reading], self.version
+
+    def get_steps_per_sec(self):
+        total_time = sum(self.step_times)
+        if total_time == 0:
+            return 0
+        else:
+            return len(self.step_times) / total_time
@@ -0,0 +1,499 @@
+import numpy as np
+import taichi as ti
+
+from nbody.backend import has_f64, has_fast_math
+from nbody.collisions import Collisions
+from nbody.forces import FORCES
+from nbody.ic import make_ic
+from nbody.integrators import INTEGRATORS
+from nbody.reorder import MortonOrder, Permutation
+
+SOLVERS = tuple(FORCES)
+
+# memory layout of the body fields
+#   "soa"    : one dense SNode per field (pos[], vel[], acc[], mass[])
+#   "aos"    : one dense SNode for all of them, a 40 bytes record per body
+#   "packed" : soa + a vec4 (pos, mass) copy refreshed before each force computation, the force loops
+#              read a single 16 bytes record per interaction
+LAYOUTS = ("soa", "aos", "packed")
+
+# precision of the integration (kick / drift), the forces are always computed in f32 from pos
+#   "f32"   : pos / vel updated in place
+#   "kahan" : f32 + compensated (Kahan) summation of the updates, the rounding error is carried over
+#             (needs fast_math=False)
+#   "f64"   : f64 master copies of pos / vel, pos / vel are their f32 rounding after every update
+PRECISIONS = ("f32", "kahan", "f64")
+
+PRECISION_FIELDS = {"f32": (), "kahan": ("pos_comp", "vel_comp"), "f64": ("pos64", "vel64")}
+
+# the slots grow geometrically when added bodies do not fit (a rebuild + recompile each time, see resized)
+GROWTH = 2
+
+def grown_capacity(needed, capacity):
+    while capacity < needed:
+        capacity *= GROWTH
+    return capacity
+
+# -----------------------------------------------------------------------------------------------------------
+# dataclass version here: https://github.com/devpack/taichi-tests/blob/main/nbody-dataclass.py
+
+@ti.data_oriented
+class NBodySystem:
+    def __init__(self, nb_body=8, solver="direct", theta=0.5, integrator="kdk", scale=8.0, layout="soa", precision="f32", targets=None,
+                 grid=128, periodic=False, capacity=0):
+
+        # slots of every per body field: the initial bodies, or capacity if bigger (room for add_bodies)
+        self.nb_init = nb_body
+        self.nb_body = max(nb_body, capacity)
+
+        # bodies whose forces are computed (begin, end), the others are sources only (distributed workers)
+        self.target_begin, self.target_end = targets or (0, self.nb_body)
+
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown layout %s, expected one of %s" % (layout, LAYOUTS))
+
+        self.layout = layout
+
+        self.pos = ti.Vector.field(3, dtype=ti.f32)
+        self.vel = ti.Vector.field(3, dtype=ti.f32)
+        self.acc = ti.Vector.field(3, dtype=ti.f32)
+        self.mass = ti.field(dtype=ti.f32)
+
+        if self.layout == "aos":
+            ti.root.dense(ti.i, self.nb_body).place(self.pos, self.vel, self.acc, self.mass)
+        else:
+            for f in (self.pos, self.vel, self.acc, self.mass):
+                ti.root.dense(ti.i, self.nb_body).place(f)
+
+        # bounding box of the positions (min, max), see pos_bounds
+        self.bounds = ti.Vector.field(3, dtype=ti.f32, shape=2)
+
+        # softened potential of every body, written by the force solvers with acc (diagnostics only)
+        self.pot = ti.field(dtype=ti.f32, shape=self.nb_body)
+
+        # original index of the body in each slot, the slots are permuted by reorder()
+        self.ids = ti.field(dtype=ti.i32, shape=self.nb_body)
+
+        # the bodies 0 .. nb_active are simulated, the slots after are empty (mass 0): merged bodies (see
+        # nbody.collisions), removed ones or room for add_bodies. n_active is its host copy
+        self.nb_active = ti.field(dtype=ti.i32, shape=())
+        self.n_active = self.nb_init
+
+        if self.layout == "packed":
+            self.pos_mass = ti.Vector.field(4, dtype=ti.f32, shape=self.nb_body)
+
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision %s, expected one of %s" % (precision, PRECISIONS))
+        if precision != "f32" and not getattr(INTEGRATORS.get(integrator), "uses_kick_drift", False):
+            raise ValueError("Precision %s needs a kick / drift integrator, not %s" % (precision, integrator))
+        if integrator == "hermite" and solver != "direct":
+            # forces + jerk by its own direct summation, the solver would never be used
+            raise ValueError("Integrator hermite computes its forces by direct summation, it needs solver direct, not %s" % solver)
+        if precision == "f64" and not has_f64():
+            raise ValueError("Precision f64 is not supported on this arch")
+        if precision == "kahan" and has_fast_math():
+            raise ValueError("Precision kahan needs ti.init(fast_math=False)")
+
+        self.precision = precision
+        self.precision_fields = PRECISION_FIELDS[precision]
+
+        if self.precision == "kahan":
+            self.pos_comp = ti.Vector.field(3, dtype=ti.f32, shape=self.nb_body)
+            self.vel_comp = ti.Vector.field(3, dtype=ti.f32, shape=self.nb_body)
+        elif self.precision == "f64":
+            self.pos64 = ti.Vector.field(3, dtype=ti.f64, shape=self.nb_body)
+            self.vel64 = ti.Vector.field(3, dtype=ti.f64, shape=self.nb_body)
+
+        # initial uniform cube half width
+        self.scale = scale
+
+        if solver not in FORCES:
+            raise ValueError("Unknown solver %s, expected one of %s" % (solver, tuple(FORCES)))
+        if integrator not in INTEGRATORS:
+            raise ValueError("Unknown integrator %s, expected one of %s" % (integrator, tuple(INTEGRATORS)))
+
+        self.solver = solver
+        self.theta = theta
+
+        # particle-mesh cells per axis, periodic box [-scale, scale]^3
+        self.grid = grid
+        self.periodic = periodic
+        self.integrator_name = integrator
+
+        self.force = FORCES[solver](self)
+        self.integrator = INTEGRATORS[integrator](self)
+
+        # every per body field, the integrator state included: moved together by the reorders, the
+        # compaction after merges and the removals
+        names = ("pos", "vel", "acc", "mass", "pot", "ids") + self.precision_fields
+        self.body_fields = [getattr(self, name) for name in names]
+        self.body_fields += [getattr(self.integrator, name) for name in getattr(self.integrator, "state_fields", ())
+                             if getattr(self.integrator, name).shape == (self.nb_body,)]
+
+        # add_bodies / remove_bodies calls: the bodies changed slots (like reorder_count for the reorders)
+        self.edit_count = 0
+
+        # number of update() calls and simulated time since init()
+        self.step_count = 0
+        self.time = 0.0
+
+        # the force passes of every pot_every-th step also fill pot (0 = never), see Diagnostics
+        self.pot_every = 0
+        self.with_pot = False
+
+        # Morton reordering of the bodies every reorder_every steps (0 = never), see set_reorder
+        self.reorder_every = 0
+        self.reorder_count = 0
+        self.morton = None
+
+        # slot moves shared by the reorders and the compaction after merges
+        self.permutation = None
+
+        # collision stage after every step, see set_collisions
+        self.collisions = None
+
+    def init(self, ic="cube", seed=0, params=None, cache_dir=None):
+        # "cube" in a kernel, the other initial conditions from nbody.ic (seeded numpy, cached)
+        if ic == "cube":
+            self.init_cube(self.nb_init)
+            self.ids.from_numpy(np.arange(self.nb_body, dtype=np.int32))
+        else:
+            self.set_bodies(*make_ic(ic, self.nb_init, seed=seed, params=params, scale=self.scale, cache_dir=cache_dir))
+
+        self.set_active(self.nb_init)
+        self.sync_precision()
+        self.integrator.reset()
+
+        self.step_count = 0
+        self.time = 0.0
+
+    @ti.kernel
+    def init_cube(self, n: ti.i32):
+        for i in range(n):
+            self.pos[i] = [((ti.random(float) * 2) - 1) * self.scale, ((ti.random(float) * 2) - 1) * self.scale, ((ti.random(float) * 2) - 1) * self.scale]
+            self.vel[i] = [0.0, 0.0, 0.0]
+            self.acc[i] = [0.0, 0.0, 0.0]
+            self.pot[i] = 0.0
+            self.mass[i] = 1.0
+
+        for i in range(n, self.nb_body):
+            self.clear_body(i)
+
+    def set_bodies(self, pos, vel, mass):
+        # the first len(mass) slots, the others are emptied
+        self.pos.fill(0.0)
+        self.vel.fill(0.0)
+        self.mass.fill(0.0)
+        self.acc.fill(0.0)
+        self.pot.fill(0.0)
+        self.ids.from_numpy(np.arange(self.nb_body, dtype=np.int32))
+        self.set_active(0)
+        self.add_bodies(pos, vel, mass)
+
+    @ti.kernel
+    def write_bodies(self, pos: ti.types.ndarray(dtype=ti.math.vec3, ndim=1), vel: ti.types.ndarray(dtype=ti.math.vec3, ndim=1),
+                     mass: ti.types.ndarray(dtype=ti.f32, ndim=1), start: ti.i32):
+        for k in range(mass.shape[0]):
+            i = start + k
+            self.pos[i] = pos[k]
+            self.vel[i] = vel[k]
+            self.acc[i] = [0.0, 0.0, 0.0]
+            self.pot[i] = 0.0
+            self.mass[i] = mass[k]
+            self.sync_body(i)
+
+    @ti.func
+    def clear_body(self, i):
+        self.vel[i] = [0.0, 0.0, 0.0]
+        self.acc[i] = [0.0, 0.0, 0.0]
+        self.pot[i] = 0.0
+        self.mass[i] = 0.0
+        self.sync_body(i)
+
+    @ti.kernel
+    def clear_slot(self, i: ti.i32):
+        self.clear_body(i)
+
+    @ti.kernel
+    def swap_bodies(self, i: ti.i32, j: ti.i32):
+        for f in ti.static(self.body_fields):
+            tmp = f[i]
+            f[i] = f[j]
+            f[j] = tmp
+
+    def add_bodies(self, pos, vel, mass):
+        # appends bodies after the active ones, in place: a kernel writes the new slots and the loops read
+        # nb_active, so nothing recompiles. The forces are recomputed by the next step
+        k = len(mass)
+        if self.n_active + k > self.nb_body:
+            raise ValueError("No room for %d more bodies, %d / %d slots used (see resized)" % (k, self.n_active, self.nb_body))
+
+        self.write_bodies(np.ascontiguousarray(pos, dtype='f4'), np.ascontiguousarray(vel, dtype='f4'), np.ascontiguousarray(mass, dtype='f4'),
+                          self.n_active)
+        self.set_active(self.n_active + k)
+        self.integrator.reset()
+        self.edit_count += 1
+
+    def remove_bodies(self, slots):
+        # swap-remove, O(1) per body: the last active body moves into the slot, which becomes the last one
+        # and is emptied (the order changes, ids keep the identities)
+        for i in sorted(set(slots), reverse=True):
+            if not 0 <= i < self.n_active:
+                raise ValueError("Slot %d is not an active body (%d active)" % (i, self.n_active))
+
+            last = self.n_active - 1
+            if i != last:
+                self.swap_bodies(i, last)
+            self.clear_slot(last)
+            self.set_active(last)
+
+        self.integrator.reset()
+        self.edit_count += 1
+
+    def resized(self, capacity):
+        # -> a new system with capacity slots, the same settings and state (the bodies keep their slots).
+        # Taichi compiles the kernels of a data_oriented object once for its fields, so the slots cannot grow
+        # in place: the caller re-points its references to the new system. Main thread only
+        from nbody.checkpoint import load_state_arrays, state_arrays
+
+        system = NBodySystem(nb_body=capacity, solver=self.solver, theta=self.theta, integrator=self.integrator_name, scale=self.scale,
+                             layout=self.layout, precision=self.precision, grid=self.grid, periodic=self.periodic)
+
+        arrays = state_arrays(self)
+        for name, a in arrays.items():
+            if a.ndim == 0:
+                continue
+            pad = np.arange(self.nb_body, capacity, dtype=a.dtype) if name == "ids" else np.zeros((capacity - self.nb_body,) + a.shape[1:], dtype=a.dtype)
+            arrays[name] = np.concatenate([a, pad])
+
+        load_state_arrays(system, arrays)
+
+        system.set_active(self.n_active)
+        system.step_count, system.time, system.pot_every = self.step_count, self.time, self.pot_every
+        system.reorder_count, system.edit_count = self.reorder_count, self.edit_count
+        system.set_reorder(self.reorder_every)
+
+        if self.collisions:
+            system.set_collisions(self.collisions.radius)
+            system.collisions.merges = self.collisions.merges
+
+        return system
+
+    def spawn(self, pos, vel, mass):
+        # add_bodies, after a geometric growth when they do not fit -> the system to use from now on
+        needed = self.n_active + len(mass)
+        system = self.resized(grown_capacity(needed, self.nb_body)) if needed > self.nb_body else self
+        system.add_bodies(pos, vel, mass)
+        return system
+
+    def set_active(self, n):
+        self.nb_active[None] = n
+        self.n_active = n
+
+    # end of the force loop targets: the target range without the merged bodies
+    @ti.func
+    def target_stop(self):
+        return ti.min(self.target_end, self.nb_active[None])
+
+    # copy of the positions / velocities into a host array (N, 3) float32, written in place on the cpu backend
+    @ti.kernel
+    def export_pos(self, out: ti.types.ndarray(dtype=ti.math.vec3, ndim=1)):
+        for i in range(self.nb_body):
+            out[i] = self.pos[i]
+
+    # packed copies for the VBO (half the bytes): float16, or int16 steps of `scale` around `offset`
+    @ti.kernel
+    def export_pos_f16(self, out: ti.types.ndarray(dtype=ti.types.vector(3, ti.f16), ndim=1)):
+        for i in range(self.nb_body):
+            out[i] = ti.cast(self.pos[i], ti.f16)
+
+    @ti.kernel
+    def export_pos_i16(self, out: ti.types.ndarray(dtype=ti.types.vector(3, ti.i16), ndim=1), offset: ti.math.vec3, inv_scale: ti.math.vec3):
+        for i in range(self.nb_body):
+            out[i] = ti.cast(ti.round((self.pos[i] - offset) * inv_scale), ti.i16)
+
+    @ti.kernel
+    def compute_bounds(self):
+        self.bounds[0] = [ti.math.inf, ti.math.inf, ti.math.inf]
+        self.bounds[1] = [-ti.math.inf, -ti.math.inf, -ti.math.inf]
+
+        for i in range(self.nb_active[None]):
+            ti.atomic_min(self.bounds[0], self.pos[i])
+            ti.atomic_max(self.bounds[1], self.pos[i])
+
+    def pos_bounds(self):
+        self.compute_bounds()
+        lo, hi = self.bounds.to_numpy()
+        return lo, hi
+
+    @ti.kernel
+    def export_vel(self, out: ti.types.ndarray(dtype=ti.math.vec3, ndim=1)):
+        for i in range(self.nb_body):
+            out[i] = self.vel[i]
+
+    # pos / vel in the original order of the bodies (through ids), whatever reorder() did
+    @ti.kernel
+    def export_by_id(self, pos: ti.types.ndarray(dtype=ti.math.vec3, ndim=1), vel: ti.types.ndarray(dtype=ti.math.vec3, ndim=1)):
+        for i in range(self.nb_body):
+            pos[self.ids[i]] = self.pos[i]
+            vel[self.ids[i]] = self.vel[i]
+
+    # after pos / vel were written from outside the kick / drift kernels (init, initial conditions)
+    @ti.kernel
+    def sync_precision(self):
+        for i in range(self.nb_body):
+            self.sync_body(i)
+
+    @ti.func
+    def sync_body(self, i):
+        if ti.static(self.precision == "kahan"):
+            self.pos_comp[i] = [0.0, 0.0, 0.0]
+            self.vel_comp[i] = [0.0, 0.0, 0.0]
+        elif ti.static(self.precision == "f64"):
+            self.pos64[i] = ti.cast(self.pos[i], ti.f64)
+            self.vel64[i] = ti.cast(self.vel[i], ti.f64)
+
+    @ti.func
+    def kick_body(self, i, h):
+        if ti.static(self.precision == "kahan"):
+            y = self.acc[i] * h - self.vel_comp[i]
+            t = self.vel[i] + y
+            self.vel_comp[i] = (t - self.vel[i]) - y
+            self.vel[i] = t
+        elif ti.static(self.precision == "f64"):
+            self.vel64[i] += ti.cast(self.acc[i], ti.f64) * ti.cast(h, ti.f64)
+            self.vel[i] = ti.cast(self.vel64[i], ti.f32)
+        else:
+            self.vel[i] += self.acc[i] * h
+
+    @ti.func
+    def drift_body(self, i, h):
+        if ti.static(self.precision == "kahan"):
+            y = self.vel[i] * h - self.pos_comp[i]
+            t = self.pos[i] + y
+            self.pos_comp[i] = (t - self.pos[i]) - y
+            self.pos[i] = t
+        elif ti.static(self.precision == "f64"):
+            self.pos64[i] += self.vel64[i] * ti.cast(h, ti.f64)
+            self.pos[i] = ti.cast(self.pos64[i], ti.f32)
+        else:
+            self.pos[i] += self.vel[i] * h
+
+    @ti.kernel
+    def kick(self, h: ti.f32):
+        for i in range(self.nb_active[None]):
+            self.kick_body(i, h)
+
+    @ti.kernel
+    def drift(self, h: ti.f32):
+        for i in range(self.nb_active[None]):
+            self.drift_body(i, h)
+
+    @ti.kernel
+    def kick_drift(self, kick_h: ti.f32, drift_h: ti.f32):
+        for i in range(self.nb_active[None]):
+            self.kick_body(i, kick_h)
+            self.drift_body(i, drift_h)
+
+    # position and mass of body j as read by the force loops
+    @ti.func
+    def source(self, j):
+        p = ti.Vector([0.0, 0.0, 0.0])
+        m = 0.0
+
+        if ti.static(self.layout == "packed"):
+            q = self.pos_mass[j]
+            p = q.xyz
+            m = q.w
+        else:
+            p = self.pos[j]
+            m = self.mass[j]
+
+        return p, m
+
+    @ti.kernel
+    def pack(self):
+        for i in range(self.nb_active[None]):
+            p = self.pos[i]
+            self.pos_mass[i] = [p.x, p.y, p.z, self.mass[i]]
+
+    def compute_forces(self, eps):
+        if self.layout == "packed":
+            self.pack()
+
+        self.force.compute(eps, self.with_pot)
+
+    def get_permutation(self):
+        if self.permutation is None:
+            self.permutation = Permutation(self)
+        return self.permutation
+
+    def set_collisions(self, radius):
+        # merge the bodies closer than the sum of their radii, radius * mass^(1/3) (0 = no collisions).
+        # Same main thread constraint as set_reorder
+        self.collisions = Collisions(self, radius) if radius > 0 else None
+
+    def collide(self):
+        self.collisions.update()
+
+    def set_reorder(self, every):
+        # the fields are allocated here: Taichi only creates fields from the main thread, the steps (and so
+        # the reorders) may run in another one
+        self.reorder_every = every
+        if every > 0 and self.morton is None:
+            self.morton = MortonOrder(self)
+
+    def reorder(self):
+        # bodies in Morton order of their positions, see nbody.reorder
+        if self.morton is None:
+            self.morton = MortonOrder(self)
+
+        self.morton.reorder()
+        self.reorder_count += 1
+
+    def warmup(self, dt, eps):
+        # compiles the kernels of the steps (with and without pot, reorder, merge) before the first frame: the
+        # steps run on the real state, then the fields and host counters are put back
+        from nbody.checkpoint import load_state_arrays, state_arrays
+
+        arrays = state_arrays(self)
+        objects = [self, self.integrator] + ([self.collisions] if self.collisions else [])
+        host = [{k: v for k, v in vars(o).items() if isinstance(v, (bool, int, float))} for o in objects]
+
+        for pot_every in (0, 1) if self.pot_every else (0,):
+            self.pot_every = pot_every
+            self.update(dt, eps)
+
+        if self.morton:
+            self.morton.reorder()
+        if self.collisions:
+            self.collisions.merge()
+            self.permutation.apply()
+
+        load_state_arrays(self, arrays)
+        for o, values in zip(objects, host):
+            vars(o).update(values)
+        self.set_active(self.n_active)
+
+    def instrument(self, timer):
+        # every kick / drift / force pass becomes a (synced) phase of a nbody.timing.FrameTimer
+        for name in ("kick", "drift", "kick_drift"):
+            setattr(self, name, timer.wrap(getattr(self, name), name, sync=True))
+
+        self.compute_forces = timer.wrap(self.compute_forces, "force", sync=True)
+        self.reorder = timer.wrap(self.reorder, "reorder", sync=True)
+        self.collide = timer.wrap(self.collide, "collide", sync=True)
+
+    def update(self, dt, eps):
+        self.with_pot = self.pot_every > 0 and (self.step_count + 1) % self.pot_every == 0
+
+        self.integrator.step(dt, eps)
+
+        self.step_count += 1
+        self.time += dt
+
+        if self.collisions:
+            self.collide()
+
+        if self.reorder_every > 0 and self.step_count % self.reorder_every == 0:
+            self.reorder()
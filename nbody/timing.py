@@ -0,0 +1,192 @@
+import collections, contextlib, json, os, threading, time
+
+import numpy as np
+
+# -----------------------------------------------------------------------------------------------------------
+# per phase frame timing
+#
+# phase(name) times a block; the durations of a frame are summed per phase (a phase can run several times
+# per frame, e.g. 3 force passes with yoshida4) and end_frame() pushes them into a rolling history used for
+# the p50 / p95 / p99. Phases can come from another thread (threaded stepper), they are counted in the
+# frame in progress.
+#
+# with trace=True every phase is also kept as a Chrome trace event ("X", complete event, per thread),
+# export_trace(path) writes a file for chrome://tracing or https://ui.perfetto.dev
+
+PERCENTILES = (50, 95, 99)
+
+class FrameTimer:
+
+    def __init__(self, history=300, trace=False, max_events=1000000, sync=None):
+        self.history = history
+        self.trace = trace
+
+        # called before the end of the kernel phases (ti.sync) so async backends are measured, or None
+        self.sync = sync
+
+        self.lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+        self.frame = collections.defaultdict(float)
+        self.frames = collections.deque(maxlen=history)
+
+        self.t0 = time.perf_counter()
+        self.frame_start = self.t0
+        self.events = collections.deque(maxlen=max_events)
+
+    @contextlib.contextmanager
+    def phase(self, name, sync=False):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            if sync and self.sync:
+                self.sync()
+            self.add(name, t0, time.perf_counter())
+
+    def add(self, name, t0, t1):
+        with self.lock:
+            self.frame[name] += t1 - t0
+
+            if name not in self.phases:
+                self.phases[name] = collections.deque(maxlen=self.history)
+
+            if self.trace:
+                self.events.append((name, t0, t1, threading.get_ident()))
+
+    def wrap(self, function, name, sync=False):
+        def timed(*args, **kwargs):
+            with self.phase(name, sync=sync):
+                return function(*args, **kwargs)
+        return timed
+
+    def end_frame(self):
+        t = time.perf_counter()
+
+        with self.lock:
+            for name, durations in self.phases.items():
+                durations.append(self.frame.get(name, 0.0))
+            self.frame.clear()
+
+            self.frames.append(t - self.frame_start)
+            if self.trace:
+                self.events.append(("frame", self.frame_start, t, threading.get_ident()))
+
+        self.frame_start = t
+
+    def percentiles(self, durations):
+        if not durations:
+            return [0.0] * len(PERCENTILES)
+        return list(np.percentile(np.array(durations), PERCENTILES))
+
+    def summary(self):
+        # {phase: [p50, p95, p99]} in seconds, "frame" = whole frame
+        with self.lock:
+            rows = [(name, list(durations)) for name, durations in self.phases.items()]
+            rows.append(("frame", list(self.frames)))
+
+        return collections.OrderedDict((name, self.percentiles(durations)) for name, durations in rows)
+
+    def format_summary(self):
+        lines = ["%-12s %9s %9s %9s" % (("phase",) + tuple("p%d ms" % p for p in PERCENTILES))]
+        for name, values in self.summary().items():
+            lines.append("%-12s %9.3f %9.3f %9.3f" % ((name,) + tuple(v * 1000 for v in values)))
+        return "\n".join(lines)
+
+    def export_trace(self, path):
+        pid = os.getpid()
+
+        with self.lock:
+            events = list(self.events)
+
+        threads = {}
+        trace = []
+
+        for name, t0, t1, thread in events:
+            tid = threads.setdefault(thread, len(threads))
+            trace.append({"name": name, "cat": "frame" if name == "frame" else "phase", "ph": "X", "pid": pid, "tid": tid,
+                          "ts": (t0 - self.t0) * 1e6, "dur": (t1 - t0) * 1e6})
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+        return len(trace)
+
+# -----------------------------------------------------------------------------------------------------------
+# frame pacing: physics substeps per rendered frame
+#
+# the cost of a step and of the rest of the frame (events, transfer, draw, imgui, swap) are measured online
+# (exponential moving averages). With a target fps the substeps fill the frame budget the rest leaves, so
+# the frame rate holds while the simulated time per wall-second is maximised. The substeps at most double
+# from a frame to the next, a slower step drops them at once. A single step longer than the budget leaves
+# 1 substep: the frame rate then follows the physics (the threaded stepper decouples them)
+
+class FramePacer:
+
+    def __init__(self, fps=0, substeps=0, max_substeps=64, smoothing=0.2):
+        # target frame time, None for an unlimited fps (nothing to pace against: 1 substep)
+        self.budget = 1.0 / fps if fps > 0 else None
+
+        # fixed substeps per frame, 0 for automatic
+        self.fixed = substeps
+        self.max_substeps = max_substeps
+        self.smoothing = smoothing
+
+        self.substeps = substeps or 1
+
+        # moving averages (s): one step, the frame without its steps
+        self.step_cost = None
+        self.other_cost = None
+
+        self.frame_start = time.perf_counter()
+        self.frame_steps = 0
+        self.frame_step_time = 0.0
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+        self.frame_steps = 0
+        self.frame_step_time = 0.0
+
+    def add_step(self, elapsed):
+        self.frame_steps += 1
+        self.frame_step_time += elapsed
+
+    def average(self, value, sample):
+        return sample if value is None else value + self.smoothing * (sample - value)
+
+    def end_frame(self):
+        # before the wait for the target fps: the work of the frame -> the substeps of the next one
+        work = time.perf_counter() - self.frame_start
+
+        if self.frame_steps:
+            self.step_cost = self.average(self.step_cost, self.frame_step_time / self.frame_steps)
+        self.other_cost = self.average(self.other_cost, max(work - self.frame_step_time, 0.0))
+
+        if not self.fixed and self.budget and self.step_cost:
+            substeps = int((self.budget - self.other_cost) / self.step_cost)
+            self.substeps = max(1, min(substeps, self.max_substeps, self.substeps * 2))
+
+    def get_info(self):
+        ms = lambda t: (t or 0.0) * 1000
+        return {"substeps": self.substeps, "auto": not self.fixed and self.budget is not None, "step_ms": ms(self.step_cost),
+                "other_ms": ms(self.other_cost), "budget_ms": ms(self.budget)}
+
+# -----------------------------------------------------------------------------------------------------------
+# startup breakdown: mark(name) closes the stage in progress (imports, taichi init, initial conditions,
+# kernel compilation, first frame...), the interpreter start itself is not counted
+
+class StartupProfile:
+
+    def __init__(self, t0=None):
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self.last = self.t0
+        self.stages = []
+
+    def mark(self, name):
+        t = time.perf_counter()
+        self.stages.append((name, t - self.last))
+        self.last = t
+
+    def format(self):
+        lines = ["%-20s %9.3f s" % (name, duration) for name, duration in self.stages]
+        lines.append("%-20s %9.3f s" % ("startup", self.last - self.t0))
+        return "\n".join(lines)
@@ -0,0 +1,220 @@
+import json, queue, struct, threading, time, zlib
+
+import numpy as np
+
+# -----------------------------------------------------------------------------------------------------------
+# trajectory file
+#
+#   MAGIC (8 bytes) | header size (u32) | reserved (u32) | JSON header, space padded to HEADER_SIZE
+#   frames
+#
+# uncompressed: fixed size frames (header["frame_bytes"]), the file can be memory-mapped as a numpy
+#               structured array (step i8, time f8, pos (N, 3), vel (N, 3)), see TrajectoryReader.frames
+# compressed  : every frame is a u64 size followed by the compressed raw frame
+#
+# a frame is only counted once it is complete, a run killed while writing keeps all the previous frames
+
+MAGIC = b"NBTRAJ\x00\x01"
+PREAMBLE = struct.Struct("<8sII")
+HEADER_SIZE = 4096
+
+DTYPES = ("float32", "float16")
+COMPRESSIONS = ("none", "zlib", "zstd", "lz4")
+
+def frame_dtype(nb_body, dtype="float32", fields=("pos", "vel")):
+    return np.dtype([("step", "<i8"), ("time", "<f8")] + [(f, "<" + np.dtype(dtype).str[1:], (nb_body, 3)) for f in fields])
+
+def get_codec(compression):
+    # zlib is always there, zstd / lz4 only if their python package is installed
+    if compression in (None, "none"):
+        return None, None
+    if compression == "zlib":
+        return (lambda b: zlib.compress(b, 1)), zlib.decompress
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=1).compress, zstandard.ZstdDecompressor().decompress
+    if compression == "lz4":
+        import lz4.frame
+        return lz4.frame.compress, lz4.frame.decompress
+
+    raise ValueError("Unknown compression %s, expected one of %s" % (compression, COMPRESSIONS))
+
+# -----------------------------------------------------------------------------------------------------------
+# background writer
+#
+# the simulation thread only copies pos / vel into a free buffer of a preallocated pool and queues it,
+# it never waits: no free buffer (the disk is behind) => the frame is dropped and counted
+
+class TrajectoryWriter:
+
+    def __init__(self, path, nb_body, dt=0.0, eps=0.0, every=1, dtype="float32", compression="none", nb_buffer=8, **meta):
+
+        if dtype not in DTYPES:
+            raise ValueError("Unknown dtype %s, expected one of %s" % (dtype, DTYPES))
+
+        self.path = path
+        self.nb_body = nb_body
+        self.every = max(1, every)
+        self.dtype = frame_dtype(nb_body, dtype)
+        self.compress, _ = get_codec(compression)
+
+        self.header = dict(meta, version=1, nb_body=nb_body, dtype=dtype, fields=["pos", "vel"], dt=dt, eps=eps, every=self.every,
+                           compression=compression or "none", frame_bytes=self.dtype.itemsize, header_bytes=HEADER_SIZE)
+
+        self.file = open(path, "wb")
+        self.file.write(encode_header(self.header))
+
+        # float32 staging buffers (filled by the export kernels), recycled through free_buffers
+        self.free_buffers = queue.Queue()
+        for _ in range(nb_buffer):
+            self.free_buffers.put((np.empty((nb_body, 3), dtype='f4'), np.empty((nb_body, 3), dtype='f4')))
+
+        self.pending = queue.Queue()
+
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.bytes_written = HEADER_SIZE
+        self.busy_time = 0.0
+
+        self.thread = threading.Thread(target=self.run, name="nbody-trajectory", daemon=True)
+        self.thread.start()
+
+    def write(self, system):
+        # called after every step, keeps one frame every `every` steps
+        if system.step_count % self.every:
+            return
+
+        try:
+            pos, vel = self.free_buffers.get_nowait()
+        except queue.Empty:
+            self.frames_dropped += 1
+            return
+
+        # frames in body id order, the system may reorder its slots
+        system.export_by_id(pos, vel)
+
+        self.pending.put((system.step_count, system.time, pos, vel))
+
+    def run(self):
+        frame = np.zeros((), dtype=self.dtype)
+
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+
+            t0 = time.perf_counter()
+
+            step, sim_time, pos, vel = item
+            frame["step"] = step
+            frame["time"] = sim_time
+            frame["pos"] = pos
+            frame["vel"] = vel
+
+            self.free_buffers.put((pos, vel))
+
+            data = frame.tobytes()
+            if self.compress:
+                data = self.compress(data)
+                self.file.write(struct.pack("<Q", len(data)))
+                self.bytes_written += 8
+
+            self.file.write(data)
+            self.file.flush()
+
+            self.bytes_written += len(data)
+            self.frames_written += 1
+            self.busy_time += time.perf_counter() - t0
+
+    def metrics(self):
+        return {
+            "frames_written": self.frames_written,
+            "frames_dropped": self.frames_dropped,
+            "frames_queued": self.pending.qsize(),
+            "bytes_written": self.bytes_written,
+            "write_mb_per_sec": self.bytes_written / self.busy_time / 1e6 if self.busy_time else 0.0,
+        }
+
+    def close(self):
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+            self.file.close()
+
+# the writer of a system, its settings in the header
+def open_writer(system, path, dt, eps, every=10, dtype="float32", compression="none"):
+    return TrajectoryWriter(path, system.nb_body, dt=dt, eps=eps, every=every, dtype=dtype, compression=compression,
+                            solver=system.solver, integrator=system.integrator_name, layout=system.layout, precision=system.precision)
+
+def print_writer_metrics(writer):
+    m = writer.metrics()
+    print("trajectory %s: %d frames written, %d dropped, %d queued, %.1f MB at %.1f MB/s" % (writer.path, m["frames_written"],
+          m["frames_dropped"], m["frames_queued"], m["bytes_written"] / 1e6, m["write_mb_per_sec"]))
+
+def encode_header(header):
+    text = json.dumps(header).encode()
+    if len(text) > HEADER_SIZE - PREAMBLE.size:
+        raise ValueError("Trajectory header too big (%d bytes)" % len(text))
+
+    return PREAMBLE.pack(MAGIC, HEADER_SIZE, 0) + text.ljust(HEADER_SIZE - PREAMBLE.size, b" ")
+
+# -----------------------------------------------------------------------------------------------------------
+
+class TrajectoryReader:
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as f:
+            magic, header_size, _ = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError("%s is not a trajectory file" % path)
+
+            self.header = json.loads(f.read(header_size - PREAMBLE.size))
+
+        self.header_size = header_size
+        self.nb_body = self.header["nb_body"]
+        self.dtype = frame_dtype(self.nb_body, self.header["dtype"], self.header["fields"])
+        self.compressed = self.header["compression"] != "none"
+
+        if self.compressed:
+            _, self.decompress = get_codec(self.header["compression"])
+            self.offsets = self.scan()
+            self.frames = None
+        else:
+            # zero copy: frames[k]["pos"] is a view on the page cache
+            nb_frame = (self.file_size() - header_size) // self.dtype.itemsize
+            self.frames = np.memmap(path, dtype=self.dtype, mode="r", offset=header_size, shape=(nb_frame,)) if nb_frame else np.zeros(0, self.dtype)
+
+    def file_size(self):
+        with open(self.path, "rb") as f:
+            return f.seek(0, 2)
+
+    def scan(self):
+        offsets = []
+        size = self.file_size()
+
+        with open(self.path, "rb") as f:
+            offset = self.header_size
+            while offset + 8 <= size:
+                f.seek(offset)
+                n, = struct.unpack("<Q", f.read(8))
+                if offset + 8 + n > size:
+                    break
+                offsets.append((offset + 8, n))
+                offset += 8 + n
+
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets) if self.compressed else len(self.frames)
+
+    def frame(self, k):
+        if not self.compressed:
+            return self.frames[k]
+
+        offset, n = self.offsets[k]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return np.frombuffer(self.decompress(f.read(n)), dtype=self.dtype)[0]
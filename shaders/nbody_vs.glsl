@@ -1,22 +1,28 @@
 #version 430
 
 in vec3 in_position;
+// bodies behind the vertex: 1, or the body count of a LOD impostor
+in float in_weight;
 //in vec4 in_velocity;
 
 uniform mat4 m_proj;
 uniform mat4 m_view;
 uniform mat4 m_model;
 
+// packed VBO positions (int16): position = offset + in_position * scale, (0, 1) otherwise
+uniform vec3 u_pos_offset;
+uniform vec3 u_pos_scale;
+
 //out vec4 body_color;
 out float body_color_dist;
 
 void main() {
-    vec4 model_pos = m_model * vec4(in_position.xyz, 1.0);
+    vec4 model_pos = m_model * vec4(u_pos_offset + in_position.xyz * u_pos_scale, 1.0);
 	vec4 view_model_pos = m_view * model_pos;
 	gl_Position = m_proj * view_model_pos;
 
 	float dist = length(view_model_pos);
-	float psize = 50. / dist;
+	float psize = 50. / dist * pow(max(in_weight, 1.0), 1.0 / 3.0);
 	gl_PointSize = psize;
 
 	//body_color_dist = model_pos.z;
@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pytest
+import taichi as ti
+
+from nbody import checkpoint
+from nbody.checkpoint import restore_checkpoint, save_checkpoint, system_from_checkpoint
+from nbody.ic import plummer
+from nbody.system import NBodySystem
+
+# save -> restore -> N more steps gives the same state as an uninterrupted run, cpu arch
+
+DT, EPS = 0.01, 0.1
+STEPS = 6
+
+@pytest.fixture(scope="module", autouse=True)
+def taichi():
+    ti.init(arch=ti.cpu, offline_cache=False)
+
+def make_system(integrator, reorder_every=0):
+    # fewer bodies than slots: the restore keeps the active count
+    pos, vel, mass = plummer(200, np.random.default_rng(0), scale=8.0)
+    system = NBodySystem(nb_body=200, solver="direct", integrator=integrator, capacity=256)
+    system.set_bodies(pos, vel, mass)
+    system.set_reorder(reorder_every)
+    return system
+
+def run(system, steps):
+    for _ in range(steps):
+        system.update(DT, EPS)
+
+def state(system):
+    # by body id, the slots may have been reordered
+    pos = np.empty((system.nb_body, 3), dtype='f4')
+    vel = np.empty((system.nb_body, 3), dtype='f4')
+    system.export_by_id(pos, vel)
+    return pos[:system.n_active], vel[:system.n_active]
+
+@pytest.mark.parametrize("integrator, reorder_every", [("kdk", 0), ("kdk", 4), ("rk4", 0), ("hermite", 0)])
+def test_restart_continues_the_run(tmp_path, integrator, reorder_every):
+    path = str(tmp_path / "run.npz")
+
+    system = make_system(integrator, reorder_every)
+    run(system, STEPS)
+    save_checkpoint(system, path, DT, EPS, seed=3)
+    run(system, STEPS)
+
+    restored, meta = system_from_checkpoint(path)
+    restored.set_reorder(reorder_every)
+
+    assert (meta["step"], meta["seed"], meta["dt"], meta["eps"]) == (STEPS, 3, DT, EPS)
+    assert restored.n_active == 200 and restored.nb_body == 256
+    assert restored.step_count == STEPS and restored.time == pytest.approx(STEPS * DT)
+
+    run(restored, STEPS)
+
+    for a, b in zip(state(system), state(restored)):
+        np.testing.assert_allclose(a, b, rtol=1e-6, atol=1e-6)
+    assert restored.time == pytest.approx(system.time)
+
+def test_hermite_state_restored(tmp_path):
+    path = str(tmp_path / "run.npz")
+
+    system = make_system("hermite")
+    run(system, 2)
+    save_checkpoint(system, path, DT, EPS)
+
+    # into a fresh system with the same settings
+    restored = make_system("hermite")
+    restore_checkpoint(restored, path)
+
+    assert restored.integrator.primed == system.integrator.primed
+    for name in system.integrator.state_fields:
+        np.testing.assert_array_equal(getattr(restored.integrator, name).to_numpy(), getattr(system.integrator, name).to_numpy())
+
+def test_failed_save_keeps_the_previous_checkpoint(tmp_path, monkeypatch):
+    path = str(tmp_path / "run.npz")
+
+    system = make_system("kdk")
+    run(system, 2)
+    save_checkpoint(system, path, DT, EPS)
+    assert os.listdir(tmp_path) == ["run.npz"]
+
+    def crash(f, **arrays):
+        f.write(b"partial")
+        raise OSError("disk full")
+
+    run(system, 2)
+    monkeypatch.setattr(checkpoint.np, "savez", crash)
+    with pytest.raises(OSError):
+        save_checkpoint(system, path, DT, EPS)
+    monkeypatch.undo()
+
+    # the rename never happened: the previous checkpoint is intact
+    assert checkpoint.read_checkpoint_meta(path)["step"] == 2
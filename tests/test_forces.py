@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import taichi as ti
+
+from nbody.forces import DirectForce, TiledForce
+from nbody.ic import plummer
+from nbody.system import NBodySystem
+
+# the tiled symmetric solver against the direct summation, cpu arch
+
+@pytest.fixture(scope="module", autouse=True)
+def taichi():
+    ti.init(arch=ti.cpu, offline_cache=False)
+
+def forces(force, system, eps):
+    # what system.compute_forces does, with a given solver
+    if system.layout == "packed":
+        system.pack()
+
+    force.compute(eps, True)
+    n = system.n_active
+    return system.acc.to_numpy()[:n], system.pot.to_numpy()[:n]
+
+# (bodies, slots, tile, layout): full tiles, partial last tile (and partial last block) with an even / odd tile
+# count, free slots after the active bodies
+CASES = [
+    (256, 256, 32, "soa"),
+    (300, 512, 32, "soa"),   # 10 tiles, the last one 12 bodies
+    (600, 600, 128, "soa"),  # 5 tiles, the last one 88 bodies
+    (37, 64, 8, "packed"),   # 5 tiles, the last one 5 bodies
+]
+
+@pytest.mark.parametrize("nb_active, nb_body, tile, layout", CASES)
+@pytest.mark.parametrize("eps", [0.5, 0.0])
+def test_tiled_equals_direct(nb_active, nb_body, tile, layout, eps):
+    pos, vel, mass = plummer(nb_active, np.random.default_rng(nb_active), scale=8.0)
+
+    system = NBodySystem(nb_body=nb_body, solver="tiled", layout=layout)
+    system.set_bodies(pos, vel, mass * np.linspace(0.5, 1.5, nb_active))
+
+    acc, pot = forces(DirectForce(system), system, eps)
+    tiled_acc, tiled_pot = forces(TiledForce(system, tile=tile), system, eps)
+
+    assert np.isfinite(tiled_acc).all() and np.isfinite(tiled_pot).all()
+    assert np.abs(tiled_acc - acc).max() <= 1e-5 * np.abs(acc).max()
+    assert np.abs(tiled_pot - pot).max() <= 1e-5 * np.abs(pot).max()
+
+def test_tile_multiple_of_lanes():
+    system = NBodySystem(nb_body=64, solver="direct")
+    with pytest.raises(ValueError):
+        TiledForce(system, tile=30)
+
+def test_barnes_hut_close_to_direct():
+    pos, vel, mass = plummer(3000, np.random.default_rng(1), scale=8.0)
+
+    # coincident bodies share a leaf (equal keys)
+    pos[1:6] = pos[0]
+
+    system = NBodySystem(nb_body=4096, solver="bh", theta=0.5)
+    system.set_bodies(pos, vel, mass)
+
+    # the bodies of the first slots move around, the tree only covers the active ones
+    system.remove_bodies([0, 10, 20])
+
+    acc, _ = forces(DirectForce(system), system, 0.1)
+    bh_acc, _ = forces(system.force, system, 0.1)
+
+    err = np.linalg.norm(bh_acc - acc, axis=1) / np.linalg.norm(acc, axis=1)
+    assert np.median(err) < 1e-2
+    assert err.max() < 1e-1
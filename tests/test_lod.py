@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import taichi as ti
+
+from nbody.ic import plummer
+from nbody.lod import LOD
+
+# the LOD budget logic offscreen: cpu arch, no GL
+
+N = 50000
+
+@pytest.fixture(scope="module")
+def bodies():
+    ti.init(arch=ti.cpu, offline_cache=False)
+    pos, _, mass = plummer(N, np.random.default_rng(0), scale=8.0)
+    return pos.astype('f4'), mass.astype('f4')
+
+CAMERAS = {"near": (0.0, 0.0, 1.0), "far": (0.0, 0.0, 200.0)}
+
+@pytest.mark.parametrize("budget", [1000, 5000, 20000])
+@pytest.mark.parametrize("camera", list(CAMERAS))
+def test_budget_and_weights(bodies, budget, camera):
+    pos, mass = bodies
+    cam = np.array(CAMERAS[camera], dtype='f4')
+    lod = LOD(budget)
+
+    # a few frames, the near radius adapts between them
+    for _ in range(10):
+        out_pos, weight = lod.update(pos, mass, cam)
+
+        assert lod.nb_vertex <= budget
+        assert len(out_pos) == len(weight) == lod.nb_vertex
+        assert weight.sum() == pytest.approx(N)
+        assert np.isfinite(out_pos).all()
+
+@pytest.mark.parametrize("camera", list(CAMERAS))
+def test_near_bodies_first(bodies, camera):
+    pos, mass = bodies
+    cam = np.array(CAMERAS[camera], dtype='f4')
+    lod = LOD(5000)
+
+    for _ in range(10):
+        radius = lod.radius
+        out_pos, weight = lod.update(pos, mass, cam)
+
+        if radius is None:
+            continue
+
+        within = int((np.linalg.norm(pos - cam, axis=1) < radius).sum())
+        near = min(lod.nb_near, lod.near_cap)
+
+        # every body within the radius is drawn one by one while the budget has room for them
+        assert lod.nb_near == within
+        assert near == min(within, lod.near_cap)
+
+        # the near vertices come first, bodies (weight 1) within the radius
+        assert (weight[:near] == 1.0).all()
+        assert (np.linalg.norm(out_pos[:near] - cam, axis=1) < radius * (1 + 1e-5)).all()
+
+    # the radius settles with the near bodies inside their share of the budget
+    assert 0 < min(lod.nb_near, lod.near_cap) <= lod.near_cap
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import taichi as ti
+
+from nbody.ic import plummer
+from nbody.reorder import BLOCK, RadixSort
+from nbody.system import NBodySystem
+
+# the Morton reorder only moves bodies between slots, cpu arch
+
+@pytest.fixture(scope="module", autouse=True)
+def taichi():
+    ti.init(arch=ti.cpu, offline_cache=False)
+
+def by_id(system):
+    # every per body field, indexed by body id
+    ids = system.ids.to_numpy()
+    fields = []
+    for f in system.body_fields:
+        a = f.to_numpy()
+        out = np.empty_like(a)
+        out[ids] = a
+        fields.append(out)
+    return fields
+
+@pytest.mark.parametrize("integrator, precision", [("kdk", "f64"), ("hermite", "f32")])
+def test_reorder_keeps_bodies_by_id(integrator, precision):
+    pos, vel, mass = plummer(3000, np.random.default_rng(2), scale=8.0)
+
+    system = NBodySystem(nb_body=4096, solver="direct", integrator=integrator, precision=precision)
+    system.set_bodies(pos, vel, mass * np.linspace(0.5, 1.5, 3000))
+    system.update(0.01, 0.1)
+
+    # ids out of order before the reorder, free slots after the active bodies
+    system.remove_bodies([0, 10, 20])
+    n = system.n_active
+
+    before = by_id(system)
+    ids = system.ids.to_numpy()
+    system.reorder()
+
+    new_ids = system.ids.to_numpy()
+    assert not np.array_equal(new_ids, ids)
+    assert np.array_equal(np.sort(new_ids), np.arange(system.nb_body))
+    # the active bodies stay active
+    assert np.array_equal(np.sort(new_ids[:n]), np.sort(ids[:n]))
+
+    for a, b in zip(before, by_id(system)):
+        np.testing.assert_array_equal(a, b)
+
+    # sorted already: a second reorder keeps every slot
+    system.reorder()
+    np.testing.assert_array_equal(system.ids.to_numpy(), new_ids)
+
+@pytest.mark.parametrize("n", [1000, 2 * BLOCK + 123])
+def test_radix_sort_stable(n):
+    rng = np.random.default_rng(n)
+    # few distinct low digits and wide keys: ties and every pass used
+    keys = rng.integers(0, 50, n, dtype=np.uint64) << np.uint64(40) | rng.integers(0, 4, n, dtype=np.uint64)
+
+    sorter = RadixSort(3 * BLOCK)
+    sorter.keys.from_numpy(np.stack([np.pad(keys, (0, 3 * BLOCK - n), constant_values=7), np.zeros(3 * BLOCK, np.uint64)]))
+    sorter.slots.from_numpy(np.stack([np.arange(3 * BLOCK, dtype=np.int32)] * 2))
+    sorter.sort(n)
+
+    order = np.argsort(keys, kind="stable")
+    np.testing.assert_array_equal(sorter.slots.to_numpy()[0, :n], order)
+    np.testing.assert_array_equal(sorter.keys.to_numpy()[0, :n], keys[order])
@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+import pytest
+
+from nbody.replay import Player
+from nbody.trajectory import TrajectoryReader, TrajectoryWriter
+
+# trajectory files written and read back, numpy only (no taichi)
+
+N = 100
+NB_FRAME = 5
+
+class Frames:
+    # what the writer reads from a system: step_count, time and export_by_id
+
+    def __init__(self, seed=0):
+        rng = np.random.default_rng(seed)
+        self.pos = rng.uniform(-8.0, 8.0, (NB_FRAME, N, 3)).astype('f4')
+        self.vel = rng.uniform(-1.0, 1.0, (NB_FRAME, N, 3)).astype('f4')
+        self.step_count = 0
+        self.time = 0.0
+
+    def export_by_id(self, pos, vel):
+        pos[:] = self.pos[self.step_count]
+        vel[:] = self.vel[self.step_count]
+
+def write(path, frames, dtype, compression):
+    writer = TrajectoryWriter(str(path), N, dt=0.01, eps=0.5, every=1, dtype=dtype, compression=compression, solver="direct")
+    for k in range(NB_FRAME):
+        frames.step_count, frames.time = k, k * 0.01
+        writer.write(frames)
+    writer.close()
+    return writer
+
+# (rtol, atol): float16 keeps 11 significant bits
+TOLERANCE = {"float32": (0.0, 0.0), "float16": (1e-3, 1e-4)}
+
+@pytest.mark.parametrize("compression", ["none", "zlib"])
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_roundtrip(tmp_path, dtype, compression):
+    frames = Frames()
+    path = tmp_path / "run.nbt"
+    writer = write(path, frames, dtype, compression)
+
+    assert writer.metrics()["frames_written"] == NB_FRAME
+    assert writer.metrics()["frames_dropped"] == 0
+
+    reader = TrajectoryReader(str(path))
+    assert len(reader) == NB_FRAME
+    assert reader.header["dtype"] == dtype and reader.header["compression"] == compression
+    assert reader.header["solver"] == "direct"
+
+    for k in range(NB_FRAME):
+        frame = reader.frame(k)
+        assert frame["step"] == k
+        assert frame["time"] == pytest.approx(k * 0.01)
+        assert frame["pos"].dtype == np.dtype(dtype)
+        rtol, atol = TOLERANCE[dtype]
+        np.testing.assert_allclose(frame["pos"], frames.pos[k], rtol=rtol, atol=atol)
+        np.testing.assert_allclose(frame["vel"], frames.vel[k], rtol=rtol, atol=atol)
+
+@pytest.mark.parametrize("compression", ["none", "zlib"])
+def test_truncated_frame_dropped(tmp_path, compression):
+    # a run killed while writing: the partial last frame is not counted
+    path = tmp_path / "run.nbt"
+    write(path, Frames(), "float32", compression)
+
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 10)
+
+    assert len(TrajectoryReader(str(path))) == NB_FRAME - 1
+
+def test_replay_memmap(tmp_path):
+    frames = Frames()
+    path = tmp_path / "run.nbt"
+    write(path, frames, "float32", "none")
+
+    player = Player(str(path), mode="skip", loop=False)
+    assert isinstance(player.reader.frames, np.memmap)
+    assert player.nb_frame == NB_FRAME
+
+    # skip: the frame under the play head, a view on the file
+    player.seek(2.7)
+    np.testing.assert_array_equal(player.positions(), frames.pos[2])
+    assert player.positions() is None
+    assert player.get_frame_info() == (2, pytest.approx(0.02))
+
+    # linear: between the two frames
+    player.mode = "linear"
+    player.seek(1.5)
+    np.testing.assert_allclose(player.positions(), (frames.pos[1] + frames.pos[2]) * 0.5, atol=1e-5)
+
+    # hermite: through the frames at both ends
+    player.mode = "hermite"
+    player.seek(3.0)
+    np.testing.assert_array_equal(player.positions(), frames.pos[3])
+    player.seek(3.5)
+    assert np.isfinite(player.positions()).all()
+
+    # clamped at the ends without looping
+    player.seek(10.0)
+    assert player.current() == NB_FRAME - 1